@@ -0,0 +1,188 @@
+#!/usr/bin/python
+"""
+Benchmark the probe collectors and the job/slot state transforms against
+a synthetic pool (see fake/htcondor.py), reporting run time, ads and
+metrics (or records) per second, and peak memory for each.
+
+    python bench/benchmark.py --jobs 1000000 --schedds 50 --slots 200000
+"""
+import os
+import sys
+import time
+import json
+import logging
+from optparse import OptionParser
+
+here = os.path.dirname(os.path.abspath(__file__))
+# the fake bindings must shadow any real ones
+sys.path[0:0] = [os.path.join(here, "fake"), os.path.join(here, "..", "bin")]
+
+import htcondor
+
+from fifemon import Instruments
+from fifemon.memory import reset_peak_rss, peak_rss
+from fifemon.emitter import Emitter
+from condor.jobs import Jobs
+from condor import slots, status, priorities
+import jobstate
+import slotstate
+
+logger = logging.getLogger(__name__)
+
+POOL = "fake.example.com"
+
+
+def count_ads(stats, suffix=".ads"):
+    return sum(v for k,v in stats.iteritems() if k.endswith(suffix))
+
+def bench_schedd_queries(opts):
+    """baseline: time to generate and stream the synthetic jobs, included
+    in every job benchmark below"""
+    n = 0
+    for ad in htcondor.Collector(POOL).locateAll(htcondor.DaemonTypes.Schedd):
+        for r in htcondor.Schedd(ad).xquery(True, Jobs.projection):
+            n += 1
+    return n, 0
+
+def bench_startd_query(opts):
+    """baseline: time to generate the synthetic slots, included in every
+    slot benchmark below"""
+    n = len(htcondor.Collector(POOL).query(htcondor.AdTypes.Startd, True, None))
+    return n, 0
+
+def bench_job_count(opts):
+    stats = Instruments()
+    jobs = Jobs(POOL, max_workers=opts.workers)
+    data = jobs.get_job_count(retry_delay=0, max_retries=1, stats=stats)
+    return stats.get("jobs.ads", 0), len(data)
+
+def bench_pool_slots(opts):
+    stats = Instruments()
+    data = slots.get_pool_slots(POOL, retry_delay=0, max_retries=1, stats=stats)
+    return count_ads(stats), len(data)
+
+def bench_pool_glidein_slots(opts):
+    stats = Instruments()
+    data = slots.get_pool_glidein_slots(POOL, retry_delay=0, max_retries=1, stats=stats)
+    return count_ads(stats), len(data)
+
+def bench_pool_startd_metrics(opts):
+    stats = Instruments()
+    data = slots.get_pool_startd_metrics(POOL, retry_delay=0, max_retries=1, stats=stats)
+    return count_ads(stats), sum(len(d) for d in data.itervalues())
+
+def bench_pool_priorities(opts):
+    stats = Instruments()
+    data = priorities.get_pool_priorities(POOL, retry_delay=0, max_retries=1, stats=stats)
+    return count_ads(stats), len(data)
+
+def bench_pool_status(opts):
+    stats = Instruments()
+    data = status.get_pool_status(POOL, retry_delay=0, max_retries=1, stats=stats)
+    return count_ads(stats), sum(len(d["metrics"]) for d in data)
+
+def bench_jobstate(opts):
+    j = jobstate.Jobs(POOL)
+    emitter = Emitter(open(os.devnull, "w"))
+    for s in j.get_job_stats(retry_delay=0, max_retries=1, extra_stats=jobstate.default_extra_stats):
+        emitter.write(jobstate.calc_stats(s))
+    emitter.flush()
+    return opts.jobs, emitter.records
+
+def bench_slotstate(opts):
+    s = slotstate.Slots(POOL)
+    emitter = Emitter(open(os.devnull, "w"))
+    for r in s.get_stats(retry_delay=0, max_retries=1, extra_stats=["GLIDECLIENT_group"]):
+        emitter.write(r)
+    emitter.flush()
+    return emitter.records, emitter.records
+
+benchmarks = [
+    ("schedd_queries", bench_schedd_queries),
+    ("startd_query", bench_startd_query),
+    ("get_job_count", bench_job_count),
+    ("get_pool_slots", bench_pool_slots),
+    ("get_pool_glidein_slots", bench_pool_glidein_slots),
+    ("get_pool_startd_metrics", bench_pool_startd_metrics),
+    ("get_pool_priorities", bench_pool_priorities),
+    ("get_pool_status", bench_pool_status),
+    ("jobstate", bench_jobstate),
+    ("slotstate", bench_slotstate),
+]
+
+def run(name, func, opts):
+    """run one benchmark opts.repeat times, keeping the fastest run"""
+    best = None
+    for i in xrange(opts.repeat):
+        reset_peak_rss()
+        start = time.time()
+        ads, metrics = func(opts)
+        duration = time.time()-start
+        result = {
+            "benchmark": name,
+            "time": duration,
+            "ads": ads,
+            "metrics": metrics,
+            "ads_per_sec": ads/duration if duration > 0 else 0,
+            "metrics_per_sec": metrics/duration if duration > 0 else 0,
+            "peak_rss_mb": peak_rss()/1024.0/1024.0,
+        }
+        logger.debug(result)
+        if best is None or result["time"] < best["time"]:
+            best = result
+    return best
+
+def get_options():
+    parser = OptionParser(usage="usage: %prog [options] [benchmark ...]",
+            description="benchmarks: "+", ".join(name for name,func in benchmarks))
+    parser.add_option('--jobs',type="int",default=100000,
+        help="jobs in the synthetic pool (default %default)")
+    parser.add_option('--schedds',type="int",default=10,
+        help="schedds to spread the jobs over (default %default)")
+    parser.add_option('--slots',type="int",default=20000,
+        help="startd slots in the synthetic pool (default %default)")
+    parser.add_option('--glidein-fraction',type="float",default=0.5,
+        help="fraction of slots that are glideins (default %default)")
+    parser.add_option('--users',type="int",default=500,
+        help="users submitting jobs (default %default)")
+    parser.add_option('--workers',type="int",default=8,
+        help="schedd query workers for get_job_count (default %default)")
+    parser.add_option('--repeat',type="int",default=1,
+        help="runs per benchmark, the fastest is reported (default %default)")
+    parser.add_option('--json',action="store_true",
+        help="print results as JSON, one per line")
+    parser.add_option('-d','--debug',action="store_true",
+        help="enable debug logging")
+    (opts,args) = parser.parse_args()
+    names = [name for name,func in benchmarks]
+    for a in args:
+        if a not in names:
+            parser.error("unknown benchmark '%s'" % a)
+    return opts,args
+
+if __name__=="__main__":
+    opts,args = get_options()
+    loglevel = logging.WARNING
+    if opts.debug:
+        loglevel = logging.DEBUG
+    logging.basicConfig(level=loglevel,
+        format="%(asctime)s [%(levelname)s] %(name)s - %(message)s")
+    htcondor.configure(jobs=opts.jobs, schedds=opts.schedds, slots=opts.slots,
+            glidein_fraction=opts.glidein_fraction, users=opts.users)
+    if not reset_peak_rss():
+        logger.warning("unable to reset peak RSS, peak memory is since the benchmark started")
+
+    if not opts.json:
+        print "%-24s %9s %10s %12s %9s %12s %9s" % (
+                "benchmark", "time(s)", "ads", "ads/s", "metrics", "metrics/s", "peak MB")
+    for name, func in benchmarks:
+        if args and name not in args:
+            continue
+        r = run(name, func, opts)
+        if opts.json:
+            print json.dumps(r)
+        else:
+            print "%-24s %9.2f %10d %12.0f %9d %12.0f %9.1f" % (
+                    name, r["time"], r["ads"], r["ads_per_sec"],
+                    r["metrics"], r["metrics_per_sec"], r["peak_rss_mb"])
+        sys.stdout.flush()
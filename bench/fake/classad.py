@@ -0,0 +1,9 @@
+#!/usr/bin/python
+"""
+Minimal stand-in for the HTCondor classad module, for benchmarks. Ads are
+plain dicts of already-evaluated attribute values.
+"""
+
+class ClassAd(dict):
+    def eval(self, attr):
+        return self[attr]
@@ -0,0 +1,313 @@
+#!/usr/bin/python
+"""
+Stand-in for the HTCondor python bindings that serves a synthetic pool, so
+the probes can be benchmarked without a live collector. Only the calls the
+probes make are implemented.
+
+Call configure() to set the pool size before querying. Ads are generated
+from a fixed seed, so every run of the same configuration sees the same
+pool, and schedd queries generate their jobs as they are iterated like a
+real streaming query does.
+"""
+import random
+import re
+import time
+
+from classad import ClassAd
+
+config = {
+    "jobs": 100000,
+    "schedds": 10,
+    "slots": 20000,
+    "glidein_fraction": 0.5,
+    "users": 500,
+    "experiments": 30,
+    "sites": 40,
+    "seed": 42,
+}
+
+def configure(**kwargs):
+    for k,v in kwargs.iteritems():
+        if k not in config:
+            raise ValueError("unknown fake pool setting '%s'" % k)
+        config[k] = v
+
+class DaemonTypes(object):
+    Schedd = "Schedd"
+    Collector = "Collector"
+    Negotiator = "Negotiator"
+    Startd = "Startd"
+
+class AdTypes(object):
+    Startd = "Startd"
+    Schedd = "Schedd"
+    Collector = "Collector"
+    Negotiator = "Negotiator"
+
+
+## constraints
+
+class _Scope(object):
+    """attribute lookup for constraint evaluation: case-insensitive, and
+    undefined attributes are None"""
+    def __init__(self, ad):
+        self.ad = ad
+
+    def __getitem__(self, name):
+        if name in ("True", "False", "None"):
+            raise KeyError(name)
+        if name in self.ad:
+            return self.ad[name]
+        name = name.lower()
+        for k in self.ad:
+            if k.lower() == name:
+                return self.ad[k]
+        return None
+
+def _compile(constraint):
+    """compile a simple ClassAd constraint (comparisons, && and ||) into a
+    python code object, or None if it matches everything"""
+    if constraint is None or constraint is True:
+        return None
+    constraint = str(constraint)
+    if constraint.strip().lower() == "true":
+        return None
+    expr = constraint.replace("&&", " and ").replace("||", " or ")
+    expr = re.sub(r"!(?!=)", " not ", expr)
+    expr = re.sub(r"\btrue\b", "True", expr, flags=re.I)
+    expr = re.sub(r"\bfalse\b", "False", expr, flags=re.I)
+    expr = re.sub(r"=\?=", "==", expr)
+    expr = re.sub(r"=!=", "!=", expr)
+    return compile(expr, "<constraint>", "eval")
+
+def _filter(ads, constraint, projection):
+    code = _compile(constraint)
+    for ad in ads:
+        if code is not None and not eval(code, {}, _Scope(ad)):
+            continue
+        if projection:
+            yield ClassAd((k, ad[k]) for k in projection if k in ad)
+        else:
+            yield ClassAd(ad)
+
+
+## synthetic pool
+
+def _users(r):
+    exps = ["exp%02d" % i for i in xrange(config["experiments"])]
+    return [(r.choice(exps), "user%04d" % i) for i in xrange(config["users"])]
+
+def _sites():
+    return ["Site%02d" % i for i in xrange(config["sites"])]
+
+def _schedd_names():
+    return ["schedd%02d.example.com" % i for i in xrange(config["schedds"])]
+
+def _jobs(schedd, now):
+    """jobs on one schedd, generated lazily"""
+    index = _schedd_names().index(schedd)
+    r = random.Random(config["seed"]*1000+index)
+    users = _users(random.Random(config["seed"]))
+    sites = _sites()
+    n = config["jobs"]//config["schedds"]
+    if index < config["jobs"]%config["schedds"]:
+        n += 1
+    cluster = 1
+    proc = 0
+    exp, user = r.choice(users)
+    qdate = now-r.randint(0, 14*86400)
+    for i in xrange(n):
+        status = r.choice([1,1,1,1,1,1,2,2,2,5])
+        universe = 7 if r.random() < 0.01 else 5
+        ad = {
+            "ClusterId": cluster,
+            "ProcId": proc,
+            "Owner": user,
+            "AccountingGroup": "group_%s.%s" % (exp, user),
+            "JobStatus": status,
+            "JobUniverse": universe,
+            "QDate": qdate,
+            "EnteredCurrentStatus": qdate+r.randint(0, now-qdate),
+            "RequestCpus": r.choice([1,1,1,1,2,4,8]),
+            "RequestMemory": r.choice([1000,2000,2000,4000,8000]),
+            "RequestDisk": r.choice([1000000,10000000,35000000]),
+            "NumRestarts": r.choice([0,0,0,1,2]),
+            "NumJobStarts": r.choice([0,1,1,1,2]),
+            "JOB_EXPECTED_MAX_LIFETIME": r.choice([3600,28800,86400]),
+        }
+        if status == 1:
+            if r.random() < 0.8:
+                ad["DESIRED_usage_model"] = r.choice(["DEDICATED","OPPORTUNISTIC","DEDICATED,OPPORTUNISTIC","OFFSITE"])
+            if r.random() < 0.3:
+                ad["DESIRED_Sites"] = ",".join(r.sample(sites, 3))
+        elif status == 2:
+            start = ad["EnteredCurrentStatus"]
+            ad["JobCurrentStartDate"] = start
+            ad["RemoteUserCpu"] = float(int((now-start)*r.random()))
+            ad["ResidentSetSize_RAW"] = r.randint(10000, 4000000)
+            ad["DiskUsage_RAW"] = r.randint(1000, 30000000)
+            site = r.choice(sites)
+            ad["MATCH_GLIDEIN_Site"] = site
+            ad["MATCH_EXP_JOBGLIDEIN_ResourceName"] = site+"_CE"
+        elif status == 5:
+            ad["HoldReason"] = "Job exceeded memory limit"
+            ad["HoldReasonCode"] = 34
+            ad["HoldReasonSubcode"] = 0
+        yield ad
+        # clusters of about 20 procs, submitted together by one user
+        proc += 1
+        if r.random() < 0.05:
+            cluster += 1
+            proc = 0
+            exp, user = r.choice(users)
+            qdate = now-r.randint(0, 14*86400)
+
+def _slots(now):
+    """partitionable slots with their dynamic slots, plus static glidein
+    slots, config["slots"] in all"""
+    r = random.Random(config["seed"]+1)
+    users = _users(random.Random(config["seed"]))
+    sites = _sites()
+    total = config["slots"]
+    glideins = int(total*config["glidein_fraction"])
+    ads = []
+    n = 0
+    while len(ads) < total-glideins:
+        n += 1
+        name = "wn%05d.example.com" % n
+        cpus = r.choice([8,16,32,64])
+        memory = cpus*2000
+        disk = cpus*20000000
+        load = 0.0
+        claimed = r.randint(0, cpus)
+        for i in xrange(claimed):
+            if len(ads) >= total-glideins-1:
+                break
+            exp, user = r.choice(users)
+            slot_load = r.random()
+            load += slot_load
+            ads.append({
+                "Name": "slot1_%d@%s" % (i+1, name),
+                "SlotType": "Dynamic",
+                "State": r.choice(["Claimed","Claimed","Claimed","Preempting"]),
+                "SlotWeight": 1,
+                "Cpus": 1, "TotalSlotCpus": 1, "TotalCpus": cpus,
+                "Memory": 2000, "TotalSlotMemory": 2000, "TotalMemory": memory,
+                "Disk": 20000000, "TotalSlotDisk": 20000000, "TotalDisk": disk,
+                "LoadAvg": slot_load, "TotalCondorLoadAvg": slot_load, "TotalLoadAvg": slot_load,
+                "AccountingGroup": "group_%s.%s@example.com" % (exp, user),
+                "RemoteGroup": "group_"+exp,
+                "RemoteOwner": user+"@example.com",
+            })
+        free = cpus-claimed
+        ads.append({
+            "Name": "slot1@"+name,
+            "SlotType": "Partitionable",
+            "State": "Unclaimed",
+            "SlotWeight": free,
+            "Cpus": free, "TotalSlotCpus": cpus, "TotalCpus": cpus,
+            "Memory": free*2000, "TotalSlotMemory": memory, "TotalMemory": memory,
+            "Disk": free*20000000, "TotalSlotDisk": disk, "TotalDisk": disk,
+            "LoadAvg": 0.0, "TotalCondorLoadAvg": load, "TotalLoadAvg": load,
+        })
+    for i in xrange(glideins):
+        site = r.choice(sites)
+        state = r.choice(["Claimed","Claimed","Claimed","Unclaimed"])
+        start = now-r.randint(0, 2*86400)
+        ad = {
+            "Name": "glidein_%d@%s.glidein.example.com" % (i, site.lower()),
+            "SlotType": "Static",
+            "State": state,
+            "SlotWeight": 1,
+            "is_glidein": True,
+            "GLIDEIN_Site": site,
+            "GLIDEIN_ResourceName": site+"_CE",
+            "GLIDECLIENT_group": "main",
+            "DaemonStartTime": start,
+            "GLIDEIN_ToDie": start+r.choice([86400,2*86400,3*86400]),
+            "MyCurrentTime": now,
+            "Cpus": 1, "TotalSlotCpus": 1, "TotalCpus": 1,
+            "Memory": 2500, "TotalSlotMemory": 2500, "TotalMemory": 2500,
+            "Disk": 10000000, "TotalSlotDisk": 10000000, "TotalDisk": 10000000,
+            "LoadAvg": 0.0, "TotalCondorLoadAvg": 0.0, "TotalLoadAvg": 0.0,
+        }
+        if state == "Claimed":
+            exp, user = r.choice(users)
+            ad["LoadAvg"] = ad["TotalCondorLoadAvg"] = ad["TotalLoadAvg"] = r.random()
+            ad["AccountingGroup"] = "group_%s.%s@example.com" % (exp, user)
+            ad["RemoteGroup"] = "group_"+exp
+            ad["RemoteOwner"] = user+"@example.com"
+        ads.append(ad)
+    return ads
+
+def _priorities():
+    r = random.Random(config["seed"]+2)
+    users = _users(random.Random(config["seed"]))
+    ads = []
+    for exp in sorted(set(e for e,u in users)):
+        ads.append(ClassAd(Name="group_%s@example.com" % exp, IsAccountingGroup=True,
+            ResourcesUsed=0, AccumulatedUsage=0.0, WeightedAccumulatedUsage=0.0,
+            Priority=0.0, WeightedResourcesUsed=0.0, PriorityFactor=1000.0))
+    for exp, user in users:
+        used = r.randint(0, 2000)
+        usage = r.random()*1e8
+        ads.append(ClassAd(Name="group_%s.%s@example.com" % (exp, user), IsAccountingGroup=False,
+            ResourcesUsed=used, AccumulatedUsage=usage, WeightedAccumulatedUsage=usage*1.2,
+            Priority=500.0+r.random()*1e5, WeightedResourcesUsed=float(used),
+            PriorityFactor=1000.0))
+    return ads
+
+def _daemons(daemon_type):
+    if daemon_type == DaemonTypes.Schedd:
+        return [ClassAd(Name=name, MyType="Scheduler", MachineAttrCpus0=1,
+                        TotalRunningJobs=config["jobs"]//config["schedds"]//3,
+                        TotalIdleJobs=config["jobs"]//config["schedds"]*2//3)
+                for name in _schedd_names()]
+    if daemon_type == DaemonTypes.Negotiator:
+        return [ClassAd(Name="negotiator.example.com", MyType="Negotiator", LastNegotiationCycleDuration0=42)]
+    if daemon_type == DaemonTypes.Collector:
+        return [ClassAd(Name="collector.example.com", MyType="Collector", ActiveQueryWorkers=2)]
+    return []
+
+
+## bindings
+
+class Collector(object):
+    def __init__(self, pool=None):
+        self.pool = pool
+
+    def locateAll(self, daemon_type):
+        return _daemons(daemon_type)
+
+    def locate(self, daemon_type, name=None):
+        ads = _daemons(daemon_type)
+        if len(ads) == 0:
+            raise IOError("unable to locate %s" % daemon_type)
+        return ads[0]
+
+    def query(self, ad_type=AdTypes.Startd, constraint=True, projection=None):
+        if ad_type != AdTypes.Startd:
+            return list(_filter(_daemons(ad_type), constraint, projection))
+        return list(_filter(_slots(int(time.time())), constraint, projection))
+
+class Schedd(object):
+    def __init__(self, ad=None):
+        self.name = ad["Name"]
+
+    def xquery(self, requirements=True, projection=None):
+        now = int(time.time())
+        if projection:
+            projection = list(projection)+["ServerTime"]
+        for ad in _filter(_jobs(self.name, now), requirements, projection):
+            ad["ServerTime"] = now
+            yield ad
+
+    def query(self, constraint=True, attr_list=None):
+        return list(self.xquery(constraint, attr_list))
+
+class Negotiator(object):
+    def __init__(self, ad=None):
+        pass
+
+    def getPriorities(self, rollup=False):
+        return _priorities()
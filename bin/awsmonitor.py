@@ -7,67 +7,263 @@ import datetime
 import ConfigParser
 import pprint
 
-import boto3
+try:
+    import boto3
+except ImportError:
+    # only needed to make the clients, see AwsProbe.get_clients
+    boto3 = None
 
 import fifemon
+from fifemon.workers import parallel_map
 
 logger = logging.getLogger(__name__)
 
-def get_ec2_instance_cpu(session, region,instance,end_time=None,period=300):
+# CloudWatch EC2 metric -> prefix of the metrics it is reported under, e.g.
+# CPUUtilization gives cpu_avg, cpu_min and cpu_max. Other metrics are
+# reported under their lowercased name.
+ec2_metric_names = {
+    'CPUUtilization':   'cpu',
+    'NetworkIn':        'network_in',
+    'NetworkOut':       'network_out',
+    'NetworkPacketsIn': 'network_packets_in',
+    'NetworkPacketsOut':'network_packets_out',
+    'DiskReadBytes':    'disk_read_bytes',
+    'DiskWriteBytes':   'disk_write_bytes',
+    'CPUCreditBalance': 'cpu_credit_balance',
+    'CPUCreditUsage':   'cpu_credit_usage',
+}
+
+def ec2_metric_name(metric):
+    return ec2_metric_names.get(metric, fifemon.graphite.sanitize_key(metric.lower()))
+
+def get_ec2_metrics(cloudwatch, instance_ids, metrics=('CPUUtilization',),
+        end_time=None, period=300, batch_size=500):
+    """average, minimum and maximum of each CloudWatch metric of each
+    instance, as {instance_id: {metric: {'avg':..., 'min':..., 'max':...}}},
+    fetched for all the metrics together with GetMetricData in batches of
+    up to batch_size metric queries"""
     if end_time is None:
         end_time=datetime.datetime.utcnow()
-    cw = session.client('cloudwatch',region_name=region)
-    response = cw.get_metric_statistics(
-        Namespace='AWS/EC2',
-        MetricName='CPUUtilization',
-        Dimensions=[{'Name':"InstanceId",'Value':instance}],
-        StartTime=end_time-datetime.timedelta(seconds=period*2),
-        EndTime=end_time,
-        Period=period,
-        Statistics=['Average','Minimum','Maximum'],
-        Unit='Percent')
-    datapoints=response['Datapoints']
-    r = {}
-    if len(datapoints) > 0:
-        datapoint=datapoints[-1]
-        r['avg'] = datapoint['Average']
-        r['min'] = datapoint['Minimum']
-        r['max'] = datapoint['Maximum']
-    else:
-        logging.warning('no CPU utilization received for instance %s'%instance)
+    stats = [('avg','Average'), ('min','Minimum'), ('max','Maximum')]
+    queries = []
+    for n, instance in enumerate(instance_ids):
+        for m, metric in enumerate(metrics):
+            for key, stat in stats:
+                query = {
+                    'Id': 'i%d_%d_%s' % (n, m, key),
+                    'MetricStat': {
+                        'Metric': {
+                            'Namespace': 'AWS/EC2',
+                            'MetricName': metric,
+                            'Dimensions': [{'Name':"InstanceId",'Value':instance}],
+                        },
+                        'Period': period,
+                        'Stat': stat,
+                    },
+                    'ReturnData': True,
+                }
+                if metric == 'CPUUtilization':
+                    query['MetricStat']['Unit'] = 'Percent'
+                queries.append(query)
+    r = defaultdict(lambda: defaultdict(dict))
+    for i in xrange(0, len(queries), batch_size):
+        kwargs = {
+            'MetricDataQueries': queries[i:i+batch_size],
+            'StartTime': end_time-datetime.timedelta(seconds=period*2),
+            'EndTime': end_time,
+            'ScanBy': 'TimestampDescending',
+        }
+        while True:
+            response = cloudwatch.get_metric_data(**kwargs)
+            for result in response['MetricDataResults']:
+                if len(result['Values']) == 0:
+                    continue
+                n, m, key = result['Id'][1:].split('_')
+                values = r[instance_ids[int(n)]][metrics[int(m)]]
+                # newest first; a later page only has older points
+                if key not in values:
+                    values[key] = result['Values'][0]
+            if 'NextToken' not in response:
+                break
+            kwargs['NextToken'] = response['NextToken']
+    for instance in instance_ids:
+        if instance not in r:
+            logger.warning('no CloudWatch metrics received for instance %s'%instance)
+    return r
+
+class StreamStats(object):
+    """sample count, sum, minimum and maximum of one metric over a group
+    of instances, updated as each instance comes in"""
+    __slots__ = ['samples', 'sum', 'min', 'max']
+
+    def __init__(self):
+        self.samples = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, values):
+        """add an instance's {'avg':..., 'min':..., 'max':...}"""
+        if 'avg' in values:
+            self.samples += 1
+            self.sum += values['avg']
+        if 'min' in values and (self.min is None or values['min'] < self.min):
+            self.min = values['min']
+        if 'max' in values and (self.max is None or values['max'] > self.max):
+            self.max = values['max']
+
+    def finalize(self, prefix, data):
+        if self.samples > 0:
+            data[prefix+"_avg"] = self.sum/self.samples
+        if self.min is not None:
+            data[prefix+"_min"] = self.min
+        if self.max is not None:
+            data[prefix+"_max"] = self.max
+
+class GroupStats(object):
+    """instance count and per-metric StreamStats of one group of instances"""
+    __slots__ = ['count', 'metrics']
+
+    def __init__(self):
+        self.count = 0
+        self.metrics = {}
+
+    def add(self, metrics):
+        self.count += 1
+        for metric, values in metrics.iteritems():
+            try:
+                stats = self.metrics[metric]
+            except KeyError:
+                stats = self.metrics[metric] = StreamStats()
+            stats.add(values)
+
+    def finalize(self, base_metric, data):
+        data[base_metric+".count"] = self.count
+        for metric, stats in self.metrics.iteritems():
+            stats.finalize(base_metric+"."+ec2_metric_name(metric), data)
+
+class InstanceCache(object):
+    """the group key ("region.az.group.type.key") of each instance of a
+    region, by instance id, so each cycle only has to fetch instance states.
+
+    Instances not yet cached, or whose entry is older than ttl seconds, are
+    described with paginated describe_instances calls, filtered by instance
+    id unless there are more than max_filter of them. The type and placement
+    group can only change while an instance is stopped, so ttl bounds how
+    stale they can get. Entries are evicted once expired, and the hits,
+    misses, evictions, describe calls and size of each update are kept in
+    stats."""
+
+    # instance ids per describe_instances filter
+    filter_size = 200
+
+    def __init__(self, region, ttl=3600, max_filter=1000):
+        self.region = region
+        self.ttl = ttl
+        self.max_filter = max_filter
+        self.entries = {}
+        self.stats = {}
+
+    def group_key(self, instance):
+        placement = instance['Placement']
+        if placement.get('GroupName', "") != "":
+            group = fifemon.graphite.sanitize_key(placement['GroupName'])
+        else:
+            group = "none"
+        return "{region}.{az}.{group}.{type}.{key}".format(
+                region = self.region,
+                az = fifemon.graphite.sanitize_key(placement['AvailabilityZone']),
+                group = group,
+                type = fifemon.graphite.sanitize_key(instance['InstanceType']),
+                key = fifemon.graphite.sanitize_key(instance.get('KeyName')))
+
+    def describe(self, ec2, instance_ids):
+        """cache the group keys of instance_ids, or of every instance if
+        instance_ids is None. Returns the number of describe calls made."""
+        paginator = ec2.get_paginator('describe_instances')
+        if instance_ids is None:
+            requests = [{}]
+        else:
+            requests = [{'Filters': [{'Name': 'instance-id',
+                'Values': instance_ids[i:i+self.filter_size]}]}
+                for i in xrange(0, len(instance_ids), self.filter_size)]
+        expires = time.time()+self.ttl
+        calls = 0
+        for kwargs in requests:
+            for page in paginator.paginate(**kwargs):
+                calls += 1
+                for reservation in page['Reservations']:
+                    for instance in reservation['Instances']:
+                        self.entries[instance['InstanceId']] = (self.group_key(instance), expires)
+        return calls
+
+    def update(self, ec2, instance_ids):
+        """make sure instance_ids are cached and evict expired entries"""
+        now = time.time()
+        evicted = 0
+        for instance in self.entries.keys():
+            if self.entries[instance][1] <= now:
+                del self.entries[instance]
+                evicted += 1
+        missing = [instance for instance in instance_ids if instance not in self.entries]
+        calls = 0
+        if len(missing) > self.max_filter:
+            calls = self.describe(ec2, None)
+        elif len(missing) > 0:
+            calls = self.describe(ec2, missing)
+        self.stats = {
+            'hits':           len(instance_ids)-len(missing),
+            'misses':         len(missing),
+            'evicted':        evicted,
+            'describe_calls': calls,
+            'size':           len(self.entries),
+        }
+
+    def get(self, instance):
+        entry = self.entries.get(instance)
+        if entry is None:
+            return None
+        return entry[0]
+
+def get_instance_states(ec2):
+    """[(instance_id, state)] of every instance in the region"""
+    r = []
+    paginator = ec2.get_paginator('describe_instance_status')
+    for page in paginator.paginate(IncludeAllInstances=True):
+        for status in page['InstanceStatuses']:
+            r.append((status['InstanceId'], status['InstanceState']['Name']))
     return r
 
-def get_ec2_instances(session, region):
-    r = defaultdict(int)
-    cpu = defaultdict(float)
+def get_ec2_instances(ec2, cloudwatch, cache, batch_size=500, metrics=('CPUUtilization',)):
+    r = {}
     try:
-        ec2 = session.resource('ec2',region)
-        instances = ec2.instances.all()
-        for i in instances:
-            if i.placement['GroupName'] != "":
-                group = fifemon.graphite.sanitize_key(i.placement['GroupName'])
-            else:
-                group = "none"
-            base_metric = "{region}.{az}.{group}.{type}.{key}.{state}".format(
-                    region = region,
-                    az = fifemon.graphite.sanitize_key(i.placement['AvailabilityZone']),
-                    group = group,
-                    type = fifemon.graphite.sanitize_key(i.instance_type),
-                    key = fifemon.graphite.sanitize_key(i.key_name),
-                    state = i.state['Name'])
-            r[base_metric+".count"] += 1
-            if i.state['Name'] == 'running':
-                cpu_usage = get_ec2_instance_cpu(session, region, i.instance_id)
-                count = r[base_metric+".count"]
-                if 'avg' in cpu_usage:
-                    oldavg = r[base_metric+".cpu_avg"]
-                    r[base_metric+".cpu_avg"] = (oldavg*(count-1) + cpu_usage['avg'])/count
-                if 'min' in cpu_usage:
-                    oldmin = r[base_metric+".cpu_min"]
-                    r[base_metric+".cpu_min"] = min(oldmin, cpu_usage['min'])
-                if 'max' in cpu_usage:
-                    oldmax = r[base_metric+".cpu_max"]
-                    r[base_metric+".cpu_max"] = max(oldmax,cpu_usage['max'])
+        # group every instance first, then fetch the metrics of all the
+        # running ones in as few requests as possible
+        states = get_instance_states(ec2)
+        cache.update(ec2, [instance for instance, state in states])
+        instances = []
+        for instance, state in states:
+            key = cache.get(instance)
+            if key is None:
+                # went away between the two calls
+                continue
+            instances.append((instance, state, key+"."+state))
+        running = [instance for instance, state, base_metric in instances if state == 'running']
+        try:
+            usage = get_ec2_metrics(cloudwatch, running, metrics, batch_size=batch_size)
+        except Exception as e:
+            # still count the instances
+            logger.error('error getting metrics from CloudWatch: %s'%e)
+            usage = {}
+        groups = {}
+        for instance, state, base_metric in instances:
+            try:
+                group = groups[base_metric]
+            except KeyError:
+                group = groups[base_metric] = GroupStats()
+            group.add(usage.get(instance, {}) if state == 'running' else {})
+        for base_metric, group in groups.iteritems():
+            group.finalize(base_metric, r)
     except Exception as e:
         logger.error('error communicating with AWS: %s'%e)
     return r
@@ -76,31 +272,68 @@ class AwsProbe(fifemon.Probe):
     def __init__(self, *args, **kwargs):
         self.regions = kwargs.pop('regions', ['us-west-2',])
         self.profiles = kwargs.pop('profiles', [None])
+        self.max_workers = kwargs.pop('max_workers', 8)
+        self.metric_batch_size = kwargs.pop('metric_batch_size', 500)
+        self.metrics = kwargs.pop('metrics', ['CPUUtilization'])
+        self.instance_cache_ttl = kwargs.pop('instance_cache_ttl', 3600)
+        # kept between cycles: a session per profile, and EC2 and CloudWatch
+        # clients and an InstanceCache per (profile, region)
+        self.sessions = {}
+        self.clients = {}
+        self.caches = {}
 
         super(AwsProbe, self).__init__(*args, **kwargs)
 
+    def get_clients(self, profile, region):
+        """the EC2 and CloudWatch clients for a profile and region,
+        made on first use. Sessions aren't thread-safe, so call this before
+        handing the clients to worker threads."""
+        if (profile, region) not in self.clients:
+            if boto3 is None:
+                raise ImportError("awsmonitor needs boto3")
+            if profile not in self.sessions:
+                self.sessions[profile] = boto3.session.Session(profile_name = profile)
+            session = self.sessions[profile]
+            self.clients[(profile, region)] = (session.client('ec2', region_name=region),
+                    session.client('cloudwatch', region_name=region))
+            self.caches[(profile, region)] = InstanceCache(region, self.instance_cache_ttl)
+        return self.clients[(profile, region)]
+
+    def post_region(self, profile, region):
+        ec2, cloudwatch = self.get_clients(profile, region)
+        cache = self.caches[(profile, region)]
+        data = get_ec2_instances(ec2, cloudwatch, cache, self.metric_batch_size,
+                self.metrics)
+        for k, v in cache.stats.iteritems():
+            self.meta_data.count("instance_cache."+k, v)
+        logger.info("queried AWS region {0}".format(region))
+        if len(data) == 0:
+            return
+        if self.use_graphite:
+            try:
+                self.graphite.send_dict(self.namespace+".%s"%profile, 
+                        data, send_data=(not self.test),
+                        timestamp=self.cycle_time)
+            except Exception as e:
+                logging.error("error sending data to graphite: %s"%e)
+        if self.use_influxdb:
+            tags = dict(self.influxdb_tags)
+            tags['account'] = "%s"%profile
+            try:
+                self.influxdb.send_dict(data, send_data=(not self.test),
+                        timestamp=self.cycle_time,
+                        schema="region.az.group.type.key.state.measurement",
+                        tags=tags)
+            except Exception as e:
+                logging.error("error sending data to influxdb: %s"%e)
+
     def post(self):
-        for profile in self.profiles:
-            session = boto3.session.Session(profile_name = profile)
-            for region in self.regions:
-                data = get_ec2_instances(session, region)
-                logger.info("queried AWS region {0}".format(region))
-                if len(data) == 0:
-                    continue
-                if self.use_graphite:
-                    try:
-                        self.graphite.send_dict(self.namespace+".%s"%profile, 
-                                data, send_data=(not self.test))
-                    except Exception as e:
-                        logging.error("error sending data to graphite: %s"%e)
-                if self.use_influxdb:
-                    self.influxdb_tags['account'] = "%s"%profile
-                    try:
-                        self.influxdb.send_dict(data, send_data=(not self.test),
-                                schema="region.az.group.type.key.state.measurement",
-                                tags=self.influxdb_tags)
-                    except Exception as e:
-                        logging.error("error sending data to influxdb: %s"%e)
+        targets = [(profile, region) for profile in self.profiles for region in self.regions]
+        for profile, region in targets:
+            self.get_clients(profile, region)
+        # each region is queried on its own thread, with its own clients
+        parallel_map(lambda target: self.post_region(*target), targets,
+                max_workers=self.max_workers, name=lambda target: "%s-%s" % target)
 
 
 def get_options():
@@ -124,9 +357,18 @@ def get_options():
             r[k] = v
         return r
 
+    def get_optional(section, option, default, get=config.get):
+        if config.has_option(section, option):
+            return get(section, option)
+        return default
+
     opts = {
         'regions':           config.get("AWS", "regions").split(","),
         'profiles':          config.get("AWS", "profiles").split(","),
+        'max_workers':       get_optional("AWS", "max_workers", 8, config.getint),
+        'metric_batch_size': get_optional("AWS", "metric_batch_size", 500, config.getint),
+        'instance_cache_ttl': get_optional("AWS", "instance_cache_ttl", 3600, config.getint),
+        'metrics':           [m.strip() for m in get_optional("AWS", "metrics", "CPUUtilization").split(",")],
         'namespace':         config.get("graphite", "namespace"),
         'meta_namespace':    config.get("graphite", "meta_namespace"),
         'use_graphite':      config.getboolean("graphite", "enable"),
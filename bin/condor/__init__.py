@@ -1,7 +1,9 @@
 import os
 os.environ['_CONDOR_GSI_SKIP_HOST_CHECK'] = "true"
 
+from .pool import PoolContext
+from .metrics import MetricKeys, MetricValues
 from .status import get_pool_status
-from .slots import get_pool_slots, get_pool_glidein_slots
-from .priorities import get_pool_priorities
+from .slots import get_pool_slots, get_pool_glidein_slots, get_pool_startd_metrics
+from .priorities import get_pool_priorities, PriorityHistory
 from .jobs import Jobs
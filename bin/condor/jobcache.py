@@ -0,0 +1,107 @@
+#!/usr/bin/python
+import logging
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+
+def job_id(job_classad):
+    return "{0}.{1}".format(job_classad["ClusterId"], job_classad["ProcId"])
+
+
+class ScheddJobCache(object):
+    """
+    Per-job contributions to one schedd's job counters, kept between
+    cycles so only changed jobs need to be fetched and re-aggregated.
+    Jobs are kept as compact JobRecords rather than whole ads.
+
+    Each job's contribution is the list of (counter, experiment, user)
+    groups it counts in, the (suffix, value) sums it adds to each, and the
+    ServerTime at which those sums go stale even if the ad doesn't change
+    (e.g. its age moves into the next bin). Group totals are kept as
+    [contributors, sum] so a suffix disappears, as it would from a full
+    aggregation, once its last contributor is removed.
+    """
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.records = {}
+        self.contributions = {}
+        self.groups = defaultdict(dict)
+        self.last_poll = None
+        self.polls = 0
+
+    def __len__(self):
+        return len(self.records)
+
+    def _apply(self, keys, sums, sign):
+        for key in keys:
+            group = self.groups[key]
+            for suffix, value in sums:
+                total = group.get(suffix)
+                if total is None:
+                    total = group[suffix] = [0, 0]
+                total[0] += sign
+                total[1] += sign*value
+                if total[0] == 0:
+                    del group[suffix]
+            if len(group) == 0:
+                del self.groups[key]
+
+    def add(self, jobid, job):
+        """add or replace a job record"""
+        if jobid in self.records:
+            self.remove(jobid)
+        keys, sums = self.jobs.job_contribution(job)
+        expires = self.jobs.job_expiry(job)
+        self.records[jobid] = job
+        self.contributions[jobid] = (keys, sums, expires)
+        self._apply(keys, sums, 1)
+
+    def remove(self, jobid):
+        keys, sums, expires = self.contributions.pop(jobid)
+        del self.records[jobid]
+        self._apply(keys, sums, -1)
+
+    def prune(self, current_ids):
+        """remove cached jobs that are no longer in the queue. Returns the
+        number removed."""
+        removed = [jobid for jobid in self.records if jobid not in current_ids]
+        for jobid in removed:
+            self.remove(jobid)
+        return len(removed)
+
+    def refresh(self, server_time, skip=()):
+        """re-aggregate unchanged jobs whose contribution has gone stale by
+        server_time. Returns the number refreshed."""
+        stale = [jobid for jobid, (keys, sums, expires) in self.contributions.iteritems()
+                 if expires is not None and expires <= server_time and jobid not in skip]
+        for jobid in stale:
+            job = self.records[jobid]
+            job.server_time = server_time
+            self.add(jobid, job)
+        return len(stale)
+
+    def get_groups(self):
+        """group sums, in the same form as Jobs.aggregate()"""
+        groups = {}
+        for key, group in self.groups.iteritems():
+            groups[key] = dict((suffix, total[1]) for suffix, total in group.iteritems())
+        return groups
+
+
+def compare_groups(a, b, tolerance=1e-6):
+    """return the (group, suffix) keys whose sums differ between a and b"""
+    mismatches = []
+    for key in set(a.keys()) | set(b.keys()):
+        ga = a.get(key, {})
+        gb = b.get(key, {})
+        for suffix in set(ga.keys()) | set(gb.keys()):
+            if suffix not in ga or suffix not in gb:
+                mismatches.append((key, suffix))
+                continue
+            va = ga[suffix]
+            vb = gb[suffix]
+            if abs(va-vb) > tolerance*max(1, abs(va), abs(vb)):
+                mismatches.append((key, suffix))
+    return mismatches
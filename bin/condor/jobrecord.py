@@ -0,0 +1,86 @@
+#!/usr/bin/python
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def intern_str(value):
+    """
+    Returns value as an interned str, so the many jobs with the same owner,
+    experiment or site share one copy.
+    """
+    if value is None:
+        return None
+    if type(value) is not str:
+        value = str(value)
+    return intern(value)
+
+
+# accounting group -> interned experiment name
+experiments = {}
+
+def experiment(accounting_group):
+    """
+    Returns the experiment for an accounting group, e.g. "nova" for
+    "group_nova.someuser".
+    """
+    try:
+        return experiments[accounting_group]
+    except KeyError:
+        exp = experiments[accounting_group] = intern_str(accounting_group.split(".")[0][6:])
+        return exp
+
+
+class JobRecord(object):
+    """
+    The parts of a job ad that the job counters use, read out of the ad
+    once. Much smaller than the ad, and plain attribute access instead of
+    ClassAd lookups for every counter and sum.
+
+    Attributes missing from the ad are None, except owner and experiment,
+    which get the same defaults the counters always used. Desired usage
+    models and sites are only read for idle jobs, and the site and resource
+    requests and usage only for running jobs.
+    """
+    __slots__ = ["status", "universe", "exp", "user",
+                 "usage_model", "desired_sites", "site",
+                 "server_time", "qdate", "entered", "start",
+                 "cputime", "request_cpus", "request_memory", "rss",
+                 "request_disk", "disk_usage"]
+
+    def __init__(self, job_classad):
+        get = job_classad.get
+        self.status = status = job_classad["JobStatus"]
+        self.universe = job_classad["JobUniverse"]
+        self.exp = experiment(get("AccountingGroup","group_none"))
+        self.user = intern_str(get("Owner","unknown"))
+        self.server_time = get("ServerTime",0)
+        self.qdate = get("QDate")
+        self.entered = get("EnteredCurrentStatus")
+        self.start = get("JobCurrentStartDate")
+        self.cputime = get("RemoteUserCpu",0)
+        self.request_cpus = job_classad.eval("RequestCpus") if "RequestCpus" in job_classad else None
+        # the rest only matter for idle or running jobs
+        self.usage_model = None
+        self.desired_sites = None
+        self.site = None
+        self.request_memory = None
+        self.rss = None
+        self.request_disk = None
+        self.disk_usage = None
+        if status == 1:
+            self.usage_model = intern_str(get("DESIRED_usage_model"))
+            self.desired_sites = intern_str(get("DESIRED_Sites"))
+        elif status == 2:
+            site = get("MATCH_GLIDEIN_Site")
+            if site == "FNAL" and "MATCH_EXP_JOBGLIDEIN_ResourceName" in job_classad:
+                site = job_classad["MATCH_EXP_JOBGLIDEIN_ResourceName"]
+            self.site = intern_str(site)
+            if "RequestMemory" in job_classad:
+                self.request_memory = job_classad.eval("RequestMemory")
+            if "ResidentSetSize_RAW" in job_classad:
+                self.rss = job_classad.eval("ResidentSetSize_RAW")
+            if "RequestDisk" in job_classad:
+                self.request_disk = job_classad.eval("RequestDisk")
+            if "DiskUsage_RAW" in job_classad:
+                self.disk_usage = job_classad.eval("DiskUsage_RAW")
@@ -1,4 +1,5 @@
 #!/usr/bin/python
+import threading
 import time
 from collections import defaultdict
 import logging
@@ -6,8 +7,26 @@ import logging
 import classad
 import htcondor
 
+from fifemon.workers import parallel_map
+from fifemon.memory import peak_rss
+from .metrics import DerivedMetrics, MetricKeys, MetricValues
+from .jobcache import ScheddJobCache, job_id, compare_groups
+from .jobrecord import JobRecord
+from .pool import PoolContext
+
 logger = logging.getLogger(__name__)
 
+derived_metrics = DerivedMetrics()
+derived_metrics.register(".efficiency",
+        lambda cputime, walltime: max(min(cputime/walltime*100,100),0),
+        [".cputime", ".walltime"])
+derived_metrics.register(".wastetime",
+        lambda walltime, cputime: walltime-cputime,
+        [".walltime", ".cputime"])
+derived_metrics.register(".wastetime_avg",
+        lambda wastetime, count: wastetime/count if count > 0 else None,
+        [".wastetime", ".count"])
+
 
 def find_bin(value, bins):
     for b in bins:
@@ -17,9 +36,42 @@ def find_bin(value, bins):
 
 
 class Jobs(object):
-    def __init__(self, pool="localhost"):
+    projection = ["ClusterId","ProcId","Owner",
+                  "MATCH_GLIDEIN_Site","MATCH_EXP_JOBGLIDEIN_ResourceName",
+                  "AccountingGroup","JobStatus",
+                  "DESIRED_usage_model","DESIRED_Sites","JobUniverse",
+                  "QDate","ServerTime","JobCurrentStartDate","RemoteUserCpu",
+                  "EnteredCurrentStatus","NumRestarts",
+                  "RequestMemory","ResidentSetSize_RAW",
+                  "RequestDisk","DiskUsage_RAW","RequestCpus"]
+
+    def __init__(self, pool="localhost", max_workers=8, schedd_timeout=None,
+            incremental=False, full_resync_interval=12, verify_incremental=False,
+            change_markers=None):
         self.pool = pool
-        self.collector = htcondor.Collector(pool)
+        self.max_workers = max_workers
+        self.schedd_timeout = schedd_timeout
+        self.incremental = incremental
+        self.full_resync_interval = full_resync_interval
+        self.verify_incremental = verify_incremental
+        if change_markers is None:
+            change_markers = ["EnteredCurrentStatus"]
+        self.change_markers = change_markers
+        self.caches = {}
+        # schedds whose query is still running, e.g. abandoned by an earlier
+        # cycle after schedd_timeout, so they aren't queried (and their
+        # cache updated) twice at once
+        self.in_flight = set()
+        self.in_flight_lock = threading.Lock()
+        # counters only depend on a few interned fields, so share one list
+        # between all the jobs with the same ones
+        self.idle_counters = {}
+        self.running_counters = {}
+        # ids of the metric paths each (counter, experiment, user, schedd)
+        # adds to, kept between cycles
+        self.metric_keys = MetricKeys()
+        self.metric_ids = {}
+        self.collector = PoolContext(pool)
         self.bins=[(300,       'recent'),
                    (3600,      'one_hour'),
                    (3600*4,    'four_hours'),
@@ -28,156 +80,362 @@ class Jobs(object):
                    (3600*24*2, 'two_days'),
                    (3600*24*7, 'one_week')]
 
-    def job_metrics(self, job_classad, schedd_name):
+    def job_counters(self, job):
         """
-        Returns a list of base metrics for the given job.
+        Returns the experiment, user and list of counters for the given job
+        record.
         """
-        counters = []
-
-        exp_name = job_classad.get("AccountingGroup","group_none").split(".")[0][6:]
-        user_name = job_classad.get("Owner","unknown")
-
-        if job_classad["JobUniverse"] == 7:
+        if job.universe == 7:
             counters = [".dag.totals"]
-        elif job_classad["JobStatus"] == 1:
-            counters = [".idle.totals"]
-            if "DESIRED_usage_model" in job_classad:
-                models = set(job_classad["DESIRED_usage_model"].split(","))
-                if "DESIRED_Sites" in job_classad:
-                    sites = job_classad["DESIRED_Sites"].split(",")
-                    for s in sites:
-                        counters.append(".idle.sites."+s)
-                    if "Fermigrid" not in sites:
-                        models.discard("DEDICATED")
-                        models.discard("OPPORTUNISTIC")
-                models_sorted = list(models)
-                if len(models_sorted) == 0:
-                    models_sorted = ["impossible"]
-                else:
-                    models_sorted.sort()
-                counters.append(".idle.usage_models." + "_".join(models_sorted))
-            else:
-                counters.append(".idle.usage_models.unknown")
-        elif job_classad["JobStatus"] == 2:
-            counters = [".running.totals"]
-            if "MATCH_GLIDEIN_Site" in job_classad:
-                site = job_classad["MATCH_GLIDEIN_Site"]
-                if site == "FNAL" and "MATCH_EXP_JOBGLIDEIN_ResourceName" in job_classad:
-                    site = job_classad["MATCH_EXP_JOBGLIDEIN_ResourceName"]
-                counters.append(".running.sites." + site)
-            else:
-                counters.append(".running.sites.unknown")
-        elif job_classad["JobStatus"] == 5:
+        elif job.status == 1:
+            key = (job.usage_model, job.desired_sites)
+            counters = self.idle_counters.get(key)
+            if counters is None:
+                counters = self.idle_counters[key] = self.compute_idle_counters(job)
+        elif job.status == 2:
+            counters = self.running_counters.get(job.site)
+            if counters is None:
+                counters = self.running_counters[job.site] = [".running.totals",
+                        ".running.sites."+(job.site if job.site is not None else "unknown")]
+        elif job.status == 5:
             counters = [".held.totals"]
         else:
             counters = [".unknown.totals"]
 
+        return job.exp, job.user, counters
+
+    def compute_idle_counters(self, job):
+        """
+        Returns the counters for an idle job, which only depend on its
+        desired usage models and sites.
+        """
+        counters = [".idle.totals"]
+        if job.usage_model is not None:
+            models = set(job.usage_model.split(","))
+            if job.desired_sites is not None:
+                sites = job.desired_sites.split(",")
+                for s in sites:
+                    counters.append(".idle.sites."+s)
+                if "Fermigrid" not in sites:
+                    models.discard("DEDICATED")
+                    models.discard("OPPORTUNISTIC")
+            models_sorted = list(models)
+            if len(models_sorted) == 0:
+                models_sorted = ["impossible"]
+            else:
+                models_sorted.sort()
+            counters.append(".idle.usage_models." + "_".join(models_sorted))
+        else:
+            counters.append(".idle.usage_models.unknown")
+        return counters
+
+    def metric_parts(self, counter, exp_name, user_name, schedd_name):
+        """
+        Returns the parts of every metric path that a counter contributes
+        to.
+        """
+        c = tuple(counter[1:].split("."))
+        return [("totals",)+c,
+                ("experiments",exp_name,"totals")+c,
+                ("experiments",exp_name,"users",user_name)+c,
+                ("users",user_name)+c,
+                ("schedds",schedd_name,"totals")+c,
+                ("schedds",schedd_name,"experiments",exp_name,"totals")+c,
+                ("schedds",schedd_name,"experiments",exp_name,"users",user_name)+c]
+
+    def metric_paths(self, counter, exp_name, user_name, schedd_name):
+        """
+        Returns every metric path that a counter contributes to.
+        """
+        return [".".join(parts) for parts in self.metric_parts(counter, exp_name, user_name, schedd_name)]
+
+    def get_metric_ids(self, counter, exp_name, user_name, schedd_name):
+        """
+        Returns the MetricKeys ids of every metric path that a counter
+        contributes to.
+        """
+        key = (counter, exp_name, user_name, schedd_name)
+        ids = self.metric_ids.get(key)
+        if ids is None:
+            ids = self.metric_ids[key] = [self.metric_keys.id(parts)
+                    for parts in self.metric_parts(counter, exp_name, user_name, schedd_name)]
+        return ids
+
+    def job_metrics(self, job, schedd_name):
+        """
+        Returns a list of base metrics for the given job record.
+        """
+        exp_name, user_name, counters = self.job_counters(job)
         metrics = []
         for counter in counters:
-            metrics.append("totals"+counter)
-            metrics.append("experiments."+exp_name+".totals"+counter)
-            metrics.append("experiments."+exp_name+".users."+user_name+counter)
-            metrics.append("users."+user_name+counter)
-            metrics.append("schedds."+schedd_name+".totals"+counter)
-            metrics.append("schedds."+schedd_name+".experiments."+exp_name+".totals"+counter)
-            metrics.append("schedds."+schedd_name+".experiments."+exp_name+".users."+user_name+counter)
+            metrics.extend(self.metric_paths(counter, exp_name, user_name, schedd_name))
         return metrics
 
-    def job_walltime(self, job_classad):
-        now = job_classad.get("ServerTime",0)
-        start = job_classad.get("JobCurrentStartDate",now)
-        return (now-start)*job_classad.get("RequestCpus",1)
+    def job_sums(self, job):
+        """
+        Returns the (suffix, value) pairs that the given job adds to each
+        of its metrics.
+        """
+        sums = [(".count", 1)]
+
+        bin = self.job_bin(job)
+        if bin is not None:
+            sums.append((bin, 1))
+
+        walltime = self.job_walltime(job)
+        cputime = self.job_cputime(job)
+        if walltime > 0 and cputime > 0:
+            sums.append((".walltime", walltime))
+            sums.append((".cputime", cputime))
+
+        if job.status == 2:
+            if job.request_cpus is not None:
+                sums.append((".cpu_request", job.request_cpus))
+            if job.request_memory is not None:
+                sums.append((".memory_request_b", job.request_memory*1024*1024))
+            if job.rss is not None:
+                sums.append((".memory_usage_b", job.rss*1024))
+            if job.request_disk is not None:
+                sums.append((".disk_request_b", job.request_disk*1024))
+            if job.disk_usage is not None:
+                sums.append((".disk_usage_b", job.disk_usage*1024))
+        return sums
 
-    def job_cputime(self, job_classad):
-        return job_classad.get("RemoteUserCpu",0)
-    
-    def job_bin(self, job_classad):
+    def job_walltime(self, job):
+        if job.start is None:
+            return 0
+        return (job.server_time-job.start)*(job.request_cpus if job.request_cpus is not None else 1)
+
+    def job_cputime(self, job):
+        return job.cputime
+
+    def job_bin(self, job):
         bin = None
-        if job_classad["JobStatus"] == 1:
-            if "QDate" in job_classad:
-                qage = job_classad["ServerTime"]-job_classad["QDate"]
-                bin = ".count_"+find_bin(qage, self.bins)
+        if job.status == 1:
+            if job.qdate is not None:
+                bin = ".count_"+find_bin(job.server_time-job.qdate, self.bins)
             else:
                 bin = ".count_unknown"
-        elif job_classad["JobStatus"] == 2:
-            walltime = self.job_walltime(job_classad)
+        elif job.status == 2:
+            walltime = self.job_walltime(job)
             if walltime > 0:
                 bin = ".count_"+find_bin(walltime, self.bins)
             else:
                 bin = ".count_unknown"
-        elif job_classad["JobStatus"] == 5:
-            if "EnteredCurrentStatus" in job_classad:
-                holdage = job_classad["ServerTime"]-job_classad["EnteredCurrentStatus"]
-                bin = ".count_holdage_"+find_bin(holdage, self.bins)
+        elif job.status == 5:
+            if job.entered is not None:
+                bin = ".count_holdage_"+find_bin(job.server_time-job.entered, self.bins)
             else:
                 bin = ".count_holdage_unknown"
         return bin
 
-    def get_job_count(self, retry_delay=30, max_retries=4):
+    def next_bin_edge(self, start, now, scale=1):
+        """
+        Returns the time after which an age of (now-start)*scale moves
+        into the next bin, or None if it is already in the last one.
+        """
+        age = (now-start)*scale
+        for b in self.bins:
+            if age < b[0]:
+                return start+float(b[0])/scale
+        return None
+
+    def job_expiry(self, job):
+        """
+        Returns the ServerTime at which the job's contribution changes even
+        if its ad doesn't, or None if it never does.
+        """
+        now = job.server_time
+        if job.status == 2 or (self.job_walltime(job) > 0 and self.job_cputime(job) > 0):
+            # walltime grows every cycle, also for jobs that ran before
+            return now
+        if job.status == 1:
+            if job.qdate is not None:
+                return self.next_bin_edge(job.qdate, now)
+        elif job.status == 5:
+            if job.entered is not None:
+                return self.next_bin_edge(job.entered, now)
+        return None
+
+    def job_contribution(self, job):
+        """
+        Returns the (counter, experiment, user) groups the job counts in,
+        and the (suffix, value) sums it adds to each.
+        """
+        exp_name, user_name, counters = self.job_counters(job)
+        keys = [(counter, exp_name, user_name) for counter in counters]
+        return keys, self.job_sums(job)
+
+    def aggregate(self, ads):
+        """
+        Sums each job ad once into its (counter, experiment, user) group.
+        Returns the groups and the number of ads.
+        """
+        groups = defaultdict(lambda: defaultdict(int))
+        n = 0
+        for r in ads:
+            n += 1
+            keys, sums = self.job_contribution(JobRecord(r))
+            for key in keys:
+                group = groups[key]
+                for suffix, value in sums:
+                    group[suffix] += value
+        return groups, n
+
+    def update_cache(self, schedd, schedd_name, stats=None):
+        """
+        Brings the schedd's job cache up to date, fetching only running
+        jobs and jobs whose change markers are newer than the last poll,
+        plus the ids of every job to find the ones that left the queue.
+        Every full_resync_interval polls the cache is rebuilt from a full
+        query instead. Returns the groups and the number of ads fetched.
+        """
+        metric = "jobs.schedds."+schedd_name
+        cache = self.caches.get(schedd_name)
+        if cache is None or cache.polls >= self.full_resync_interval:
+            cache = ScheddJobCache(self)
+            cache.last_poll = int(time.time())
+            n = 0
+            for r in schedd.xquery(True, self.projection):
+                n += 1
+                cache.add(job_id(r), JobRecord(r))
+                cache.last_poll = r.get("ServerTime", cache.last_poll)
+            self.caches[schedd_name] = cache
+            if stats is not None:
+                stats[metric+".full_resync"] = 1
+            return cache.get_groups(), n
+
+        current_ids = set()
+        server_time = cache.last_poll
+        for r in schedd.xquery(True, ["ClusterId","ProcId","ServerTime"]):
+            current_ids.add(job_id(r))
+            server_time = max(server_time, r.get("ServerTime",server_time))
+        removed = cache.prune(current_ids)
+
+        constraint = " || ".join(["JobStatus == 2"] +
+                ["{0} >= {1}".format(m, cache.last_poll) for m in self.change_markers])
+        n = 0
+        changed = set()
+        for r in schedd.xquery(constraint, self.projection):
+            n += 1
+            jobid = job_id(r)
+            changed.add(jobid)
+            cache.add(jobid, JobRecord(r))
+        refreshed = cache.refresh(server_time, skip=changed)
+        cache.last_poll = server_time
+        cache.polls += 1
+        if stats is not None:
+            stats[metric+".full_resync"] = 0
+            stats[metric+".jobs_removed"] = removed
+            stats[metric+".jobs_changed"] = n
+            stats[metric+".jobs_refreshed"] = refreshed
+        groups = cache.get_groups()
+
+        if self.verify_incremental:
+            full_groups, full_n = self.aggregate(schedd.xquery(True, self.projection))
+            mismatches = compare_groups(groups, full_groups)
+            if len(mismatches) > 0:
+                # jobs can also change between the two queries, so a few
+                # mismatches on a busy schedd are expected
+                logger.warning("incremental job counts for schedd {0} differ from full query in {1} sums, e.g. {2}".format(
+                    schedd_name, len(mismatches), mismatches[:5]))
+            if stats is not None:
+                stats[metric+".verify_mismatches"] = len(mismatches)
+        return groups, n
+
+    def get_schedd_count(self, schedd_ad, retry_delay=30, max_retries=4, stats=None):
+        """
+        Returns the job counters for a single schedd, or None if the schedd
+        could not be queried or is still being queried from an earlier call.
+        """
+        schedd_name = schedd_ad["Name"].replace(".","_").replace("@","-")
+        with self.in_flight_lock:
+            if schedd_name in self.in_flight:
+                logger.warning("schedd {0} is still being queried from an earlier cycle, skipping it".format(schedd_ad["Name"]))
+                if stats is not None:
+                    stats["jobs.schedds."+schedd_name+".in_flight"] = 1
+                return None
+            self.in_flight.add(schedd_name)
+        try:
+            return self.query_schedd_count(schedd_ad, schedd_name, retry_delay, max_retries, stats)
+        finally:
+            with self.in_flight_lock:
+                self.in_flight.discard(schedd_name)
+
+    def query_schedd_count(self, schedd_ad, schedd_name, retry_delay=30, max_retries=4, stats=None):
+        start = time.time()
+        retries=0
+        groups=None
+        while retries < max_retries:
+            try:
+                schedd = htcondor.Schedd(schedd_ad)
+                if self.incremental:
+                    groups, n = self.update_cache(schedd, schedd_name, stats)
+                else:
+                    constraint = True
+                    ads = schedd.xquery(constraint, self.projection)
+                    # aggregate ads as they stream in instead of holding the
+                    # whole queue; a failure part way through discards the
+                    # partial sums and starts over
+                    groups, n = self.aggregate(ads)
+            except:
+                logging.warning("Trouble communicating with schedd {0}, retrying in {1}s.".format(schedd_ad['Name'],retry_delay))
+                retries += 1
+                if stats is not None:
+                    stats.count("jobs.schedds."+schedd_name+".retries")
+                groups = None
+                time.sleep(retry_delay)
+                continue
+            else:
+                break
+
+        if groups is None:
+            logging.error("Trouble communicating with schedd {0}, giving up.".format(schedd_ad['Name']))
+            return None
+
+        if stats is not None:
+            metric = "jobs.schedds."+schedd_name
+            stats.count("jobs.ads", n)
+            stats[metric+".ads"] = n
+            stats[metric+".query_time"] = time.time()-start
+            # process-wide high-water mark since the cycle started, other
+            # schedds and stages may be running at the same time
+            stats[metric+".peak_rss_b"] = peak_rss()
+
+        # add every distinct group to its metric paths, by id
+        counts = MetricValues(self.metric_keys)
+        for (counter, exp_name, user_name), group in groups.iteritems():
+            for i in self.get_metric_ids(counter, exp_name, user_name, schedd_name):
+                counts.add_sums(i, group)
+        return counts
+
+    def get_job_count(self, retry_delay=30, max_retries=4, stats=None, context=None):
+        coll = context if context is not None else self.collector
+        if context is None:
+            # no shared context, so this is a new cycle
+            coll.reset(stats)
         try:
-            ads = self.collector.locateAll(htcondor.DaemonTypes.Schedd)
+            ads = coll.locateAll(htcondor.DaemonTypes.Schedd)
         except:
             logging.error("Trouble getting pool {0} schedds.".format(self.pool))
             return None
 
-        counts = defaultdict(int)
-        for a in ads:
-            retries=0
-            while retries < max_retries:
-                try:
-                    schedd = htcondor.Schedd(a)
-                    constraint = True
-                    results = schedd.query(constraint, ["ClusterId","ProcId","Owner",
-                        "MATCH_GLIDEIN_Site","MATCH_EXP_JOBGLIDEIN_ResourceName",
-                        "AccountingGroup","JobStatus",
-                        "DESIRED_usage_model","DESIRED_Sites","JobUniverse",
-                        "QDate","ServerTime","JobCurrentStartDate","RemoteUserCpu",
-                        "EnteredCurrentStatus","NumRestarts",
-                        "RequestMemory","ResidentSetSize_RAW",
-                        "RequestDisk","DiskUsage_RAW","RequestCpus"])
-                except:
-                    logging.warning("Trouble communicating with schedd {0}, retrying in {1}s.".format(a['Name'],retry_delay))
-                    retries += 1
-                    results = None
-                    time.sleep(retry_delay)
-                    continue
-                else:
-                    break
+        # query schedds concurrently, so a slow schedd only holds up its own worker
+        results = parallel_map(lambda a: self.get_schedd_count(a, retry_delay, max_retries, stats),
+                ads, max_workers=self.max_workers, timeout=self.schedd_timeout,
+                name=lambda a: a["Name"])
 
-            if results is None:
-                logging.error("Trouble communicating with schedd {0}, giving up.".format(a['Name']))
+        counts = MetricValues(self.metric_keys)
+        for a, schedd_counts in results:
+            if schedd_counts is None:
                 continue
+            for i, sums in schedd_counts.iterids():
+                counts.add_sums(i, sums)
+        if stats is not None:
+            stats["jobs.peak_rss_b"] = peak_rss()
 
-            schedd_name = a["Name"].replace(".","_").replace("@","-")
-            for r in results:
-                metrics = self.job_metrics(r,schedd_name)
-                for m in metrics:
-                    counts[m+".count"] += 1
-
-                    bin = self.job_bin(r)
-                    if bin is not None:
-                        counts[m+bin] += 1
-
-                    walltime = self.job_walltime(r)
-                    cputime = self.job_cputime(r)
-                    if walltime > 0 and cputime > 0:
-                        counts[m+".walltime"] += walltime
-                        counts[m+".cputime"] += cputime
-                        counts[m+".efficiency"] = max(min(counts[m+".cputime"]/counts[m+".walltime"]*100,100),0)
-                        counts[m+".wastetime"] = counts[m+".walltime"]-counts[m+".cputime"]
-                        if counts[m+".count"] > 0:
-                            counts[m+".wastetime_avg"] = counts[m+".wastetime"]/counts[m+".count"]
-
-                    if r["JobStatus"] == 2:
-                        if "RequestCpus" in r:
-                            counts[m+".cpu_request"] += r.eval("RequestCpus")
-                        if "RequestMemory" in r:
-                            counts[m+".memory_request_b"] += r.eval("RequestMemory")*1024*1024
-                        if "ResidentSetSize_RAW" in r:
-                            counts[m+".memory_usage_b"] += r.eval("ResidentSetSize_RAW")*1024
-                        if "RequestDisk" in r:
-                            counts[m+".disk_request_b"] += r.eval("RequestDisk")*1024
-                        if "DiskUsage_RAW" in r:
-                            counts[m+".disk_usage_b"] += r.eval("DiskUsage_RAW")*1024
-
+        # ratios don't add across schedds, so derive them from the merged sums
+        derived_metrics.finalize(counts)
+        if self.metric_keys.trim(sum(1 for i, sums in counts.iterids())):
+            self.metric_ids = {}
         return counts
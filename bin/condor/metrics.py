@@ -0,0 +1,198 @@
+#!/usr/bin/python
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class DerivedMetrics(object):
+    """
+    Registry of metrics computed from already-aggregated sums, e.g. ratios
+    and averages that can't simply be added up job-by-job or slot-by-slot.
+
+    Aggregation loops only accumulate additive sums; finalize() then adds
+    the derived metrics once per metric path.
+    """
+
+    def __init__(self):
+        self.derived = []
+
+    def register(self, suffix, func, requires):
+        """
+        Derive metric path+suffix as func(*[values[path+r] for r in requires])
+        for every path that has all the required suffixes. func may return
+        None to skip a path. Metrics are derived in registration order, so
+        a derived metric can require an earlier one.
+        """
+        self.derived.append((suffix, func, requires))
+
+    def finalize(self, values):
+        """
+        Adds the derived metrics to MetricValues, once per path.
+        """
+        for i, group in values.iterids():
+            for suffix, func, requires in self.derived:
+                if not all(r in group for r in requires):
+                    continue
+                value = func(*[group[r] for r in requires])
+                if value is not None:
+                    group[suffix] = value
+        return values
+
+
+class MetricKeys(object):
+    """
+    Registry of metric paths. A path is a tuple of parts, e.g.
+    ("schedds", "schedd1", "experiments", "nova", "totals", "idle",
+    "totals"), and gets a small int id the first time it is seen, so
+    aggregation loops index arrays by id instead of building and hashing
+    dotted strings for every job or slot. Dotted names are only rendered
+    when the metrics are sent, and InfluxDB can take its tags straight from
+    the parts.
+
+    Keep one registry for as long as the paths it holds keep coming up, so
+    later cycles reuse the ids; trim() starts over once most of them have
+    gone stale. It can be shared between threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def __len__(self):
+        return len(self.parts)
+
+    def clear(self):
+        # replaced rather than emptied, so MetricValues from before still
+        # render with the paths they were counted under
+        self.ids = {}
+        self.parts = []
+
+    def id(self, parts):
+        """
+        Returns the id of the path with the given parts, adding it if it is
+        new.
+        """
+        i = self.ids.get(parts)
+        if i is None:
+            with self.lock:
+                i = self.ids.get(parts)
+                if i is None:
+                    i = self.ids[parts] = len(self.parts)
+                    self.parts.append(parts)
+        return i
+
+    def trim(self, used):
+        """
+        Starts over if fewer than half of the paths were used in the last
+        cycle, e.g. after many users have left the pool. Returns True if it
+        did.
+        """
+        if len(self.parts) <= 2*used+1000:
+            return False
+        logger.info("dropping {0} metric paths, {1} in use".format(len(self.parts), used))
+        with self.lock:
+            self.clear()
+        return True
+
+
+class MetricValues(object):
+    """
+    Metric values by path id and suffix, e.g. ".count", in an array of
+    {suffix: value} indexed by MetricKeys id. Reads like a dict of dotted
+    metric names, rendering the names as it is iterated, so it can be sent
+    as is, or copied with dict().
+    """
+
+    def __init__(self, registry):
+        self.registry = registry
+        # the registry's current ids and parts, which trim() replaces
+        # rather than empties, so names still render and look up the same
+        # after it starts over
+        self.ids = registry.ids
+        self.parts = registry.parts
+        self.groups = []
+
+    def group(self, i):
+        """
+        Returns the {suffix: value} dict of path id i, adding it if needed.
+        """
+        try:
+            group = self.groups[i]
+        except IndexError:
+            # ids are handed out in order, so most new ones are at the end
+            # of the registry; make room for all of them at once
+            self.groups.extend([None]*(max(i+1, len(self.parts))-len(self.groups)))
+            group = None
+        if group is None:
+            group = self.groups[i] = {}
+        return group
+
+    def add(self, i, suffix, value):
+        group = self.group(i)
+        group[suffix] = group.get(suffix, 0)+value
+
+    def add_sums(self, i, sums):
+        """
+        Adds a {suffix: value} dict of sums to path id i.
+        """
+        group = self.group(i)
+        for suffix, value in sums.iteritems():
+            group[suffix] = group.get(suffix, 0)+value
+
+    def add_key(self, parts, suffix, value):
+        self.add(self.registry.id(parts), suffix, value)
+
+    def set_key(self, parts, suffix, value):
+        self.group(self.registry.id(parts))[suffix] = value
+
+    def __len__(self):
+        return sum(len(group) for group in self.groups if group is not None)
+
+    def iterids(self):
+        for i, group in enumerate(self.groups):
+            if group is not None:
+                yield i, group
+
+    def iterparts(self):
+        parts = self.parts
+        for i, group in self.iterids():
+            for suffix, value in group.iteritems():
+                yield parts[i]+(suffix[1:],), value
+
+    def iteritems(self):
+        parts = self.parts
+        for i, group in self.iterids():
+            path = ".".join(parts[i])
+            for suffix, value in group.iteritems():
+                yield path+suffix, value
+
+    def items(self):
+        return list(self.iteritems())
+
+    def keys(self):
+        return [name for name, value in self.iteritems()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __getitem__(self, name):
+        path, suffix = name.rsplit(".", 1)
+        i = self.ids.get(tuple(path.split(".")))
+        if i is not None and i < len(self.groups) and self.groups[i] is not None:
+            group = self.groups[i]
+            if "."+suffix in group:
+                return group["."+suffix]
+        raise KeyError(name)
+
+    def __contains__(self, name):
+        try:
+            self[name]
+        except KeyError:
+            return False
+        return True
+
+    def __reduce__(self):
+        # e.g. when a queued send is spooled; the registry isn't needed
+        # once the names are rendered
+        return (dict, (self.items(),))
@@ -0,0 +1,66 @@
+#!/usr/bin/python
+import logging
+import threading
+
+import htcondor
+
+logger = logging.getLogger(__name__)
+
+
+class PoolContext(object):
+    """
+    One collector handle for a pool, with the daemon ads it has located
+    cached for the length of a probe cycle, so the sub-collectors don't
+    each ask the collector for e.g. the schedd list. It can be used in
+    place of an htcondor.Collector; failed lookups aren't cached, so the
+    callers' retry loops still query the collector again.
+
+    Call reset() at the start of each cycle to forget the located ads.
+    """
+
+    def __init__(self, pool="localhost", stats=None):
+        self.pool = pool
+        self.collector = htcondor.Collector(pool)
+        self.lock = threading.Lock()
+        self.reset(stats)
+
+    def reset(self, stats=None):
+        """start a new cycle, optionally counting collector lookups in stats"""
+        with self.lock:
+            self.located = {}
+            self.stats = stats
+
+    def _count(self, name):
+        if self.stats is not None:
+            self.stats.count("collector."+name)
+
+    def _cached(self, key, lookup):
+        # hold the lock over the lookup, so concurrent callers wait for one
+        # collector query rather than each making their own
+        with self.lock:
+            if key in self.located:
+                self._count("locate_hits")
+                return self.located[key]
+            self._count("locate_queries")
+            result = lookup()
+            self.located[key] = result
+            return result
+
+    def locateAll(self, daemon_type):
+        return self._cached(("locateAll", daemon_type),
+                lambda: self.collector.locateAll(daemon_type))
+
+    def locate(self, daemon_type):
+        with self.lock:
+            ads = self.located.get(("locateAll", daemon_type))
+        if ads:
+            # already have the full list, e.g. the negotiators for status
+            self._count("locate_hits")
+            return ads[0]
+        return self._cached(("locate", daemon_type),
+                lambda: self.collector.locate(daemon_type))
+
+    def query(self, *args, **kwargs):
+        """uncached, queries differ in constraint and projection"""
+        self._count("queries")
+        return self.collector.query(*args, **kwargs)
@@ -1,15 +1,81 @@
 #!/usr/bin/python
+import heapq
 import logging
 import time
 
 import classad
 import htcondor
 
+from fifemon.state import load_state, save_state
+from .pool import PoolContext
+
 logger = logging.getLogger(__name__)
 
-def get_pool_priorities(pool, retry_delay=30, max_retries=4):
-    coll =  htcondor.Collector(pool)
+# priority attributes sent for each submitter
+prio_metrics = ["ResourcesUsed",
+                "AccumulatedUsage",
+                "WeightedAccumulatedUsage",
+                "Priority",
+                "WeightedResourcesUsed",
+                "PriorityFactor"]
+
+# accumulated usages turned into a Delta (since the last query) and a Rate
+# (per second, i.e. cores in use on average) when there's history
+usage_metrics = ["AccumulatedUsage", "WeightedAccumulatedUsage"]
+
+# priority attributes summed over the submitters of each group, along
+# with the usage deltas and rates
+group_metrics = ["ResourcesUsed", "WeightedResourcesUsed",
+                 "AccumulatedUsage", "WeightedAccumulatedUsage"]
+
+# what the top submitters and groups are ranked by
+top_metric = "WeightedAccumulatedUsageRate"
+
+
+class PriorityHistory(object):
+    """
+    The accumulated usages of each submitter at the last priority query,
+    to turn the next query's into usage deltas and rates.
+
+    If state_file is given the snapshot is also kept there, and picked up
+    again on start.
+    """
+
+    def __init__(self, state_file=None):
+        self.state_file = state_file
+        self.time = None
+        self.usage = {}
+        self.load()
+
+    def load(self):
+        self.time, self.usage = load_state(self.state_file, (None, {}), "priority history")
+
+    def save(self):
+        save_state(self.state_file, (self.time, self.usage), "priority history")
+
+    def update(self, now, usage):
+        """replace the snapshot with usage, {submitter: (usage, ...)} at now"""
+        self.time = now
+        self.usage = usage
+        self.save()
+
+
+def get_pool_priorities(pool, retry_delay=30, max_retries=4, stats=None, context=None,
+        history=None, top_n=0, rollups=None):
+    """
+    Returns {metric: value} of each submitter's priority attributes.
+
+    With a PriorityHistory, each submitter also gets the Delta and Rate of
+    its accumulated usages since the last query. If a rollups dict is given
+    too, each group ("groups.DOMAIN.GROUP") gets the sums of group_metrics
+    and of the deltas and rates there, and the top_n submitters and groups
+    by top_metric are copied there under "top.users" and "top.groups", so
+    dashboards don't have to search every submitter. Rollups are kept out
+    of the returned data so they don't match wildcards over submitters.
+    """
+    coll = context if context is not None else PoolContext(pool)
     retries = 0
+    start = time.time()
     while retries < max_retries:
         try:
             ad = coll.locate(htcondor.DaemonTypes.Negotiator)
@@ -18,6 +84,8 @@ def get_pool_priorities(pool, retry_delay=30, max_retries=4):
         except:
             logging.warning("Trouble communicating with pool {0} negotiator, retrying in {1}s.".format(pool,retry_delay))
             retries += 1
+            if stats is not None:
+                stats.count("priorities.retries")
             prio = None
             time.sleep(retry_delay)
         else:
@@ -27,6 +95,19 @@ def get_pool_priorities(pool, retry_delay=30, max_retries=4):
         logging.error("Trouble communicating with pool {0} negotiator, giving up.".format(pool))
         return {}
 
+    now = time.time()
+    if stats is not None:
+        stats["priorities.ads"] = len(prio)
+        stats["priorities.query_time"] = now-start
+
+    elapsed = None
+    if history is not None and history.time is not None and now > history.time:
+        elapsed = now-history.time
+    usage = {}
+    groups = {}
+    # (rate, basename) of the top_n submitters so far
+    top = []
+
     data = {}
     for p in prio:
         if p['IsAccountingGroup']:
@@ -35,15 +116,64 @@ def get_pool_priorities(pool, retry_delay=30, max_retries=4):
         parts = a.split('.')
         exp = parts[0].split("_")[-1]
         name = parts[-1]
-        basename = "{0}.{1}.{2}".format(
+        groupname = "{0}.{1}".format(
                 schedd.replace(".","_"),
-                exp,
-                name)
-        for metric in ["ResourcesUsed",
-                       "AccumulatedUsage",
-                       "WeightedAccumulatedUsage",
-                       "Priority",
-                       "WeightedResourcesUsed",
-                       "PriorityFactor"]:
+                exp)
+        basename = groupname+"."+name
+        for metric in prio_metrics:
             data[basename+"."+metric] = p[metric]
+        if history is None:
+            continue
+
+        values = [p[metric] for metric in usage_metrics]
+        usage[basename] = values
+        group = None
+        if rollups is not None:
+            group = groups.get(groupname)
+            if group is None:
+                group = groups[groupname] = dict((metric, 0) for metric in group_metrics)
+                for metric in usage_metrics if elapsed is not None else []:
+                    group[metric+"Delta"] = 0
+                    group[metric+"Rate"] = 0
+            for metric in group_metrics:
+                group[metric] += p[metric]
+        last = history.usage.get(basename)
+        if elapsed is None or last is None:
+            continue
+        deltas = [value-last_value for value, last_value in zip(values, last)]
+        if min(deltas) < 0:
+            # usage was reset, e.g. by condor_userprio
+            continue
+        for metric, delta in zip(usage_metrics, deltas):
+            data[basename+"."+metric+"Delta"] = delta
+            data[basename+"."+metric+"Rate"] = delta/elapsed
+            if group is not None:
+                group[metric+"Delta"] += delta
+                group[metric+"Rate"] += delta/elapsed
+        if rollups is not None and top_n > 0:
+            entry = (data[basename+"."+top_metric], basename)
+            if len(top) < top_n:
+                heapq.heappush(top, entry)
+            else:
+                heapq.heappushpop(top, entry)
+
+    if history is None:
+        return data
+    history.update(now, usage)
+    if rollups is None:
+        return data
+
+    for groupname, group in groups.iteritems():
+        for metric, value in group.iteritems():
+            rollups["groups."+groupname+"."+metric] = value
+    if top_n > 0 and elapsed is not None:
+        for rate, basename in top:
+            for metric in prio_metrics:
+                rollups["top.users."+basename+"."+metric] = data[basename+"."+metric]
+            for metric in usage_metrics:
+                for key in [basename+"."+metric+"Delta", basename+"."+metric+"Rate"]:
+                    rollups["top.users."+key] = data[key]
+        for groupname, group in heapq.nlargest(top_n, groups.iteritems(), key=lambda g: g[1][top_metric]):
+            for metric, value in group.iteritems():
+                rollups["top.groups."+groupname+"."+metric] = value
     return data
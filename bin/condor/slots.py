@@ -1,5 +1,4 @@
 #!/usr/bin/python
-from collections import defaultdict
 import re
 import logging
 import time
@@ -7,15 +6,23 @@ import time
 import classad
 import htcondor
 
+from fifemon.memory import peak_rss
+from .metrics import DerivedMetrics, MetricKeys, MetricValues
+from .pool import PoolContext
+
 logger = logging.getLogger(__name__)
 
+# metrics derived from the aggregated slot sums; none yet, register new
+# ratios here rather than in the slot loops
+derived_metrics = DerivedMetrics()
+
 def sanitize(key):
     if key is None:
         return None
     return key.replace(".","_").replace("@","-").replace(" ","_")
 
-def get_pool_resource_utilization(pool, retry_delay=30, max_retries=4):
-    coll =  htcondor.Collector(pool)
+def get_pool_resource_utilization(pool, retry_delay=30, max_retries=4, stats=None, context=None):
+    coll = context if context is not None else PoolContext(pool)
     retries = 0
     while retries < max_retries:
         try:
@@ -23,6 +30,8 @@ def get_pool_resource_utilization(pool, retry_delay=30, max_retries=4):
         except:
             logger.warning("trouble getting pool {0} schedds, retrying in {1}s.".format(pool,retry_delay))
             retries += 1
+            if stats is not None:
+                stats.count("resource_utilization.retries")
             schedd_ads = None
             time.sleep(retry_delay)
         else:
@@ -35,37 +44,155 @@ def get_pool_resource_utilization(pool, retry_delay=30, max_retries=4):
     memory_usage = 0
     disk_usage = 0
     for ad in schedd_ads:
+        start = time.time()
+        schedd_memory = 0
+        schedd_disk = 0
+        n = 0
         try:
             schedd = htcondor.Schedd(ad)
-            results = schedd.query('jobstatus==2',['ResidentSetSize_RAW','DiskUsage_RAW'])
+            # sum the ads as they stream in, only counting a schedd once
+            # all of its ads have arrived
+            for r in schedd.xquery('jobstatus==2',['ResidentSetSize_RAW','DiskUsage_RAW']):
+                n += 1
+                schedd_memory += r.get('ResidentSetSize_RAW',0)
+                schedd_disk += r.get('DiskUsage_RAW',0)
         except Exception as e:
             logger.error(e)
         else:
-            for r in results:
-                memory_usage += r.get('ResidentSetSize_RAW',0)
-                disk_usage += r.get('DiskUsage_RAW',0)
+            memory_usage += schedd_memory
+            disk_usage += schedd_disk
+            if stats is not None:
+                metric = ".".join(["resource_utilization", "schedds", sanitize(ad["Name"])])
+                stats[metric+".ads"] = n
+                stats[metric+".query_time"] = time.time()-start
+                # process-wide high-water mark since the cycle started, the
+                # probe resets it once per cycle
+                stats[metric+".peak_rss_b"] = peak_rss()
     return {
         "MemoryUsage":memory_usage/1024,
         "DiskUsage":disk_usage,
     }
 
 
-def get_pool_slots(pool, retry_delay=30, max_retries=4):
-    coll =  htcondor.Collector(pool)
+def aggregate_slot(a, data, now):
+    """slot totals by type and state, and claimed slots by group and owner"""
+    slot_type = a.get("SlotType", "Static")
+    state = a.get("State", "Unknown")
+
+    if slot_type == "Partitionable":
+        if a["Cpus"] == 0 or a["Memory"] < 500 or a["Disk"] < 1048576:
+            for k in ["TotalDisk", "TotalSlotDisk",
+                      "TotalMemory", "TotalSlotMemory",
+                      "TotalCpus", "TotalSlotCpus",
+                      "TotalLoadAvg", "LoadAvg", "TotalCondorLoadAvg"]:
+                #metric = ".".join([slot_type, "startds", sanitize(a["Name"]), k])
+                #data[metric] = a[k]
+                data.add_key((slot_type, "totals"), "."+k, a[k])
+            # slot is effectively fully utilized, reclassffy remaining resources
+            slot_type = "Dynamic"
+            state = "Unusable"
+        else:
+            for k in ["TotalDisk", "TotalSlotDisk", "Disk", 
+                      "TotalMemory", "TotalSlotMemory", "Memory",
+                      "TotalCpus", "TotalSlotCpus", "Cpus",
+                      "TotalLoadAvg", "LoadAvg", "TotalCondorLoadAvg"]:
+                #metric = ".".join([slot_type, "startds", sanitize(a["Name"]), k])
+                #data[metric] = a[k]
+                data.add_key((slot_type, "totals"), "."+k, a[k])
+    if state == "Claimed":
+        (group,owner) = ("Unknown","Unknown")
+        if "AccountingGroup" in a:
+            m = re.match(r'group_(\S+)\.(\S+)@\S+$',a["AccountingGroup"])
+            if m:
+                group,owner = m.groups()
+        if group == "Unknown" and "RemoteGroup" in a:
+            group = a["RemoteGroup"]
+            if group == "<none>":
+                group = "None"
+        if owner == "Unknown" and "RemoteOwner" in a:
+            owner = a["RemoteOwner"].split("@")[0]
+        group = sanitize(group)
+        owner = sanitize(owner)
+
+        for k in ["Disk", "Memory", "Cpus", "LoadAvg"]:
+            data.add_key((slot_type, state, group, owner), "."+k, a[k])
+            data.add_key((slot_type, "totals"), "."+k, a[k])
+        data.add_key((slot_type, state, group, owner), ".Weighted", a.eval("SlotWeight"))
+        data.add_key((slot_type, state, group, owner), ".NumSlots", 1)
+    if state != "Claimed" and slot_type != "Partitionable":
+        for k in ["Disk", "Memory", "Cpus"]:
+            data.add_key((slot_type, state), "."+k, a[k])
+            data.add_key((slot_type, "totals"), "."+k, a[k])
+        data.add_key((slot_type, state), ".NumSlots", 1)
+
+def aggregate_glidein(a, data, now):
+    """glidein slots by state, site and resource"""
+    if not a.get("is_glidein", False):
+        return
+    site = a.get("GLIDEIN_Site", "Unknown")
+    resource = a.get("GLIDEIN_Resource_Name",a.get("GLIDEIN_ResourceName","Unknown"))
+    state = a.get("State", "Unknown")
+    if (now - a.get("DaemonStartTime",now)) < 300:
+        state = "New"
+
+    paths = [("glideins", "totals"),
+             ("glideins", state, "totals"),
+             ("glideins", state, "sites", site, "totals"),
+             ("glideins", state, "sites", site, "resources", resource)]
+    for p in paths:
+        i = data.registry.id(p)
+        data.add(i, ".NumSlots", 1)
+        for k in ["Disk", "Memory", "Cpus"]:
+            data.add(i, "."+k, a[k])
+
+# name: (constraint, projection, aggregator). An aggregator is called with
+# each ad, its MetricValues and the query time; it must skip ads outside
+# its own constraint, as it may be fed the ads of a wider combined query.
+slot_aggregators = {
+    "slots": (True,
+              ['SlotType','State','Name','SlotWeight',
+               'Cpus','TotalSlotCpus','TotalCpus',
+               'Disk','TotalSlotDisk','TotalDisk',
+               'Memory','TotalSlotMemory','TotalMemory',
+               'LoadAvg','TotalCondorLoadAvg','TotalLoadAvg',
+               'AccountingGroup','RemoteGroup','RemoteOwner'],
+              aggregate_slot),
+    "glideins": ('is_glidein==True',
+                 ['is_glidein','GLIDEIN_Site','GLIDEIN_Resource_Name','GLIDEIN_ResourceName','State',
+                  'DaemonStartTime','Disk','Memory','Cpus'],
+                 aggregate_glidein),
+}
+
+def get_pool_startd_metrics(pool, retry_delay=30, max_retries=4, stats=None, context=None,
+        aggregators=("slots","glideins"), keys=None):
+    """
+    Returns {aggregator: metrics} for the given slot_aggregators, from one
+    startd query with the union of their projections, in a single pass
+    over the ads. Pass the same MetricKeys every cycle to reuse its ids.
+    """
+    coll = context if context is not None else PoolContext(pool)
+    if keys is None:
+        keys = MetricKeys()
+    constraints = [slot_aggregators[name][0] for name in aggregators]
+    if True in constraints:
+        constraint = True
+    else:
+        constraint = " || ".join("(%s)" % c for c in constraints)
+    projection = set()
+    for name in aggregators:
+        projection.update(slot_aggregators[name][1])
+
     retries = 0
+    start = time.time()
     while retries < max_retries:
         try:
             #startd_ads = coll.locateAll(htcondor.DaemonTypes.Startd)
-            startd_ads = coll.query(htcondor.AdTypes.Startd, True, 
-                    ['SlotType','State','Name','SlotWeight',
-                        'Cpus','TotalSlotCpus','TotalCpus',
-                        'Disk','TotalSlotDisk','TotalDisk',
-                        'Memory','TotalSlotMemory','TotalMemory',
-                        'LoadAvg','TotalCondorLoadAvg','TotalLoadAvg',
-                        'AccountingGroup','RemoteGroup','RemoteOwner'])
+            startd_ads = coll.query(htcondor.AdTypes.Startd, constraint, sorted(projection))
         except:
             logger.warning("trouble getting pool {0} startds, retrying in {1}s.".format(pool,retry_delay))
             retries += 1
+            if stats is not None:
+                stats.count("startds.retries")
             startd_ads = None
             time.sleep(retry_delay)
         else:
@@ -73,118 +200,34 @@ def get_pool_slots(pool, retry_delay=30, max_retries=4):
 
     if startd_ads is None:
         logger.error("trouble getting pool {0} startds, giving up.".format(pool))
-        return {}
+        return dict((name, {}) for name in aggregators)
 
-    data = defaultdict(int)
-    load = defaultdict(float)
+    if stats is not None:
+        stats["startds.ads"] = len(startd_ads)
+        stats["startds.query_time"] = time.time()-start
+
+    data = dict((name, MetricValues(keys)) for name in aggregators)
+    feeds = [(slot_aggregators[name][2], data[name]) for name in aggregators]
+    now = time.time()
     for a in startd_ads:
-        slot_type = a.get("SlotType", "Static")
-        state = a.get("State", "Unknown")
-
-        if slot_type == "Partitionable":
-            if a["Cpus"] == 0 or a["Memory"] < 500 or a["Disk"] < 1048576:
-                for k in ["TotalDisk", "TotalSlotDisk",
-                          "TotalMemory", "TotalSlotMemory",
-                          "TotalCpus", "TotalSlotCpus",
-                          "TotalLoadAvg", "LoadAvg", "TotalCondorLoadAvg"]:
-                    #metric = ".".join([slot_type, "startds", sanitize(a["Name"]), k])
-                    #data[metric] = a[k]
-                    metric = ".".join([slot_type, "totals", k])
-                    data[metric] += a[k]
-                # slot is effectively fully utilized, reclassffy remaining resources
-                slot_type = "Dynamic"
-                state = "Unusable"
-            else:
-                for k in ["TotalDisk", "TotalSlotDisk", "Disk", 
-                          "TotalMemory", "TotalSlotMemory", "Memory",
-                          "TotalCpus", "TotalSlotCpus", "Cpus",
-                          "TotalLoadAvg", "LoadAvg", "TotalCondorLoadAvg"]:
-                    #metric = ".".join([slot_type, "startds", sanitize(a["Name"]), k])
-                    #data[metric] = a[k]
-                    metric = ".".join([slot_type, "totals", k])
-                    data[metric] += a[k]
-        if state == "Claimed":
-            (group,owner) = ("Unknown","Unknown")
-            if "AccountingGroup" in a:
-                m = re.match(r'group_(\S+)\.(\S+)@\S+$',a["AccountingGroup"])
-                if m:
-                    group,owner = m.groups()
-            if group == "Unknown" and "RemoteGroup" in a:
-                group = a["RemoteGroup"]
-                if group == "<none>":
-                    group = "None"
-            if owner == "Unknown" and "RemoteOwner" in a:
-                owner = a["RemoteOwner"].split("@")[0]
-
-            for k in ["Disk", "Memory", "Cpus", "LoadAvg"]:
-                metric = ".".join([slot_type, state, sanitize(group), sanitize(owner), k])
-                data[metric] += a[k]
-                metric = ".".join([slot_type, "totals", k])
-                data[metric] += a[k]
-            metric = ".".join([slot_type, state, sanitize(group), sanitize(owner), "Weighted"])
-            data[metric] += a.eval("SlotWeight")
-            metric = ".".join([slot_type, state, sanitize(group), sanitize(owner), "NumSlots"])
-            data[metric] += 1
-        if state != "Claimed" and slot_type != "Partitionable":
-            for k in ["Disk", "Memory", "Cpus"]:
-                metric = ".".join([slot_type, state, k])
-                data[metric] += a[k]
-                metric = ".".join([slot_type, "totals", k])
-                data[metric] += a[k]
-            metric = ".".join([slot_type, state, "NumSlots"])
-            data[metric] += 1
-    for k,v in get_pool_resource_utilization(pool, retry_delay, max_retries).iteritems():
-        metric = ".".join(["jobs", "totals", k])
-        data[metric] =  v
-        
-    return data
+        for aggregate, metrics in feeds:
+            aggregate(a, metrics, now)
 
-def get_pool_glidein_slots(pool, retry_delay=30, max_retries=4):
-    coll =  htcondor.Collector(pool)
-    retries = 0
-    while retries < max_retries:
-        try:
-            startd_ads = coll.query(htcondor.AdTypes.Startd, 'is_glidein==True', 
-                    ['GLIDEIN_Site','GLIDEIN_Resource_Name','GLIDEIN_ResourceName','State',
-                        'DaemonStartTime','Disk','Memory','Cpus'])
-        except:
-            logger.warning("trouble getting pool {0} startds, retrying in {1}s.".format(pool,retry_delay))
-            retries += 1
-            startd_ads = None
-            time.sleep(retry_delay)
-        else:
-            break
+    if "slots" in data:
+        for k,v in get_pool_resource_utilization(pool, retry_delay, max_retries, stats, coll).iteritems():
+            data["slots"].set_key(("jobs", "totals"), "."+k, v)
 
-    if startd_ads is None:
-        logger.error("trouble getting pool {0} startds, giving up.".format(pool))
-        return {}
+    for metrics in data.itervalues():
+        derived_metrics.finalize(metrics)
+    keys.trim(len(set(i for metrics in data.itervalues() for i, sums in metrics.iterids())))
+    return data
 
-    data = defaultdict(int)
-    load = defaultdict(float)
-    for a in startd_ads:
-        site = a.get("GLIDEIN_Site", "Unknown")
-        resource = a.get("GLIDEIN_Resource_Name",a.get("GLIDEIN_ResourceName","Unknown"))
-        state = a.get("State", "Unknown")
-        if (time.time() - a.get("DaemonStartTime",time.time())) < 300:
-            state = "New"
-
-        metrics = [".".join(["glideins", "totals", "NumSlots"]),
-                   ".".join(["glideins", state, "totals", "NumSlots"]),
-                   ".".join(["glideins", state, "sites", site, "totals", "NumSlots"]),
-                   ".".join(["glideins", state, "sites", site, "resources", resource, "NumSlots"])]
-        for m in metrics:
-            data[m] += 1
+def get_pool_slots(pool, retry_delay=30, max_retries=4, stats=None, context=None):
+    return get_pool_startd_metrics(pool, retry_delay, max_retries, stats, context, ["slots"])["slots"]
 
-        for k in ["Disk", "Memory", "Cpus"]:
-            metrics = [".".join(["glideins", "totals", k]),
-                       ".".join(["glideins", state, "totals", k]),
-                       ".".join(["glideins", state, "sites", site, "totals", k]),
-                       ".".join(["glideins", state, "sites", site, "resources", resource, k])]
-            for m in metrics:
-                data[m] += a[k]
-        
-    return data
+def get_pool_glidein_slots(pool, retry_delay=30, max_retries=4, stats=None, context=None):
+    return get_pool_startd_metrics(pool, retry_delay, max_retries, stats, context, ["glideins"])["glideins"]
 
 if __name__ == "__main__":
     import pprint
-    pprint.pprint(dict(get_pool_slots()))
+    pprint.pprint(dict(get_pool_slots().iteritems()))
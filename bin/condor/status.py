@@ -5,11 +5,13 @@ import time
 import classad
 import htcondor
 
+from .pool import PoolContext
+
 logger = logging.getLogger(__name__)
 
 
-def get_pool_status(pool, retry_delay=30, max_retries=4):
-    coll =  htcondor.Collector(pool)
+def get_pool_status(pool, retry_delay=30, max_retries=4, stats=None, context=None):
+    coll = context if context is not None else PoolContext(pool)
 
     daemons = {"schedds": htcondor.DaemonTypes.Schedd,
                "collectors": htcondor.DaemonTypes.Collector,
@@ -21,6 +23,7 @@ def get_pool_status(pool, retry_delay=30, max_retries=4):
             }
     for daemon_type, daemon in daemons.iteritems():
         retries = 0
+        start = time.time()
         while retries < max_retries:
             try:
                 ads = coll.locateAll(daemon)
@@ -28,12 +31,17 @@ def get_pool_status(pool, retry_delay=30, max_retries=4):
                 logger.warning("trouble getting pool {0} {1} status, retrying in {2}s.".format(pool,daemon_type,retry_delay))
                 ads = None
                 retries += 1
+                if stats is not None:
+                    stats.count("status.retries")
                 time.sleep(retry_delay)
             else:
                 break
         if ads is None:
             logger.error("trouble getting pool {0} {1} status, giving up.".format(pool,daemon_type))
         else:
+            if stats is not None:
+                stats["status."+daemon_type+".ads"] = len(ads)
+                stats["status."+daemon_type+".query_time"] = time.time()-start
             for ad in ads:
                 for k in ad:
                     if type(ad[k]) in [int,long,float]:
@@ -5,17 +5,27 @@ from optparse import OptionParser
 import logging
 import time
 import os
+import threading
 import ConfigParser
 import pprint
 
+import htcondor
+
 import fifemon
 import condor
+from fifemon.workers import parallel_map
 
 logger = logging.getLogger(__name__)
 
-class CondorProbe(fifemon.Probe):
+class CondorPool(object):
     """
-    Query HTCondor pool and post statistics to Graphite.
+    One HTCondor pool watched by a CondorProbe: its collection settings,
+    the state kept for it between cycles, and the stages that query it
+    and send its metrics under its own namespace.
+
+    A pool whose collector can't be reached is backed off, skipping an
+    exponentially growing number of cycles (up to max_backoff seconds), so
+    it doesn't keep a worker busy with retries while other pools wait.
 
     Options:
         post_pool_status:   collect main daemon (schedd, collector,
@@ -23,75 +33,323 @@ class CondorProbe(fifemon.Probe):
         post_pool_slots:    collect & aggregate slot (startd) status
         post_pool_glideins: collect & aggregate glidein slot status
         post_pool_prio:     collect user priorities
+        prio_history:       keep the last priorities to send usage deltas
+                            and rates, per user, and per group under
+                            priority_rollups.groups
+        prio_state_file:    file to keep the last priorities in across
+                            restarts; with several pools, the [condor]
+                            default gets ".NAME" appended for each pool
+        prio_top_n:         also send the top N users and groups by
+                            weighted usage rate under
+                            priority_rollups.top.users and .top.groups
         post_pool_jobs:     collect & aggregate user job status
+        parallel_stages:    run the enabled collections concurrently
+        stage_intervals:    {stage: seconds} for stages (status, startds,
+                            priorities, jobs) to run less often than
+                            every interval
+        retries, delay:     query retries for this pool, defaulting to
+                            the probe's
     """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, probe, name, namespace, **kwargs):
+        self.probe = probe
+        self.name = name
+        self.namespace = namespace
         self.pool = kwargs.pop('pool', 'localhost')
         self.post_pool_status = kwargs.pop('post_pool_status',True)
         self.post_pool_slots = kwargs.pop('post_pool_slots',True)
         self.post_pool_glideins = kwargs.pop('post_pool_glideins',False)
         self.post_pool_prio = kwargs.pop('post_pool_prio',True)
+        self.prio_history = kwargs.pop('prio_history',False)
+        self.prio_state_file = kwargs.pop('prio_state_file',None) or None
+        self.prio_top_n = kwargs.pop('prio_top_n',0)
         self.post_pool_jobs = kwargs.pop('post_pool_jobs',False)
-        self.use_gsi_auth = kwargs.pop('use_gsi_auth',False)
-        self.x509_user_key = kwargs.pop('x509_user_key',"")
-        self.x509_user_cert = kwargs.pop('x509_user_cert',"")
+        self.max_schedd_workers = kwargs.pop('max_schedd_workers',8)
+        self.schedd_timeout = kwargs.pop('schedd_timeout',None)
+        self.incremental_jobs = kwargs.pop('incremental_jobs',False)
+        self.full_resync_interval = kwargs.pop('full_resync_interval',12)
+        self.verify_incremental = kwargs.pop('verify_incremental',False)
+        self.change_markers = kwargs.pop('change_markers',None)
+        self.parallel_stages = kwargs.pop('parallel_stages',True)
+        self.stage_intervals = kwargs.pop('stage_intervals',None) or {}
+        self.retries = kwargs.pop('retries',probe.retries)
+        self.delay = kwargs.pop('delay',probe.delay)
+        self.max_backoff = kwargs.pop('max_backoff',3600)
+        if len(kwargs) > 0:
+            raise TypeError("unknown options for pool {0}: {1}".format(name, ", ".join(sorted(kwargs))))
 
-        if self.post_pool_jobs:
-            self.jobs = condor.Jobs(self.pool)
+        # one collector handle, and one lookup of each daemon type per cycle
+        self.context = condor.PoolContext(self.pool)
+        # slot metric ids, reused from cycle to cycle
+        self.slot_keys = condor.MetricKeys()
+        self.failures = 0
+        self.retry_at = 0
+        # set while the pool's stages run, so a pool that's still busy
+        # (e.g. abandoned after pool_timeout) isn't started twice
+        self.busy = threading.Lock()
 
-        super(CondorProbe, self).__init__(*args, **kwargs)
+        self.priority_history = None
+        if self.post_pool_prio and self.prio_history:
+            self.priority_history = condor.PriorityHistory(self.prio_state_file)
 
-    def post(self):
-        if self.use_gsi_auth:
-            save_key = os.environ.get('X509_USER_KEY')
-            os.environ['X509_USER_KEY'] = self.x509_user_key
-            save_cert = os.environ.get('X509_USER_CERT')
-            os.environ['X509_USER_CERT'] = self.x509_user_cert
+        if self.post_pool_jobs:
+            self.jobs = condor.Jobs(self.pool,
+                    max_workers=self.max_schedd_workers,
+                    schedd_timeout=self.schedd_timeout,
+                    incremental=self.incremental_jobs,
+                    full_resync_interval=self.full_resync_interval,
+                    verify_incremental=self.verify_incremental,
+                    change_markers=self.change_markers)
 
-        if self.post_pool_status:
-            logger.info('querying pool {0} status'.format(self.pool))
-            data = condor.get_pool_status(self.pool, self.delay, self.retries)
+    def post_status(self, stats):
+        logger.info('querying pool {0} status'.format(self.pool))
+        with stats.timer("stages.status.collect_time"):
+            data = condor.get_pool_status(self.pool, self.delay, self.retries, stats, self.context)
+        probe = self.probe
+        with stats.timer("stages.status.send_time"):
             for dataset in data:
-                if self.use_graphite:
-                    self.graphite.send_dict(self.namespace, 
+                stats.count("stages.status.metrics", len(dataset["metrics"]))
+                if probe.use_graphite:
+                    probe.graphite.send_dict(self.namespace, 
                             dataset["metrics"], 
-                            send_data=(not self.test))
-                if self.use_influxdb:
-                    self.influxdb.send_dict(dataset["metrics"], 
-                            send_data=(not self.test),
+                            send_data=(not probe.test),
+                            timestamp=probe.cycle_time)
+                if probe.use_influxdb:
+                    probe.influxdb.send_dict(dataset["metrics"], 
+                            send_data=(not probe.test),
+                            timestamp=probe.cycle_time,
                             schema=dataset["schema"], 
-                            tags=self.influxdb_tags)
+                            tags=self.influxdb_tags())
+
+    def post_startds(self, stats):
+        # slot and glidein metrics come from one startd query
+        aggregators = []
         if self.post_pool_slots:
-            logger.info('querying pool {0} slots'.format(self.pool))
-            data = condor.get_pool_slots(self.pool, self.delay, self.retries)
-            if self.use_graphite:
-                self.graphite.send_dict(self.namespace+".slots", data, send_data=(not self.test))
+            aggregators.append("slots")
         if self.post_pool_glideins:
-            logger.info('querying pool {0} glidein slots'.format(self.pool))
-            data = condor.get_pool_glidein_slots(self.pool, self.delay, self.retries)
-            if self.use_graphite:
-                self.graphite.send_dict(self.namespace+".slots", data, send_data=(not self.test))
+            aggregators.append("glideins")
+        logger.info('querying pool {0} {1}'.format(self.pool, " and ".join(aggregators)))
+        with stats.timer("stages.startds.collect_time"):
+            results = condor.get_pool_startd_metrics(self.pool, self.delay, self.retries, stats,
+                    self.context, aggregators, self.slot_keys)
+        probe = self.probe
+        for stage in aggregators:
+            data = results[stage]
+            stats.count("stages."+stage+".metrics", len(data))
+            with stats.timer("stages."+stage+".send_time"):
+                if probe.use_graphite:
+                    probe.graphite.send_dict(self.namespace+".slots", data, send_data=(not probe.test),
+                            timestamp=probe.cycle_time)
+
+    def post_priorities(self, stats):
+        logger.info('querying pool {0} priorities'.format(self.pool))
+        with stats.timer("stages.priorities.collect_time"):
+            rollups = {} if self.priority_history is not None else None
+            data = condor.get_pool_priorities(self.pool, self.delay, self.retries, stats, self.context,
+                    self.priority_history, self.prio_top_n, rollups)
+        stats.count("stages.priorities.metrics", len(data)+len(rollups or {}))
+        probe = self.probe
+        with stats.timer("stages.priorities.send_time"):
+            if probe.use_graphite:
+                probe.graphite.send_dict(self.namespace+".priorities", data, send_data=(not probe.test),
+                        timestamp=probe.cycle_time)
+                if rollups:
+                    # group and top-N rollups under their own namespace, so
+                    # they don't match wildcards over the submitters
+                    probe.graphite.send_dict(self.namespace+".priority_rollups", rollups,
+                            send_data=(not probe.test), timestamp=probe.cycle_time)
+
+    def post_jobs(self, stats):
+        logger.info('querying pool {0} jobs'.format(self.pool))
+        with stats.timer("stages.jobs.collect_time"):
+            data = self.jobs.get_job_count(self.delay, self.retries, stats, self.context)
+        if data is not None:
+            stats.count("stages.jobs.metrics", len(data))
+        probe = self.probe
+        with stats.timer("stages.jobs.send_time"):
+            if probe.use_graphite:
+                probe.graphite.send_dict(self.namespace+".jobs", data, send_data=(not probe.test),
+                        timestamp=probe.cycle_time)
+
+    def influxdb_tags(self):
+        tags = self.probe.influxdb_tags
+        if self.name is None:
+            return tags
+        tags = dict(tags or {})
+        tags["pool"] = self.name
+        return tags
+
+    def reachable(self, stats):
+        """
+        Returns whether the pool's collector answers, backing the pool off
+        if it doesn't.
+        """
+        try:
+            self.context.locate(htcondor.DaemonTypes.Collector)
+        except Exception as e:
+            self.failures += 1
+            backoff = min(self.probe.interval*2**(self.failures-1), self.max_backoff)
+            # in cycle time, so a backoff of one interval skips one cycle
+            self.retry_at = self.probe.cycle_time+backoff
+            logger.error("pool {0} collector unreachable ({1}), backing off {2}s".format(self.pool, e, backoff))
+            stats["pool.failures"] = self.failures
+            return False
+        self.failures = 0
+        self.retry_at = 0
+        return True
+
+    def post(self, stats):
+        """run the stages that are due this cycle"""
+        if self.probe.cycle_time < self.retry_at:
+            logger.info("pool {0} backed off for another {1:.0f}s".format(self.pool, self.retry_at-self.probe.cycle_time))
+            stats["pool.backed_off"] = 1
+            return
+        if not self.busy.acquire(False):
+            logger.warning("pool {0} is still busy with the last cycle, skipping".format(self.pool))
+            stats["pool.busy"] = 1
+            return
+        try:
+            self.context.reset(stats)
+            if not self.reachable(stats):
+                return
+            self.post_stages(stats)
+        finally:
+            self.busy.release()
+
+    def post_stages(self, stats):
+        stages = []
+        if self.post_pool_status:
+            stages.append(("status", self.post_status))
+        if self.post_pool_slots or self.post_pool_glideins:
+            stages.append(("startds", self.post_startds))
         if self.post_pool_prio:
-            logger.info('querying pool {0} priorities'.format(self.pool))
-            data = condor.get_pool_priorities(self.pool, self.delay, self.retries)
-            if self.use_graphite:
-                self.graphite.send_dict(self.namespace+".priorities", data, send_data=(not self.test))
+            stages.append(("priorities", self.post_priorities))
         if self.post_pool_jobs:
-            logger.info('querying pool {0} jobs'.format(self.pool))
-            data = self.jobs.get_job_count(self.delay, self.retries)
-            if self.use_graphite:
-                self.graphite.send_dict(self.namespace+".jobs", data, send_data=(not self.test))
+            stages.append(("jobs", self.post_jobs))
+        prefix = self.name+"." if self.name is not None else ""
+        stages = [(stage, func) for stage, func in stages
+                  if self.probe.due(prefix+stage, self.stage_intervals.get(stage))]
 
+        if self.parallel_stages:
+            # each stage sends its data as soon as it's done, and one
+            # stuck in retries doesn't hold up the others
+            results = parallel_map(lambda stage: stage[1](stats), stages,
+                    max_workers=len(stages), name=lambda stage: stage[0])
+            for stage, func in set(stages)-set(s for s,r in results):
+                stats.count("stages."+stage+".failed")
+        else:
+            for stage, func in stages:
+                try:
+                    func(stats)
+                except Exception as e:
+                    logger.error("stage {0} failed: {1}".format(stage, e))
+                    stats.count("stages."+stage+".failed")
+
+
+class CondorProbe(fifemon.Probe):
+    """
+    Query HTCondor pools and post statistics to Graphite.
+
+    Options:
+        pools:              list of {name, namespace, option: value} for
+                            each pool to watch, with any CondorPool option;
+                            the rest default to the single-pool options
+                            below. Each pool's metrics go to its namespace
+                            (default namespace.name) and its probe metrics
+                            to meta_namespace.pools.name.
+        max_pool_workers:   how many pools to query at once
+        pool_timeout:       seconds to wait on a pool before moving on
+                            without it
+        use_gsi_auth, x509_user_key, x509_user_cert:
+                            credentials, shared by all pools
+
+    plus the CondorPool options, for a single pool, or as defaults for
+    pools.
+    """
+
+    pool_options = ['pool', 'post_pool_status', 'post_pool_slots', 'post_pool_glideins',
+                    'post_pool_prio', 'prio_history', 'prio_state_file', 'prio_top_n',
+                    'post_pool_jobs', 'max_schedd_workers',
+                    'schedd_timeout', 'incremental_jobs', 'full_resync_interval',
+                    'verify_incremental', 'change_markers', 'parallel_stages',
+                    'stage_intervals', 'max_backoff']
+
+    def __init__(self, *args, **kwargs):
+        defaults = dict((k, kwargs.pop(k)) for k in self.pool_options if k in kwargs)
+        pools = kwargs.pop('pools', None)
+        self.use_gsi_auth = kwargs.pop('use_gsi_auth',False)
+        self.x509_user_key = kwargs.pop('x509_user_key',"")
+        self.x509_user_cert = kwargs.pop('x509_user_cert',"")
+        self.max_pool_workers = kwargs.pop('max_pool_workers',4)
+        self.pool_timeout = kwargs.pop('pool_timeout',None)
+
+        super(CondorProbe, self).__init__(*args, **kwargs)
+
+        if not pools:
+            # the original single-pool layout: no name, metrics straight
+            # under namespace
+            self.pools = [CondorPool(self, None, self.namespace, **defaults)]
+        else:
+            self.pools = []
+            for p in pools:
+                options = dict(defaults)
+                options.update(p)
+                name = options.pop('name')
+                namespace = options.pop('namespace', None) or self.namespace+"."+name
+                if 'prio_state_file' not in p and options.get('prio_state_file'):
+                    # each pool keeps its own priority history
+                    options['prio_state_file'] += "."+name
+                self.pools.append(CondorPool(self, name, namespace, **options))
+            state_files = [pool.prio_state_file for pool in self.pools
+                    if pool.priority_history is not None and pool.prio_state_file is not None]
+            for f in set(state_files):
+                if state_files.count(f) > 1:
+                    raise ValueError("prio_state_file {0} is used by more than one pool".format(f))
+
+    def post_pool(self, pool):
+        meta_data = self.meta_data
+        if pool.name is None:
+            pool.post(meta_data)
+            return
+        stats = fifemon.Instruments()
+        try:
+            pool.post(stats)
+        finally:
+            prefix = "pools."+pool.name.replace(".","_")+"."
+            with meta_data.lock:
+                for k,v in stats.iteritems():
+                    meta_data[prefix+k] = v
+
+    def post(self):
+        # the bindings read the credentials from the environment, which all
+        # pool and stage threads share, so set them once for the whole cycle
         if self.use_gsi_auth:
-            if save_key is None:
-                del os.environ['X509_USER_KEY']
-            else:
-                os.environ['X509_USER_KEY'] = save_key
-            if save_cert is None:
-                del os.environ['X509_USER_CERT']
+            save_key = os.environ.get('X509_USER_KEY')
+            os.environ['X509_USER_KEY'] = self.x509_user_key
+            save_cert = os.environ.get('X509_USER_CERT')
+            os.environ['X509_USER_CERT'] = self.x509_user_cert
+
+        try:
+            if len(self.pools) == 1:
+                self.post_pool(self.pools[0])
             else:
-                os.environ['X509_USER_CERT'] = save_cert
+                # each pool keeps its own retries and backoff, so a dead
+                # pool only ties up its own worker
+                results = parallel_map(self.post_pool, self.pools,
+                        max_workers=self.max_pool_workers, timeout=self.pool_timeout,
+                        name=lambda pool: pool.name)
+                for pool in set(self.pools)-set(p for p,r in results):
+                    self.meta_data.count("pools."+pool.name.replace(".","_")+".failed")
+        finally:
+            if self.use_gsi_auth:
+                if save_key is None:
+                    del os.environ['X509_USER_KEY']
+                else:
+                    os.environ['X509_USER_KEY'] = save_key
+                if save_cert is None:
+                    del os.environ['X509_USER_CERT']
+                else:
+                    os.environ['X509_USER_CERT'] = save_cert
 
 def get_options():
     parser = OptionParser(usage="usage: %prog [options] [config file(s)]")
@@ -113,30 +371,105 @@ def get_options():
             r[k] = v
         return r
 
+    def get_optional(section, option, default, get=config.get):
+        if config.has_option(section, option):
+            return get(section, option)
+        return default
+
+    def get_stage_intervals(section, option):
+        return dict((k,int(v)) for k,v in (parse_tags(config.get(section, option)) or {}).iteritems())
+
+    # [condor] options that a [pool NAME] section can override
+    pool_options = [
+        ('pool',                 'pool',                 config.get),
+        ('post_pool_status',     'post_pool_status',     config.getboolean),
+        ('post_pool_slots',      'post_pool_slots',      config.getboolean),
+        ('post_pool_glideins',   'post_pool_glideins',   config.getboolean),
+        ('post_pool_prio',       'post_pool_prio',       config.getboolean),
+        ('prio_history',         'prio_history',         config.getboolean),
+        ('prio_state_file',      'prio_state_file',      config.get),
+        ('prio_top_n',           'prio_top_n',           config.getint),
+        ('post_pool_jobs',       'post_pool_jobs',       config.getboolean),
+        ('max_schedd_workers',   'max_schedd_workers',   config.getint),
+        ('schedd_timeout',       'schedd_timeout',       config.getint),
+        ('incremental_jobs',     'incremental_jobs',     config.getboolean),
+        ('full_resync_interval', 'full_resync_interval', config.getint),
+        ('verify_incremental',   'verify_incremental',   config.getboolean),
+        ('change_markers',       'change_markers',       lambda s,o: config.get(s,o).split(",")),
+        ('parallel_stages',      'parallel_stages',      config.getboolean),
+        ('stage_intervals',      'stage_intervals',      get_stage_intervals),
+        ('max_pool_backoff',     'max_backoff',          config.getint),
+        ('retries',              'retries',              config.getint),
+        ('delay',                'delay',                config.getint),
+    ]
+
+    def get_pools():
+        names = [n.strip() for n in get_optional("condor", "pools", "").split(",") if n.strip() != ""]
+        pools = []
+        for name in names:
+            section = "pool "+name
+            if not config.has_section(section):
+                raise ConfigParser.NoSectionError(section)
+            p = {'name': name}
+            for option, key, get in pool_options:
+                if config.has_option(section, option):
+                    p[key] = get(section, option)
+            if config.has_option(section, "namespace"):
+                p['namespace'] = config.get(section, "namespace")
+            pools.append(p)
+        return pools
+
 
     opts = {
-        'pool':              config.get("condor", "pool"),
+        'pool':              get_optional("condor", "pool", "localhost"),
+        'pools':             get_pools(),
+        'max_pool_workers':  get_optional("condor", "max_pool_workers", 4, config.getint),
+        'pool_timeout':      get_optional("condor", "pool_timeout", None, config.getint),
+        'max_backoff':       get_optional("condor", "max_pool_backoff", 3600, config.getint),
         'post_pool_status':  config.getboolean("condor", "post_pool_status"),
         'post_pool_slots':   config.getboolean("condor", "post_pool_slots"),
         'post_pool_glideins':config.getboolean("condor", "post_pool_glideins"),
         'post_pool_prio':    config.getboolean("condor", "post_pool_prio"),
+        'prio_history':      get_optional("condor", "prio_history", False, config.getboolean),
+        'prio_state_file':   get_optional("condor", "prio_state_file", None),
+        'prio_top_n':        get_optional("condor", "prio_top_n", 0, config.getint),
         'post_pool_jobs':    config.getboolean("condor", "post_pool_jobs"),
         'use_gsi_auth':      config.getboolean("condor", "use_gsi_auth"),
         'x509_user_key':     config.get("condor", "X509_USER_KEY"),
         'x509_user_cert':    config.get("condor", "X509_USER_CERT"),
+        'max_schedd_workers':get_optional("condor", "max_schedd_workers", 8, config.getint),
+        'schedd_timeout':    get_optional("condor", "schedd_timeout", None, config.getint),
+        'incremental_jobs':  get_optional("condor", "incremental_jobs", False, config.getboolean),
+        'full_resync_interval':get_optional("condor", "full_resync_interval", 12, config.getint),
+        'verify_incremental':get_optional("condor", "verify_incremental", False, config.getboolean),
+        'change_markers':    get_optional("condor", "change_markers", "EnteredCurrentStatus").split(","),
+        'parallel_stages':   get_optional("condor", "parallel_stages", True, config.getboolean),
+        'stage_intervals':   get_optional("condor", "stage_intervals", {}, get_stage_intervals),
         'use_graphite':      config.getboolean("graphite", "enable"),
         'namespace':         config.get("graphite", "namespace"),
         'meta_namespace':    config.get("graphite", "meta_namespace"),
         'graphite_host':     config.get("graphite", "host"),
         'graphite_pickle_port':     config.getint("graphite", "port"),
+        'graphite_relays':   fifemon.graphite.parse_endpoints(get_optional("graphite", "relays", "")),
+        'graphite_batch_size':get_optional("graphite", "batch_size", 1000, config.getint),
+        'graphite_timeout':  get_optional("graphite", "timeout", 30, config.getint),
         'use_influxdb':      config.getboolean("influxdb", "enable"),
         'influxdb_host':     config.get("influxdb", "host"),
         'influxdb_port':     config.get("influxdb", "port"),
         'influxdb_db':       config.get("influxdb", "db"),
         'influxdb_tags':     parse_tags(config.get("influxdb", "tags")),
+        'influxdb_batch_size':get_optional("influxdb", "batch_size", 5000, config.getint),
+        'async_send':        get_optional("probe", "async_send", False, config.getboolean),
+        'send_queue_size':   get_optional("probe", "send_queue_size", 100, config.getint),
+        'send_queue_overflow':get_optional("probe", "send_queue_overflow", "drop"),
+        'spool_dir':         get_optional("probe", "spool_dir", "spool"),
+        'spool_failed':      get_optional("probe", "spool_failed", False, config.getboolean),
+        'spool_max_mb':      get_optional("probe", "spool_max_mb", 1024, config.getint),
+        'spool_max_age':     get_optional("probe", "spool_max_age", 86400, config.getint),
         'test':              cmd_opts.test or config.getboolean("probe", "test"),
         'once':              cmd_opts.once or config.getboolean("probe", "once"),
         'interval':          config.getint("probe", "interval"),
+        'overrun_policy':    get_optional("probe", "overrun_policy", "skip"),
         'delay':             config.getint("probe", "delay"),
         'retries':           config.getint("probe", "retries"),
     }
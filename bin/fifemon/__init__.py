@@ -1,2 +1,3 @@
 from .probe import Probe
 from .graphite import Graphite
+from .instrument import Instruments
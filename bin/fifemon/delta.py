@@ -0,0 +1,83 @@
+#!/usr/bin/python
+import hashlib
+import logging
+import time
+
+from state import load_state, save_state
+
+logger = logging.getLogger(__name__)
+
+class DeltaFilter(object):
+    """pass on only the records that are new or have changed since the
+    last cycle, so unchanged documents aren't re-indexed every cycle.
+
+    A record is identified by its id_field and compared by an 8-byte
+    fingerprint of all its fields except those in ignore (e.g. the cycle
+    timestamp). Ids that weren't seen in a cycle are returned by finish()
+    so a tombstone can be sent for them. Every full_refresh seconds a
+    cycle passes everything through. If state_file is given the
+    fingerprints are saved there after each cycle and loaded on start,
+    so a restart doesn't re-send everything."""
+
+    def __init__(self, id_field, ignore=("timestamp",), full_refresh=3600, state_file=None):
+        self.id_field = id_field
+        self.ignore = set(ignore)
+        self.full_refresh = full_refresh
+        self.state_file = state_file
+        self.fingerprints = {}
+        self.last_full = 0
+        self.seen = set()
+        self.full = True
+        self.load()
+
+    def load(self):
+        self.fingerprints, self.last_full = load_state(self.state_file,
+                ({}, 0), "delta state")
+
+    def save(self):
+        save_state(self.state_file, (self.fingerprints, self.last_full), "delta state")
+
+    def fingerprint(self, record):
+        fields = sorted((k,v) for k,v in record.iteritems() if k not in self.ignore)
+        return hashlib.md5(repr(fields)).digest()[:8]
+
+    def start(self):
+        """start a cycle"""
+        now = time.time()
+        self.seen = set()
+        self.full = self.full_refresh is not None and now-self.last_full >= self.full_refresh
+        if self.full:
+            logger.info("full refresh, sending all records this cycle")
+            self.last_full = now
+        self.passed = 0
+        self.skipped = 0
+
+    def changed(self, record):
+        """record the record's fingerprint and return True if it should be sent"""
+        doc_id = record[self.id_field]
+        self.seen.add(doc_id)
+        fp = self.fingerprint(record)
+        if not self.full and self.fingerprints.get(doc_id) == fp:
+            self.skipped += 1
+            return False
+        self.fingerprints[doc_id] = fp
+        self.passed += 1
+        return True
+
+    def finish(self, keep=None):
+        """end the cycle and return the ids of records that have gone away.
+        Ids for which keep(id) is true, e.g. those from a schedd that
+        couldn't be queried, are kept rather than reported gone."""
+        gone = []
+        for doc_id in self.fingerprints.keys():
+            if doc_id in self.seen:
+                continue
+            if keep is not None and keep(doc_id):
+                continue
+            gone.append(doc_id)
+            del self.fingerprints[doc_id]
+        self.seen = set()
+        logger.info("{0} records new or changed, {1} unchanged, {2} gone".format(
+            self.passed, self.skipped, len(gone)))
+        self.save()
+        return gone
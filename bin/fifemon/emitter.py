@@ -0,0 +1,83 @@
+#!/usr/bin/python
+import datetime
+import logging
+import sys
+import time
+
+try:
+    import ujson
+    def dumps(obj):
+        return ujson.dumps(obj, escape_forward_slashes=False)
+except ImportError:
+    import json
+    dumps = json.dumps
+
+logger = logging.getLogger(__name__)
+
+class IsoTimes(object):
+    """epoch to local ISO 8601 string conversion, cached since the same
+    times (e.g. submit times of jobs in one cluster) come up over and over.
+    The cache is cleared once it holds max_size times."""
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.cache = {}
+
+    def __call__(self, t):
+        try:
+            return self.cache[t]
+        except KeyError:
+            if len(self.cache) >= self.max_size:
+                self.cache.clear()
+            s = self.cache[t] = datetime.datetime.fromtimestamp(t).isoformat()
+            return s
+
+class Emitter(object):
+    """write records as JSON lines to a stream, e.g. stdout piped to
+    logstash, buffering buffer_records lines per write. Throughput is
+    logged every report_interval seconds and when the emitter is flushed
+    at the end of a cycle."""
+
+    def __init__(self, stream=None, buffer_records=1000, report_interval=30):
+        self.stream = stream or sys.stdout
+        self.buffer_records = buffer_records
+        self.report_interval = report_interval
+        self.buffer = []
+        self.reset()
+
+    def reset(self):
+        """start counting a new cycle"""
+        self.records = 0
+        self.bytes = 0
+        self.start = time.time()
+        self.last_report = self.start
+
+    def write(self, record):
+        self.buffer.append(dumps(record))
+        self.records += 1
+        if len(self.buffer) >= self.buffer_records:
+            self._write()
+            if time.time()-self.last_report >= self.report_interval:
+                self.report()
+
+    def _write(self):
+        if len(self.buffer) == 0:
+            return
+        data = "\n".join(self.buffer)+"\n"
+        self.buffer = []
+        self.stream.write(data)
+        self.bytes += len(data)
+
+    def flush(self):
+        """write out buffered records and report throughput for the cycle"""
+        self._write()
+        self.stream.flush()
+        self.report()
+
+    def report(self):
+        now = time.time()
+        self.last_report = now
+        duration = now-self.start
+        rate = self.records/duration if duration > 0 else 0
+        logger.info("emitted {0} records ({1} MB) in {2:.1f}s, {3:.0f} records/s".format(
+            self.records, self.bytes/1024/1024, duration, rate))
@@ -0,0 +1,169 @@
+#!/usr/bin/python
+import logging
+import json
+import threading
+import time
+import urllib2
+import Queue
+
+from emitter import dumps
+
+logger = logging.getLogger(__name__)
+
+# item statuses worth retrying: rejected by a busy node, or a node failure
+RETRY_STATUS = [429, 500, 502, 503, 504]
+
+class BulkIndexer(object):
+    """upsert records into an Elasticsearch index by id_field with _bulk
+    requests, as the logstash elasticsearch output did with doc_as_upsert.
+
+    Records are batched up to batch_size records or max_bytes, whichever
+    comes first, and sent by workers threads, spread round-robin over
+    hosts. Only the items a bulk response reports as failed with a
+    retryable status are sent again, up to max_retries times; a request
+    that fails outright is retried as a whole. It has the same write(),
+    flush() and reset() interface as Emitter."""
+
+    def __init__(self, hosts, index, id_field, doc_type=None, batch_size=500,
+            max_bytes=5*1024*1024, workers=4, max_retries=3, retry_delay=1, timeout=60):
+        self.urls = []
+        for h in hosts:
+            if not h.startswith("http"):
+                h = "http://"+h
+            self.urls.append(h.rstrip("/")+"/_bulk")
+        self.index = index
+        self.id_field = id_field
+        self.doc_type = doc_type
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.next_url = 0
+        self.batch = []
+        self.batch_bytes = 0
+        # bounded, so a slow cluster slows down the query rather than
+        # piling up batches in memory
+        self.queue = Queue.Queue(workers*2)
+        self.workers = []
+        for i in xrange(workers):
+            t = threading.Thread(target=self._run, name="bulk-{0}".format(i))
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+        self.reset()
+
+    def reset(self):
+        """start counting a new cycle"""
+        with self.lock:
+            self.records = 0
+            self.indexed = 0
+            self.failed = 0
+            self.retried = 0
+            self.requests = 0
+            self.bytes = 0
+            self.start = time.time()
+
+    def write(self, record):
+        meta = {"_index": self.index, "_id": record[self.id_field]}
+        if self.doc_type is not None:
+            meta["_type"] = self.doc_type
+        item = dumps({"update": meta})+"\n"+dumps({"doc": record, "doc_as_upsert": True})+"\n"
+        if self.batch and self.batch_bytes+len(item) > self.max_bytes:
+            self._submit()
+        self.batch.append(item)
+        self.batch_bytes += len(item)
+        self.records += 1
+        if len(self.batch) >= self.batch_size:
+            self._submit()
+
+    def _submit(self):
+        self.queue.put(self.batch)
+        self.batch = []
+        self.batch_bytes = 0
+
+    def flush(self):
+        """send any partial batch, wait for all batches to be sent and
+        report the results for the cycle"""
+        if self.batch:
+            self._submit()
+        self.queue.join()
+        duration = time.time()-self.start
+        rate = self.records/duration if duration > 0 else 0
+        logger.info("indexed {0} of {1} records in {2:.1f}s ({3:.0f} records/s), {4} failed, {5} retried, {6} bulk requests, {7} MB".format(
+            self.indexed, self.records, duration, rate, self.failed, self.retried,
+            self.requests, self.bytes/1024/1024))
+
+    def _run(self):
+        while True:
+            items = self.queue.get()
+            try:
+                self._send(items)
+            except Exception as e:
+                logger.error("dropping bulk batch of {0} records: {1}".format(len(items), e))
+                with self.lock:
+                    self.failed += len(items)
+            finally:
+                self.queue.task_done()
+
+    def _post(self, body):
+        with self.lock:
+            url = self.urls[self.next_url]
+            self.next_url = (self.next_url+1)%len(self.urls)
+            self.requests += 1
+            self.bytes += len(body)
+        req = urllib2.Request(url, body, {"Content-Type": "application/x-ndjson"})
+        return json.loads(urllib2.urlopen(req, timeout=self.timeout).read())
+
+    def _send(self, items):
+        attempt = 0
+        while True:
+            try:
+                response = self._post("".join(items))
+            except (urllib2.URLError, IOError, ValueError) as e:
+                status = getattr(e, "code", None)
+                if status is not None and status not in RETRY_STATUS:
+                    raise
+                retry = items
+                logger.warning("bulk request of {0} records failed: {1}".format(len(items), e))
+                ok = 0
+            else:
+                retry = []
+                ok = 0
+                failed = 0
+                error = None
+                results = response.get("items", [])
+                if len(results) != len(items):
+                    # can't tell which records the results belong to
+                    unmatched = len(items)-min(len(results), len(items))
+                    logger.error("bulk response has {0} results for {1} records, "
+                            "counting {2} as failed".format(len(results), len(items), unmatched))
+                    failed += unmatched
+                for item, result in zip(items, results):
+                    status = result.values()[0].get("status", 500)
+                    if status < 300:
+                        ok += 1
+                    elif status in RETRY_STATUS:
+                        retry.append(item)
+                    else:
+                        failed += 1
+                        error = result.values()[0].get("error")
+                if failed > 0:
+                    logger.error("{0} records rejected by elasticsearch, e.g. {1}".format(failed, error))
+                with self.lock:
+                    self.failed += failed
+            with self.lock:
+                self.indexed += ok
+            if not retry:
+                return
+            attempt += 1
+            if attempt > self.max_retries:
+                logger.error("giving up on {0} records after {1} retries".format(len(retry), self.max_retries))
+                with self.lock:
+                    self.failed += len(retry)
+                return
+            with self.lock:
+                self.retried += len(retry)
+            time.sleep(self.retry_delay*2**(attempt-1))
+            items = retry
@@ -5,6 +5,7 @@ import cPickle
 import struct
 import socket
 import sys
+import threading
 
 logger = logging.getLogger(__name__)
 
@@ -19,12 +20,159 @@ def sanitize_key(key):
         key = key.replace(old, new)
     return key
 
+def parse_endpoints(endpoints, default_port=2004):
+    """parse comma-separated host[:port] list into [(host,port),...]"""
+    r = []
+    if endpoints is None:
+        return r
+    for e in endpoints.split(","):
+        e = e.strip()
+        if e == "":
+            continue
+        if ":" in e:
+            host,port = e.rsplit(":",1)
+            r.append((host,int(port)))
+        else:
+            r.append((e,default_port))
+    return r
+
 class Graphite(object):
-    def __init__(self,host="localhost",pickle_port=2004):
+    """send metrics to one or more carbon pickle listeners.
+
+    Connections are kept open between sends. A connection that fails is
+    retried once right away, then the endpoint is backed off exponentially
+    (up to max_backoff seconds) while batches go to the other endpoints.
+
+    If a spool is given, batches that can't be sent anywhere are written
+    to it and replayed, oldest first, before any new data once a send
+    succeeds again.
+
+    It can be shared between threads; sends are serialized."""
+
+    def __init__(self,host="localhost",pickle_port=2004,batch_size=1000,
+            timeout=30,relays=None,max_backoff=300,spool=None):
         self.graphite_host = host
         self.graphite_pickle_port = pickle_port
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self.endpoints = [(host,pickle_port)]
+        for e in relays or []:
+            if e not in self.endpoints:
+                self.endpoints.append(e)
+        self.sockets = {}
+        self.failures = dict((e,0) for e in self.endpoints)
+        self.retry_at = dict((e,0) for e in self.endpoints)
+        self.next_endpoint = 0
+        self.spool = spool
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {
+                "sends": 0,
+                "send_errors": 0,
+                "send_time": 0.0,
+                "send_time_max": 0.0,
+                "metrics": 0,
+                "bytes": 0,
+                "spooled": 0,
+                "replayed": 0,
+        }
+
+    def get_stats(self):
+        """return send statistics since the last call, e.g. for the probe meta namespace"""
+        with self.lock:
+            stats = self.stats
+            self.reset_stats()
+        if stats["sends"] > 0:
+            stats["send_time_avg"] = stats["send_time"]/stats["sends"]
+        if self.spool is not None:
+            stats.update(self.spool.get_stats())
+        return stats
+
+    def close(self):
+        for endpoint in self.sockets.keys():
+            self._disconnect(endpoint)
+
+    def _disconnect(self, endpoint):
+        s = self.sockets.pop(endpoint, None)
+        if s is not None:
+            try:
+                s.close()
+            except socket.error:
+                pass
+
+    def _connect(self, endpoint):
+        if endpoint not in self.sockets:
+            s = socket.create_connection(endpoint, self.timeout)
+            self.sockets[endpoint] = s
+        return self.sockets[endpoint]
+
+    def _available(self):
+        """endpoints not in backoff, starting from the next in round-robin order"""
+        now = time.time()
+        n = len(self.endpoints)
+        order = [self.endpoints[(self.next_endpoint+i)%n] for i in xrange(n)]
+        self.next_endpoint = (self.next_endpoint+1)%n
+        return [e for e in order if self.retry_at[e] <= now]
+
+    def _send_to(self, endpoint, message):
+        # a persistent connection may have been dropped by the relay since
+        # the last send, so reconnect and try once more before giving up
+        for attempt in xrange(2):
+            try:
+                self._connect(endpoint).sendall(message)
+            except (socket.error, socket.timeout) as e:
+                self._disconnect(endpoint)
+                error = e
+            else:
+                self.failures[endpoint] = 0
+                return True
+        self.failures[endpoint] += 1
+        backoff = min(2**self.failures[endpoint], self.max_backoff)
+        self.retry_at[endpoint] = time.time()+backoff
+        logger.error("unable to send data to graphite at %s:%d (%s), backing off %ds" %
+                (endpoint[0],endpoint[1],error,backoff))
+        return False
+
+    def send_message(self, message):
+        """send one framed pickle message, trying each available endpoint
+        in turn. Returns True if it was sent."""
+        start = time.time()
+        sent = False
+        for endpoint in self._available():
+            if self._send_to(endpoint, message):
+                sent = True
+                break
+        duration = time.time()-start
+        self.stats["sends"] += 1
+        self.stats["send_time"] += duration
+        self.stats["send_time_max"] = max(self.stats["send_time_max"], duration)
+        if sent:
+            self.stats["bytes"] += len(message)
+        else:
+            self.stats["send_errors"] += 1
+            logger.error("unable to send data to any graphite endpoint")
+        return sent
+
+    def send_or_spool(self, message):
+        """send message, spooling it if it can't be sent or if older
+        spooled data is still waiting. Returns True if it was sent."""
+        if self.spool is not None and not self.spool.empty():
+            self.stats["replayed"] += self.spool.replay(self.send_message)
+            if not self.spool.empty():
+                self.spool.append(message)
+                self.stats["spooled"] += 1
+                return False
+        if self.send_message(message):
+            return True
+        if self.spool is not None:
+            self.spool.append(message)
+            self.stats["spooled"] += 1
+        return False
 
-    def send_dict(self,namespace, data, send_data=True, timestamp=None, batch_size=1000):
+    def send_dict(self,namespace, data, send_data=True, timestamp=None, batch_size=None):
         """send data contained in dictionary as {k: v} to graphite dataset
         $namespace.k with current timestamp"""
         if data is None:
@@ -32,27 +180,25 @@ class Graphite(object):
             return
         if timestamp is None:
             timestamp=time.time()
+        if batch_size is None:
+            batch_size=self.batch_size
         post_data=[]
         # turning data dict into [('$path.$key',($timestamp,$value)),...]]
         for k,v in data.iteritems():
             t = (namespace+"."+k, (timestamp, v))
             post_data.append(t)
             logger.debug(str(t))
-        for i in xrange(len(post_data)//batch_size + 1):
+        for i in xrange(0, len(post_data), batch_size):
+            batch = post_data[i:i+batch_size]
             # pickle data
-            payload = cPickle.dumps(post_data[i*batch_size:(i+1)*batch_size], protocol=2)
+            payload = cPickle.dumps(batch, protocol=2)
             header = struct.pack("!L", len(payload))
             message = header + payload
             # throw data at graphite
             if send_data:
-                s=socket.socket()
-                try:
-                    s.connect( (self.graphite_host, self.graphite_pickle_port) )
-                    s.sendall(message)
-                except socket.error as e:
-                    logger.error("unable to send data to graphite at %s:%d\n" % (self.graphite_host,self.graphite_pickle_port))
-                finally:
-                    s.close()
+                with self.lock:
+                    if self.send_or_spool(message):
+                        self.stats["metrics"] += len(batch)
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
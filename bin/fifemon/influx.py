@@ -1,20 +1,61 @@
 #!/usr/bin/python
 import logging
+import math
 import os
+import threading
+import time
 
 from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError
 
 logger = logging.getLogger(__name__)
 
+def to_utf8(value):
+    """value as a byte string, UTF-8 encoded if it is unicode"""
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return str(value)
+
+def escape_measurement(measurement):
+    """escape a measurement name for line protocol"""
+    return to_utf8(measurement).replace(",","\\,").replace(" ","\\ ")
+
+def escape_key(key):
+    """escape a tag key, tag value or field key for line protocol"""
+    return to_utf8(key).replace(",","\\,").replace("=","\\=").replace(" ","\\ ")
+
+def format_value(value):
+    """format a field value for line protocol, keeping python's int/float
+    distinction as the JSON API did. Returns None for nan and inf, which
+    line protocol has no way to write."""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (int, long)):
+        return "%di" % value
+    if isinstance(value, float):
+        if math.isinf(value) or math.isnan(value):
+            return None
+        return repr(value)
+    return '"%s"' % to_utf8(value).replace("\\","\\\\").replace('"','\\"')
+
 class Influxdb(object):
-    def __init__(self, host="localhost", port=8086, db="test", username=None, password=None):
+    def __init__(self, host="localhost", port=8086, db="test", username=None, password=None,
+            spool=None, batch_size=5000):
         self.host = host
         self.port = port
+        self.spool = spool
+        self.batch_size = batch_size
+        # serializes writes and stats, so one client can be shared between threads
+        self.lock = threading.Lock()
+        self.reset_stats()
+        # compiled schemas, see compile_schema()
+        self.schemas = {}
         if username is None:
             username=os.getenv('INFLUXDB_USERNAME')
         if password is None:
             password=os.getenv('INFLUXDB_PASSWORD')
 
+        # the client keeps one HTTP session, so connections are reused
         self.client = InfluxDBClient(host, port, username, password, db)
 
     def send_metric(self, measurement, value, tags={}, timestamp=None, field="value"):
@@ -30,41 +71,145 @@ class Influxdb(object):
     def send_metrics(self, data, tags={}):
         self.client.write_points(data,tags=tags)
 
-    def send_dict(self, data, send_data=True, timestamp=None, schema=None, field="value", tags={}):
+    def reset_stats(self):
+        self.stats = {
+                "writes": 0,
+                "write_errors": 0,
+                "write_time": 0.0,
+                "points": 0,
+                "bytes": 0,
+                "spooled": 0,
+                "replayed": 0,
+        }
+
+    def get_stats(self):
+        """return write statistics since the last call, e.g. for the probe meta namespace"""
+        with self.lock:
+            stats = self.stats
+            self.reset_stats()
+        if self.spool is not None:
+            stats.update(self.spool.get_stats())
+        return stats
+
+    def compile_schema(self, schema):
+        """turn a schema like "daemon.name.measurement" into the number of
+        parts it expects, the index of the measurement and a list of
+        (index, escaped tag key) for the tags; "_" parts are ignored"""
+        if schema not in self.schemas:
+            schema_parts = schema.split(".")
+            if "measurement" not in schema_parts:
+                raise ValueError("schema '%s' has no measurement" % schema)
+            measurement = None
+            tags = []
+            for i,part in enumerate(schema_parts):
+                if part == "measurement":
+                    measurement = i
+                elif part != "_":
+                    tags.append((i, escape_key(part)))
+            self.schemas[schema] = (len(schema_parts), measurement, tags)
+        return self.schemas[schema]
+
+    def _write_lines(self, lines):
+        start = time.time()
+        self.stats["writes"] += 1
+        try:
+            # the client UTF-8 encodes the joined lines itself
+            payload = "\n".join(lines).decode("utf-8")
+            self.client.write_points([payload], time_precision="s", protocol="line")
+        except:
+            self.stats["write_errors"] += 1
+            raise
+        finally:
+            self.stats["write_time"] += time.time()-start
+        self.stats["points"] += len(lines)
+        self.stats["bytes"] += sum(len(l)+1 for l in lines)
+
+    def _write_payload(self, payload):
+        try:
+            self._write_lines(payload.split("\n"))
+        except InfluxDBClientError as e:
+            # the server rejected the data, retrying won't help
+            logger.error("dropping spooled points rejected by influxdb: %s" % e)
+        except Exception as e:
+            logger.error("unable to send spooled data to influxdb: %s" % e)
+            return False
+        return True
+
+    def write_lines(self, lines):
+        """write a batch of line-protocol points, spooling it if influxdb
+        can't be reached or if older spooled batches are still waiting"""
+        with self.lock:
+            self._write_or_spool(lines)
+
+    def _write_or_spool(self, lines):
+        if self.spool is None:
+            self._write_lines(lines)
+            return
+        if not self.spool.empty():
+            self.stats["replayed"] += self.spool.replay(self._write_payload)
+            if not self.spool.empty():
+                self.spool.append("\n".join(lines))
+                self.stats["spooled"] += 1
+                return
+        try:
+            self._write_lines(lines)
+        except InfluxDBClientError:
+            raise
+        except Exception as e:
+            logger.error("unable to send data to influxdb, spooling: %s" % e)
+            self.spool.append("\n".join(lines))
+            self.stats["spooled"] += 1
+
+    def send_dict(self, data, send_data=True, timestamp=None, schema=None, field="value", tags={}, batch_size=None):
         if data is None or len(data) == 0:
             logger.warning("send_dict called with no data")
             return
-        points = []
+        if timestamp is None:
+            timestamp = time.time()
+        if batch_size is None:
+            batch_size = self.batch_size
+        # every point in a cycle shares one timestamp, in seconds
+        suffix = " %s=%%s %d" % (escape_key(field), int(timestamp))
+        global_tags = dict((escape_key(k), escape_key(v)) for k,v in (tags or {}).iteritems())
+        lines = []
         if schema is None:
-            logger.warning("no schema provided, sending complete metric as measurement")
+            logger.debug("no schema provided, sending complete metric as measurement")
+            prefix = "".join(",%s=%s" % kv for kv in sorted(global_tags.iteritems()))
             for k,v in data.iteritems():
-                points.append({
-                    "measurement": k,
-                    "fields": {field: v},
-                    })
+                value = format_value(v)
+                if value is None:
+                    logger.warning("skipping non-finite value of metric '%s'" % k)
+                    continue
+                lines.append(escape_measurement(k)+prefix+suffix % value)
         else:
-            schema_parts = schema.split(".")
-            for k,v in data.iteritems():
-                parts = k.split(".")
-                if len(parts) != len(schema_parts):
+            nparts, measurement, schema_tags = self.compile_schema(schema)
+            if hasattr(data, "iterparts"):
+                # e.g. condor MetricValues, whose keys are already split
+                items = data.iterparts()
+            else:
+                items = ((k.split("."), v) for k,v in data.iteritems())
+            for parts,v in items:
+                value = format_value(v)
+                if value is None:
+                    logger.warning("skipping non-finite value of metric '%s'" % ".".join(parts))
+                    continue
+                if len(parts) != nparts:
                     logger.error("metric '{metric}' does not match schema '{schema}', skipping".format(
-                        metric=k,
+                        metric=".".join(parts),
                         schema=schema))
-                point = {
-                        "measurement": None,
-                        "tags": {},
-                        "fields": {field: v},
-                        }
-                for i in xrange(len(parts)):
-                    if schema_parts[i] == "measurement":
-                        point["measurement"] = parts[i]
-                    elif schema_parts[i] != "_":
-                        point["tags"][schema_parts[i]] = parts[i]
-                logger.debug("sending point %s"%point)
-                points.append(point)
-        logger.debug("sending points with tags %s"%tags)
+                    continue
+                point_tags = dict(global_tags)
+                for i,tag in schema_tags:
+                    # line protocol has no empty tag values
+                    if parts[i] != "":
+                        point_tags[tag] = escape_key(parts[i])
+                line = escape_measurement(parts[measurement])
+                line += "".join(",%s=%s" % kv for kv in sorted(point_tags.iteritems()))
+                lines.append(line+suffix % value)
+        logger.debug("sending %d points with tags %s" % (len(lines), tags))
         if send_data:
-            self.client.write_points(points,tags=tags)
+            for i in xrange(0, len(lines), batch_size):
+                self.write_lines(lines[i:i+batch_size])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,29 @@
+#!/usr/bin/python
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+class Instruments(dict):
+    """per-cycle probe statistics, e.g. stage timings and ad counts, that
+    are published to the meta namespace. It's a plain dict of metric name
+    to value, plus thread-safe helpers to time code and count things."""
+
+    def __init__(self, *args, **kwargs):
+        super(Instruments, self).__init__(*args, **kwargs)
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, name):
+        """add the wall time of the with-block to name"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.count(name, time.time()-start)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self[name] = self.get(name, 0)+n
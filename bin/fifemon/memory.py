@@ -0,0 +1,29 @@
+#!/usr/bin/python
+import logging
+import resource
+
+logger = logging.getLogger(__name__)
+
+def reset_peak_rss():
+    """reset the process peak RSS, where the kernel allows it (Linux 4.0+),
+    so peak_rss() reports the high-water mark from now on. Returns True if
+    the peak was reset."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except (IOError, OSError):
+        return False
+    return True
+
+def peak_rss():
+    """process peak RSS in bytes, since the last reset_peak_rss() if that
+    worked, otherwise since the process started"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])*1024
+    except (IOError, OSError, ValueError):
+        pass
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
@@ -1,12 +1,25 @@
 #!/usr/bin/python
 import logging
+import os
 import time
 
+from instrument import Instruments
+from memory import reset_peak_rss, peak_rss
+
 logger = logging.getLogger(__name__)
 
+def align(t, interval):
+    """start of the interval-long slot of wall-clock time that t falls in"""
+    return t - t % interval
+
 class Probe(object):
     def __init__(self, *args, **kwargs):
         self.interval = kwargs.pop('interval', 240)
+        self.overrun_policy = kwargs.pop('overrun_policy', 'skip')
+        if self.overrun_policy not in ['skip', 'coalesce']:
+            raise ValueError("unknown overrun policy '%s'" % self.overrun_policy)
+        # last interval slot each sub-collector ran in, see due()
+        self.last_due = {}
         self.retries = kwargs.pop('retries', 10)
         self.delay = kwargs.pop('delay', 30)
         self.test = kwargs.pop('test',True)
@@ -15,6 +28,9 @@ class Probe(object):
         self.use_graphite = kwargs.pop('use_graphite',True)
         self.graphite_host = kwargs.pop('graphite_host','localhost')
         self.graphite_pickle_port = kwargs.pop('graphite_pickle_port',2004)
+        self.graphite_relays = kwargs.pop('graphite_relays',[])
+        self.graphite_batch_size = kwargs.pop('graphite_batch_size',1000)
+        self.graphite_timeout = kwargs.pop('graphite_timeout',30)
         self.namespace = kwargs.pop('namespace', 'test')
         self.meta_namespace = kwargs.pop('meta_namespace', 'probes.test')
 
@@ -23,6 +39,18 @@ class Probe(object):
         self.influxdb_port = kwargs.pop('influxdb_port',8086)
         self.influxdb_db = kwargs.pop('influxdb_db','test')
         self.influxdb_tags = kwargs.pop('influxdb_tags',{})
+        self.influxdb_batch_size = kwargs.pop('influxdb_batch_size',5000)
+
+        self.async_send = kwargs.pop('async_send',False)
+        self.send_queue_size = kwargs.pop('send_queue_size',100)
+        self.send_queue_overflow = kwargs.pop('send_queue_overflow','drop')
+        self.spool_dir = kwargs.pop('spool_dir','spool')
+        self.drain_timeout = kwargs.pop('drain_timeout',60)
+        self.meta_data = Instruments()
+        self.cycle_time = None
+        self.spool_failed = kwargs.pop('spool_failed',False)
+        self.spool_max_mb = kwargs.pop('spool_max_mb',1024)
+        self.spool_max_age = kwargs.pop('spool_max_age',86400)
 
         if self.test:
             logger.setLevel(logging.DEBUG)
@@ -31,10 +59,43 @@ class Probe(object):
 
         if self.use_graphite:
             from graphite import Graphite
-            self.graphite = Graphite(self.graphite_host, self.graphite_pickle_port)
+            self.graphite = Graphite(self.graphite_host, self.graphite_pickle_port,
+                    batch_size=self.graphite_batch_size,
+                    timeout=self.graphite_timeout,
+                    relays=self.graphite_relays,
+                    spool=self.make_spool("graphite", "failed"))
         if self.use_influxdb:
             from influx import Influxdb
-            self.influxdb = Influxdb(self.influxdb_host, self.influxdb_port, self.influxdb_db)
+            self.influxdb = Influxdb(self.influxdb_host, self.influxdb_port, self.influxdb_db,
+                    spool=self.make_spool("influxdb", "failed"),
+                    batch_size=self.influxdb_batch_size)
+
+        if self.async_send:
+            if self.use_graphite:
+                self.graphite = self.make_sender(self.graphite, "graphite")
+            if self.use_influxdb:
+                self.influxdb = self.make_sender(self.influxdb, "influxdb")
+
+    def make_spool(self, name, kind):
+        """disk spool for backend name, if enabled. kind is "failed" for
+        sends that didn't go through or "overflow" for a full send queue."""
+        if kind == "failed" and not self.spool_failed:
+            return None
+        if kind == "overflow" and self.send_queue_overflow != "spill":
+            return None
+        from spool import Spool
+        return Spool(os.path.join(self.spool_dir, name, kind),
+                max_bytes=self.spool_max_mb*1024*1024,
+                max_age=self.spool_max_age)
+
+    def make_sender(self, backend, name):
+        """wrap backend so sends happen on a background thread"""
+        from sender import AsyncSender
+        spool = self.make_spool(name, "overflow")
+        return AsyncSender(backend, name,
+                max_queue=self.send_queue_size,
+                overflow=self.send_queue_overflow,
+                spool=spool)
 
     def __unicode__(self):
         return """
@@ -76,24 +137,96 @@ influxdb_db:    %d
     def post(self):
         pass
 
+    def due(self, name, interval=None):
+        """whether sub-collector name, which should run every interval
+        seconds, is due this cycle. It runs in the first cycle in each
+        wall-clock-aligned slot of its interval; with no interval, or one
+        no longer than the probe's, it runs every cycle."""
+        if interval is None or interval <= self.interval:
+            return True
+        slot = int(self.cycle_time // interval)
+        if self.last_due.get(name) == slot:
+            return False
+        self.last_due[name] = slot
+        return True
+
+    def close(self):
+        """flush any queued data to the backends"""
+        for backend in ["graphite", "influxdb"]:
+            sender = getattr(self, backend, None)
+            if hasattr(sender, "get_queue_stats"):
+                logger.info("({0}) draining {1} send queue".format(self.namespace, backend))
+                sender.close(self.drain_timeout)
+
     def run(self):
+        try:
+            self.loop()
+        finally:
+            self.close()
+
+    def loop(self):
+        # cycles start on wall-clock multiples of the interval, so points
+        # line up with the retention buckets downstream
+        scheduled = align(time.time(), self.interval)
         while True:
             start = time.time()
+            # one timestamp for everything sent this cycle: its scheduled
+            # start, even if it started late
+            self.cycle_time = scheduled
+            # post() adds its own timings and counts to meta_data
+            self.meta_data = Instruments()
+            # stages may run concurrently, so the peak RSS is only reset
+            # here, once per cycle, and every peak_rss_b is since then
+            reset_peak_rss()
             self.post()
-            duration = time.time()-start
+            end = time.time()
+            duration = end-start
             logger.info("({0}) posted data in {1} s".format(self.namespace, duration))
-            meta_data = {
-                    "update_time": duration,
-                    }
+
+            next_run = scheduled+self.interval
+            overruns = 0
+            if end >= next_run:
+                overruns = int((end-next_run)//self.interval)+1
+                if self.overrun_policy == "coalesce":
+                    # run once, right away, for all the missed cycles
+                    next_run = align(end, self.interval)
+                else:
+                    next_run = align(end, self.interval)+self.interval
+                logger.warning("({0}) cycle took {1} s, overran {2} interval(s), {3}".format(
+                    self.namespace, duration, overruns,
+                    "coalescing" if self.overrun_policy == "coalesce" else "skipping"))
+
+            meta_data = dict(self.meta_data)
+            meta_data["update_time"] = duration
+            meta_data["overruns"] = overruns
+            meta_data["start_delay"] = start-scheduled
+            meta_data["peak_rss_b"] = peak_rss()
+            for backend in ["graphite", "influxdb"]:
+                sender = getattr(self, backend, None)
+                if hasattr(sender, "get_queue_stats"):
+                    for k,v in sender.get_queue_stats().iteritems():
+                        meta_data[backend+"."+k] = v
+            if self.use_influxdb:
+                for k,v in self.influxdb.get_stats().iteritems():
+                    meta_data["influxdb."+k] = v
             if self.use_graphite:
-                self.graphite.send_dict(self.meta_namespace, meta_data, send_data = (not self.test))
+                for k,v in self.graphite.get_stats().iteritems():
+                    meta_data["graphite."+k] = v
+                self.graphite.send_dict(self.meta_namespace, meta_data, send_data = (not self.test),
+                        timestamp=self.cycle_time)
             if self.use_influxdb:
-                pass
-            sleep = max(self.interval-duration-10,0)
-            logger.info("({0}) sleeping {1} s".format(self.namespace,sleep))
+                # meta metrics don't follow a schema, send each as its own
+                # measurement tagged with the meta namespace
+                tags = dict(self.influxdb_tags or {})
+                tags["probe"] = self.meta_namespace
+                self.influxdb.send_dict(meta_data, send_data=(not self.test),
+                        timestamp=self.cycle_time, tags=tags)
             if self.test or self.once:
                 return
+            sleep = max(next_run-time.time(),0)
+            logger.info("({0}) sleeping {1} s".format(self.namespace,sleep))
             time.sleep(sleep)
+            scheduled = next_run
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
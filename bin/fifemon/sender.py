@@ -0,0 +1,110 @@
+#!/usr/bin/python
+import logging
+import threading
+import time
+import cPickle
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+class AsyncSender(object):
+    """hand send_dict calls off to a backend (Graphite, Influxdb) on a
+    dedicated thread, so a slow or down backend doesn't block the probe.
+
+    Calls wait in a bounded in-memory queue. When the queue is full the
+    oldest call is either dropped (overflow="drop") or written to the
+    spool (overflow="spill") and replayed once the queue has drained.
+    Any other attribute is passed through to the backend."""
+
+    def __init__(self, backend, name, max_queue=100, overflow="drop", spool=None):
+        if overflow not in ["drop", "spill"]:
+            raise ValueError("unknown queue overflow policy '%s'" % overflow)
+        if overflow == "spill" and spool is None:
+            raise ValueError("overflow=spill requires a spool")
+        self.backend = backend
+        self.name = name
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.spool = spool
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.closing = False
+        self.dropped = 0
+        self.spilled = 0
+        self.thread = threading.Thread(target=self._run, name="sender-"+name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __getattr__(self, attr):
+        return getattr(self.backend, attr)
+
+    def send_dict(self, *args, **kwargs):
+        # stamp the data now, not whenever the sender gets to it
+        if kwargs.get("timestamp") is None:
+            kwargs["timestamp"] = time.time()
+        self.put(("send_dict", args, kwargs))
+
+    def put(self, call):
+        with self.cond:
+            if len(self.queue) >= self.max_queue:
+                oldest = self.queue.popleft()
+                if self.overflow == "spill":
+                    try:
+                        self.spool.append(cPickle.dumps(oldest, protocol=2))
+                        self.spilled += 1
+                    except Exception as e:
+                        logger.error("(%s) unable to spool data, dropping: %s" % (self.name, e))
+                        self.dropped += 1
+                else:
+                    self.dropped += 1
+                    logger.warning("(%s) send queue full, dropped oldest data" % self.name)
+            self.queue.append(call)
+            self.cond.notify()
+
+    def get_queue_stats(self):
+        with self.cond:
+            stats = {
+                    "queue_length": len(self.queue),
+                    "queue_dropped": self.dropped,
+                    "queue_spilled": self.spilled,
+            }
+            self.dropped = 0
+            self.spilled = 0
+        return stats
+
+    def _next(self):
+        with self.cond:
+            while len(self.queue) == 0:
+                if self.spool is not None:
+                    payload = self.spool.pop()
+                    if payload is not None:
+                        return cPickle.loads(payload)
+                if self.closing:
+                    return None
+                self.cond.wait(1.0)
+            return self.queue.popleft()
+
+    def _run(self):
+        while True:
+            call = self._next()
+            if call is None:
+                return
+            method, args, kwargs = call
+            try:
+                getattr(self.backend, method)(*args, **kwargs)
+            except Exception as e:
+                logger.error("(%s) error sending data: %s" % (self.name, e))
+
+    def close(self, timeout=None):
+        """stop accepting work and wait (up to timeout seconds) for the
+        queue to drain. Returns True if everything was sent."""
+        with self.cond:
+            self.closing = True
+            self.cond.notify()
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            logger.warning("(%s) gave up waiting for %d queued sends" % (self.name, len(self.queue)))
+            return False
+        if hasattr(self.backend, "close"):
+            self.backend.close()
+        return True
@@ -0,0 +1,194 @@
+#!/usr/bin/python
+import logging
+import os
+import time
+import mmap
+import struct
+import threading
+
+logger = logging.getLogger(__name__)
+
+class Spool(object):
+    """on-disk FIFO of byte payloads, e.g. graphite pickle messages that
+    couldn't be sent.
+
+    Payloads are appended to segment files as (timestamp, length, payload)
+    records; segments are named by creation time so replay is oldest first.
+    Readers memory-map a segment and keep their offset in a .pos file next
+    to it, so a restarted probe resumes where it left off. A segment is
+    deleted once it has been read. The oldest segments are evicted when the
+    spool grows past max_bytes, or when they are older than max_age seconds."""
+
+    record_header = struct.Struct("!dL")
+
+    def __init__(self, path, max_bytes=1024**3, max_age=None, segment_bytes=16*1024**2):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.segment_bytes = segment_bytes
+        self.lock = threading.RLock()
+        self.seq = 0
+        self.writer = None
+        self.writer_name = None
+        self.reader = None
+        self.reader_name = None
+        self.evicted = 0
+        self.positions = {}
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _segments(self):
+        return sorted(f for f in os.listdir(self.path) if f.endswith(".seg"))
+
+    def _filename(self, name):
+        return os.path.join(self.path, name)
+
+    def _get_pos(self, name):
+        if name not in self.positions:
+            try:
+                with open(self._filename(name)+".pos") as f:
+                    self.positions[name] = int(f.read())
+            except (IOError, ValueError):
+                self.positions[name] = 0
+        return self.positions[name]
+
+    def _set_pos(self, name, pos):
+        tmp = self._filename("."+name+".pos")
+        with open(tmp, "w") as f:
+            f.write(str(pos))
+        os.rename(tmp, self._filename(name)+".pos")
+        self.positions[name] = pos
+
+    def _close_writer(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.writer = None
+        self.writer_name = None
+
+    def _close_reader(self):
+        if self.reader is not None:
+            self.reader.close()
+        self.reader = None
+        self.reader_name = None
+
+    def _remove(self, name):
+        if name == self.writer_name:
+            self._close_writer()
+        if name == self.reader_name:
+            self._close_reader()
+        self.positions.pop(name, None)
+        for filename in [self._filename(name), self._filename(name)+".pos"]:
+            if os.path.exists(filename):
+                os.unlink(filename)
+
+    def _pending(self, name):
+        try:
+            return os.path.getsize(self._filename(name))-self._get_pos(name)
+        except OSError:
+            return 0
+
+    def _evict(self):
+        segments = self._segments()
+        if self.max_age is not None:
+            cutoff = time.time()-self.max_age
+            for name in list(segments):
+                if os.path.getmtime(self._filename(name)) < cutoff:
+                    logger.warning("evicting spool segment %s older than %ds" % (name, self.max_age))
+                    self.evicted += self._pending(name)
+                    self._remove(name)
+                    segments.remove(name)
+        total = sum(self._pending(name) for name in segments)
+        while total > self.max_bytes and len(segments) > 0:
+            name = segments.pop(0)
+            pending = self._pending(name)
+            logger.warning("spool %s over %d bytes, evicting segment %s" % (self.path, self.max_bytes, name))
+            self.evicted += pending
+            total -= pending
+            self._remove(name)
+
+    def append(self, payload, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            if self.writer is not None and self.writer.tell() >= self.segment_bytes:
+                self._close_writer()
+            if self.writer is None:
+                self.seq += 1
+                self.writer_name = "%017.6f-%06d.seg" % (time.time(), self.seq%1000000)
+                self.writer = open(self._filename(self.writer_name), "ab")
+            self.writer.write(self.record_header.pack(timestamp, len(payload)))
+            self.writer.write(payload)
+            self.writer.flush()
+            self._evict()
+
+    def _read(self, name, pos):
+        """return (timestamp, payload, next_pos) of the record at pos in
+        segment name, or None at the end of the segment"""
+        size = os.path.getsize(self._filename(name))
+        if size <= pos:
+            return None
+        if self.reader_name != name or len(self.reader) < size:
+            self._close_reader()
+            with open(self._filename(name), "rb") as f:
+                self.reader = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.reader_name = name
+        end = pos+self.record_header.size
+        if end > size:
+            return None
+        timestamp, length = self.record_header.unpack(self.reader[pos:end])
+        if end+length > size:
+            # partly-written record, e.g. from a crash mid-append
+            return None
+        return timestamp, self.reader[end:end+length], end+length
+
+    def _next(self):
+        """return (segment, timestamp, payload, next_pos) for the oldest
+        unread record, removing fully-read segments along the way"""
+        for name in self._segments():
+            record = self._read(name, self._get_pos(name))
+            if record is not None:
+                timestamp, payload, next_pos = record
+                return name, timestamp, payload, next_pos
+            self._remove(name)
+        return None
+
+    def empty(self):
+        with self.lock:
+            return self._next() is None
+
+    def pop(self):
+        """remove and return the oldest payload, or None if the spool is empty"""
+        with self.lock:
+            record = self._next()
+            if record is None:
+                return None
+            name, timestamp, payload, next_pos = record
+            self._set_pos(name, next_pos)
+            return payload
+
+    def replay(self, send):
+        """call send(payload) on payloads oldest first, until the spool is
+        empty or send returns False. Returns the number of payloads sent."""
+        sent = 0
+        with self.lock:
+            while True:
+                record = self._next()
+                if record is None:
+                    break
+                name, timestamp, payload, next_pos = record
+                if not send(payload):
+                    break
+                self._set_pos(name, next_pos)
+                sent += 1
+        if sent > 0:
+            logger.info("replayed %d spooled payloads from %s" % (sent, self.path))
+        return sent
+
+    def get_stats(self):
+        with self.lock:
+            stats = {
+                    "spool_bytes": sum(self._pending(name) for name in self._segments()),
+                    "spool_evicted_bytes": self.evicted,
+            }
+            self.evicted = 0
+        return stats
@@ -0,0 +1,31 @@
+#!/usr/bin/python
+import cPickle
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+def load_state(path, default, what="state"):
+    """the object pickled in path by save_state(), or default if path is
+    None, doesn't exist or can't be read"""
+    if path is None or not os.path.exists(path):
+        return default
+    try:
+        with open(path, "rb") as f:
+            return cPickle.load(f)
+    except Exception as e:
+        logger.error("unable to load {0} from {1}, starting over: {2}".format(what, path, e))
+        return default
+
+def save_state(path, state, what="state"):
+    """pickle state to path, through a temporary file so a crash part way
+    through leaves the last saved state in place"""
+    if path is None:
+        return
+    tmp = path+".tmp"
+    try:
+        with open(tmp, "wb") as f:
+            cPickle.dump(state, f, protocol=2)
+        os.rename(tmp, path)
+    except (IOError, OSError) as e:
+        logger.error("unable to save {0} to {1}: {2}".format(what, path, e))
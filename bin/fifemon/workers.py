@@ -0,0 +1,60 @@
+#!/usr/bin/python
+import logging
+import threading
+import time
+import Queue
+
+logger = logging.getLogger(__name__)
+
+def parallel_map(func, items, max_workers=8, timeout=None, name=str):
+    """call func(item) for each item on at most max_workers threads.
+
+    Returns a list of (item, result) tuples, in completion order, for the
+    items that finished. Items that raise, or that run longer than timeout
+    seconds, are logged and left out of the results; a timed-out worker is
+    abandoned (it can't be killed) and its slot is handed to the next item."""
+    items = list(items)
+    if len(items) == 0:
+        return []
+    max_workers = max(1, min(max_workers, len(items)))
+    done = Queue.Queue()
+
+    def work(idx, item):
+        try:
+            done.put((idx, True, func(item)))
+        except Exception as e:
+            done.put((idx, False, e))
+
+    results = []
+    pending = list(enumerate(items))
+    pending.reverse()
+    running = {}
+    while pending or running:
+        while pending and len(running) < max_workers:
+            idx, item = pending.pop()
+            t = threading.Thread(target=work, args=(idx, item),
+                    name="worker-{0}".format(name(item)))
+            t.daemon = True
+            running[idx] = time.time()
+            t.start()
+        wait = 1.0
+        if timeout is not None:
+            wait = max(min(wait, min(running.values())+timeout-time.time()), 0.01)
+        try:
+            idx, ok, value = done.get(timeout=wait)
+        except Queue.Empty:
+            pass
+        else:
+            # late results from abandoned workers are dropped
+            if running.pop(idx, None) is not None:
+                if ok:
+                    results.append((items[idx], value))
+                else:
+                    logger.error("worker for {0} failed: {1}".format(name(items[idx]), value))
+        if timeout is not None:
+            now = time.time()
+            for idx, start in running.items():
+                if now-start > timeout:
+                    logger.error("worker for {0} timed out after {1}s, abandoning".format(name(items[idx]), timeout))
+                    del running[idx]
+    return results
@@ -1,6 +1,6 @@
 #!/usr/bin/python
 import logging
-import json
+import sys
 import datetime
 import time
 import urllib2
@@ -9,13 +9,54 @@ from optparse import OptionParser
 import classad
 import htcondor
 
+from fifemon.memory import reset_peak_rss, peak_rss
+from fifemon.emitter import Emitter, IsoTimes
+from fifemon.esbulk import BulkIndexer
+from fifemon.delta import DeltaFilter
+
 logger = logging.getLogger(__name__)
 
+# job attributes reported besides the basic job state
+default_extra_stats = [
+    "Owner","JobSub_Group","AccountingGroup","JobsubClientKerberosPrincipal",
+    "DESIRED_usage_model","DESIRED_Sites",
+    "NumRestarts","NumJobStarts","RemoteUserCpu",
+    "RequestMemory", "RequestDisk", "RequestCpus",
+    "ResidentSetSize_RAW", "DiskUsage_RAW",
+    "JOB_EXPECTED_MAX_LIFETIME",
+    "HoldReason", "HoldReasonCode", "HoldReasonSubcode",
+    "MATCH_GLIDEIN_Site"]
+
+
+def stream_ads(ads, schedd_name, failed=None):
+    """
+    Yield ads from a streaming schedd query as they arrive. Jobs already
+    processed can't be taken back, so a connection lost part way through
+    is logged rather than retried, and the schedd is added to failed.
+    """
+    cnt = 0
+    it = iter(ads)
+    while True:
+        try:
+            ad = next(it)
+        except StopIteration:
+            break
+        except Exception as e:
+            logger.error("Lost connection to schedd {0} after {1} jobs: {2}".format(schedd_name,cnt,e))
+            if failed is not None:
+                failed.add(schedd_name)
+            break
+        cnt += 1
+        yield ad
+    logger.info("Received {0} jobs from schedd {1}, peak RSS {2} MB".format(cnt,schedd_name,peak_rss()/1024/1024))
 
 class Jobs(object):
     def __init__(self, pool="localhost"):
         self.pool = pool
         self.collector = htcondor.Collector(pool)
+        self.isotime = IsoTimes()
+        # schedds not fully read in the last get_job_stats, None if none were
+        self.failed_schedds = set()
 
     def job_walltime(self, job_classad):
         now = job_classad.get("ServerTime",0)
@@ -24,6 +65,13 @@ class Jobs(object):
 
     def job_cputime(self, job_classad):
         return job_classad.get("RemoteUserCpu",0)
+
+    def queried(self, jobid):
+        """whether the schedd of jobid was fully read in the last get_job_stats"""
+        if self.failed_schedds is None:
+            return False
+        # schedd names can contain "@" too, e.g. schedd_jobs1@jobsub01.fnal.gov
+        return jobid.split("@",1)[1] not in self.failed_schedds
     
     def get_job_stats(self, retry_delay=30, max_retries=4, constraint=True, extra_stats=None):
 
@@ -33,12 +81,18 @@ class Jobs(object):
         if extra_stats:
             stats += extra_stats
 
+        self.failed_schedds = set()
         try:
             ads = self.collector.locateAll(htcondor.DaemonTypes.Schedd)
         except:
             logger.error("Trouble getting pool {0} schedds.".format(self.pool))
+            self.failed_schedds = None
             return
 
+        # one timestamp for every record this cycle
+        now = time.time()
+        timestamp = datetime.datetime.utcfromtimestamp(now).isoformat()
+        isotime = self.isotime
         job_stats={}
         for a in ads:
             logger.info("Querying jobs from schedd %s"%a['Name'])
@@ -46,7 +100,7 @@ class Jobs(object):
             while retries < max_retries:
                 try:
                     schedd = htcondor.Schedd(a)
-                    results = schedd.query(constraint, stats)
+                    results = schedd.xquery(constraint, stats)
                 except:
                     logger.warning("Trouble communicating with schedd {0}, retrying in {1}s.".format(a['Name'],retry_delay))
                     retries += 1
@@ -58,11 +112,13 @@ class Jobs(object):
 
             if results is None:
                 logger.error("Trouble communicating with schedd {0}, giving up.".format(a['Name']))
+                self.failed_schedds.add(a['Name'])
                 continue
 
             logger.info("Processing jobs")
 
-            for r in results:
+            reset_peak_rss()
+            for r in stream_ads(results, a["Name"], self.failed_schedds):
                 if r["JobUniverse"] == 7:
                     # skip dagman jobs
                     continue
@@ -70,23 +126,23 @@ class Jobs(object):
                 jobid="%s.%s@%s"%(r["ClusterId"],r["ProcId"],a["Name"])
 
                 rdict = {
-                        "timestamp":            datetime.datetime.utcnow().isoformat(),
+                        "timestamp":            timestamp,
                         "pool":                 self.pool,
                         "schedd":               a["Name"],
                         "jobid":                jobid,
                         "cluster":              r["ClusterId"],
                         "process":              r["ProcId"],
                         "status":               r["JobStatus"],
-                        "submit_date":          datetime.datetime.fromtimestamp(r["QDate"]).isoformat(),
+                        "submit_date":          isotime(r["QDate"]),
                         }
                 if r["JobStatus"] == 2:
-                    rdict["start_date"] = datetime.datetime.fromtimestamp(r.get("JobCurrentStartDate",time.time())).isoformat()
+                    rdict["start_date"] = isotime(r.get("JobCurrentStartDate",now))
                     rdict["walltime"] = self.job_walltime(r)
                     rdict["cputime"] = self.job_cputime(r)
                     if rdict["walltime"] > 0:
                         rdict["efficiency"] = rdict["cputime"]/rdict["walltime"]
                 elif r["JobStatus"] == 5:
-                    rdict["hold_date"] = datetime.datetime.fromtimestamp(r.get("EnteredCurrentStatus",time.time())).isoformat()
+                    rdict["hold_date"] = isotime(r.get("EnteredCurrentStatus",now))
                 for s in extra_stats:
                     if s in r:
                         rdict[s] = r.eval(s)
@@ -118,6 +174,26 @@ def get_options():
         help="run interval (s)")
     parser.add_option('-1','--once',action="store_true",
         help="run once and exit")
+    parser.add_option('--buffer',type="int",default=1000,
+        help="records to buffer per write to stdout")
+    parser.add_option('--es-hosts',
+        help="upsert records straight into elasticsearch at these comma-separated host[:port]s instead of printing them")
+    parser.add_option('--es-index',default="fifemon-jobs",
+        help="elasticsearch index (default %default)")
+    parser.add_option('--es-batch-size',type="int",default=500,
+        help="records per bulk request (default %default)")
+    parser.add_option('--es-batch-mb',type="float",default=5,
+        help="maximum bulk request size in MB (default %default)")
+    parser.add_option('--es-workers',type="int",default=4,
+        help="concurrent bulk requests (default %default)")
+    parser.add_option('--es-retries',type="int",default=3,
+        help="times to retry records elasticsearch couldn't take (default %default)")
+    parser.add_option('--delta',action="store_true",
+        help="only emit new and changed records, plus a tombstone for each one that's gone")
+    parser.add_option('--full-refresh',type="int",default=3600,
+        help="with --delta, emit all records every this many seconds (default %default)")
+    parser.add_option('--delta-state',
+        help="with --delta, file to keep record fingerprints in across restarts")
     parser.add_option('-d','--debug',action="store_true",
         help="enable debug logging")
     (opts,args) = parser.parse_args()
@@ -131,22 +207,34 @@ if __name__=="__main__":
     logging.basicConfig(level=loglevel,
         format="%(asctime)s [%(levelname)s] %(name)s - %(message)s")
     j=Jobs(opts.pool)
+    if opts.es_hosts:
+        emitter=BulkIndexer(opts.es_hosts.split(","), opts.es_index, "jobid",
+            batch_size=opts.es_batch_size,
+            max_bytes=int(opts.es_batch_mb*1024*1024),
+            workers=opts.es_workers,
+            max_retries=opts.es_retries)
+    else:
+        emitter=Emitter(sys.stdout, buffer_records=opts.buffer)
+    delta=None
+    if opts.delta:
+        delta=DeltaFilter("jobid", full_refresh=opts.full_refresh, state_file=opts.delta_state)
     while True:
         start = time.time()
         logger.info("querying pool %s"%opts.pool)
-        cnt = 0
-        for s in j.get_job_stats(constraint=opts.constraint,extra_stats=[
-            "Owner","JobSub_Group","AccountingGroup","JobsubClientKerberosPrincipal",
-            "DESIRED_usage_model","DESIRED_Sites",
-            "NumRestarts","NumJobStarts","RemoteUserCpu",
-            "RequestMemory", "RequestDisk", "RequestCpus",
-            "ResidentSetSize_RAW", "DiskUsage_RAW",
-            "JOB_EXPECTED_MAX_LIFETIME",
-            "HoldReason", "HoldReasonCode", "HoldReasonSubcode",
-            "MATCH_GLIDEIN_Site"]):
-                cnt += 1
+        emitter.reset()
+        if delta:
+            delta.start()
+        for s in j.get_job_stats(constraint=opts.constraint,extra_stats=default_extra_stats):
                 s=calc_stats(s)
-                print json.dumps(s)
+                if delta is None or delta.changed(s):
+                    emitter.write(s)
+        if delta:
+            # jobs from schedds we couldn't read aren't gone
+            timestamp = datetime.datetime.utcnow().isoformat()
+            for jobid in delta.finish(keep=lambda jobid: not j.queried(jobid)):
+                emitter.write({"jobid": jobid, "pool": opts.pool, "timestamp": timestamp, "tombstone": True})
+        emitter.flush()
+        cnt = emitter.records
         if opts.once:
             break
         end = time.time()
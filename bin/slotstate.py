@@ -1,6 +1,6 @@
 #!/usr/bin/python
 import logging
-import json
+import sys
 import datetime
 import time
 from optparse import OptionParser
@@ -9,6 +9,10 @@ import math
 import classad
 import htcondor
 
+from fifemon.emitter import Emitter, IsoTimes
+from fifemon.esbulk import BulkIndexer
+from fifemon.delta import DeltaFilter
+
 logger = logging.getLogger(__name__)
 
 
@@ -16,6 +20,9 @@ class Slots(object):
     def __init__(self, pool="localhost"):
         self.pool = pool
         self.collector = htcondor.Collector(pool)
+        self.isotime = IsoTimes()
+        # whether the last get_stats got the startd ads
+        self.complete = True
 
     def get_stats(self, retry_delay=30, max_retries=4, constraint=None, extra_stats=None):
 
@@ -32,6 +39,7 @@ class Slots(object):
         else:
             constraint = "is_glidein && (%s)"%constraint
 
+        self.complete = False
         retries=0
         while retries < max_retries:
             try:
@@ -48,11 +56,15 @@ class Slots(object):
             logger.error("Trouble getting pool {0} startds, giving up.".format(self.pool))
             return
 
+        self.complete = True
         logger.info("Processing slots")
 
+        # one timestamp for every record this cycle
+        timestamp = datetime.datetime.utcnow().isoformat()
+        isotime = self.isotime
         for r in ads:
             rdict = {
-                    "timestamp":            datetime.datetime.utcnow().isoformat(),
+                    "timestamp":            timestamp,
                     "pool":                 self.pool,
                     }
             for s in stats:
@@ -61,7 +73,7 @@ class Slots(object):
             ## convert
             for s in ["DaemonStartTime","GLIDEIN_ToDie"]:
                 if s in rdict:
-                    rdict[s] = datetime.datetime.fromtimestamp(rdict[s]).isoformat()
+                    rdict[s] = isotime(rdict[s])
             if "Memory" in rdict:
                 memory = int(rdict["Memory"])*1024*1024
                 rdict["Memory"] = memory
@@ -92,6 +104,26 @@ def get_options():
         help="limit condor query")
     parser.add_option('--interval',default=300,
         help="run interval (s)")
+    parser.add_option('--buffer',type="int",default=1000,
+        help="records to buffer per write to stdout")
+    parser.add_option('--es-hosts',
+        help="upsert records straight into elasticsearch at these comma-separated host[:port]s instead of printing them")
+    parser.add_option('--es-index',default="fifemon-slots",
+        help="elasticsearch index (default %default)")
+    parser.add_option('--es-batch-size',type="int",default=500,
+        help="records per bulk request (default %default)")
+    parser.add_option('--es-batch-mb',type="float",default=5,
+        help="maximum bulk request size in MB (default %default)")
+    parser.add_option('--es-workers',type="int",default=4,
+        help="concurrent bulk requests (default %default)")
+    parser.add_option('--es-retries',type="int",default=3,
+        help="times to retry records elasticsearch couldn't take (default %default)")
+    parser.add_option('--delta',action="store_true",
+        help="only emit new and changed records, plus a tombstone for each one that's gone")
+    parser.add_option('--full-refresh',type="int",default=3600,
+        help="with --delta, emit all records every this many seconds (default %default)")
+    parser.add_option('--delta-state',
+        help="with --delta, file to keep record fingerprints in across restarts")
     parser.add_option('-d','--debug',action="store_true",
         help="enable debug logging")
     parser.add_option('-1','--once',action="store_true",
@@ -107,13 +139,38 @@ if __name__=="__main__":
     logging.basicConfig(level=loglevel,
         format="%(asctime)s [%(levelname)s] %(name)s - %(message)s")
     slots=Slots(opts.pool)
+    if opts.es_hosts:
+        emitter=BulkIndexer(opts.es_hosts.split(","), opts.es_index, "Name",
+            batch_size=opts.es_batch_size,
+            max_bytes=int(opts.es_batch_mb*1024*1024),
+            workers=opts.es_workers,
+            max_retries=opts.es_retries)
+    else:
+        emitter=Emitter(sys.stdout, buffer_records=opts.buffer)
+    delta=None
+    if opts.delta:
+        delta=DeltaFilter("Name", full_refresh=opts.full_refresh, state_file=opts.delta_state)
     while True:
         start = time.time()
         logger.info("querying pool %s"%opts.pool)
-        cnt = 0
+        emitter.reset()
+        if delta:
+            delta.start()
         for s in slots.get_stats(constraint=opts.constraint,extra_stats=["GLIDECLIENT_group"]):
-            cnt += 1
-            print json.dumps(s)
+            if delta is not None:
+                # these change every cycle, so they're left out rather
+                # than sent stale; time_left_hours etc. still are
+                s.pop("MyCurrentTime",None)
+                s.pop("time_left",None)
+            if delta is None or delta.changed(s):
+                emitter.write(s)
+        if delta:
+            # if the query failed the slots aren't gone, we just don't know
+            timestamp = datetime.datetime.utcnow().isoformat()
+            for name in delta.finish(keep=lambda name: not slots.complete):
+                emitter.write({"Name": name, "pool": opts.pool, "timestamp": timestamp, "tombstone": True})
+        emitter.flush()
+        cnt = emitter.records
         end = time.time()
         logger.info("processed %d slots in %ds"%(cnt,end-start))
         if opts.once:
@@ -0,0 +1,420 @@
+#!/usr/bin/python
+import datetime
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+
+import awsmonitor
+
+try:
+    import boto3
+    from botocore.stub import Stubber, ANY
+except ImportError:
+    boto3 = None
+
+END = datetime.datetime(2020, 1, 1, 12, 0, 0)
+START = END-datetime.timedelta(seconds=600)
+
+
+class FakeCloudWatch(object):
+    """answers get_metric_data from {(instance, metric, stat): [values,
+    newest first]}, page_size values of each query per page, like
+    CloudWatch splitting datapoints over pages"""
+
+    def __init__(self, values, page_size=1):
+        self.values = values
+        self.page_size = page_size
+        self.calls = []
+
+    def get_metric_data(self, **kwargs):
+        self.calls.append(kwargs)
+        page = int(kwargs.get("NextToken", 0))
+        start = page*self.page_size
+        results = []
+        more = False
+        for q in kwargs["MetricDataQueries"]:
+            stat = q["MetricStat"]
+            key = (stat["Metric"]["Dimensions"][0]["Value"], stat["Metric"]["MetricName"], stat["Stat"])
+            values = self.values.get(key, [])
+            results.append({"Id": q["Id"], "Values": values[start:start+self.page_size]})
+            more = more or len(values) > start+self.page_size
+        response = {"MetricDataResults": results}
+        if more:
+            response["NextToken"] = str(page+1)
+        return response
+
+
+class GetEc2MetricsTest(unittest.TestCase):
+
+    def test_batches_queries(self):
+        instances = ["i-%03d" % n for n in xrange(200)]
+        cloudwatch = FakeCloudWatch({("i-199", "CPUUtilization", "Average"): [7.0]})
+        r = awsmonitor.get_ec2_metrics(cloudwatch, instances, end_time=END, batch_size=500)
+        self.assertEqual([len(c["MetricDataQueries"]) for c in cloudwatch.calls], [500, 100])
+        ids = [q["Id"] for c in cloudwatch.calls for q in c["MetricDataQueries"]]
+        self.assertEqual(len(set(ids)), 600)
+        for c in cloudwatch.calls:
+            self.assertEqual(c["StartTime"], START)
+            self.assertEqual(c["EndTime"], END)
+            self.assertEqual(c["ScanBy"], "TimestampDescending")
+        self.assertEqual(r["i-199"]["CPUUtilization"], {"avg": 7.0})
+        self.assertEqual(len(r), 1)
+
+    def test_follows_next_token_keeping_newest(self):
+        cloudwatch = FakeCloudWatch({
+            ("i-a", "CPUUtilization", "Average"): [3.0, 2.0, 1.0],
+            ("i-a", "CPUUtilization", "Minimum"): [],
+            ("i-b", "CPUUtilization", "Maximum"): [9.0, 8.0],
+        })
+        r = awsmonitor.get_ec2_metrics(cloudwatch, ["i-a", "i-b"], end_time=END)
+        self.assertEqual([c.get("NextToken") for c in cloudwatch.calls], [None, "1", "2"])
+        self.assertEqual(r["i-a"]["CPUUtilization"], {"avg": 3.0})
+        self.assertEqual(r["i-b"]["CPUUtilization"], {"max": 9.0})
+
+    def test_no_datapoints(self):
+        cloudwatch = FakeCloudWatch({})
+        r = awsmonitor.get_ec2_metrics(cloudwatch, ["i-a"], end_time=END)
+        self.assertEqual(dict(r), {})
+        self.assertEqual(awsmonitor.get_ec2_metrics(cloudwatch, [], end_time=END), {})
+
+    def test_several_metrics(self):
+        cloudwatch = FakeCloudWatch({
+            ("i-a", "CPUUtilization", "Average"): [50.0],
+            ("i-b", "NetworkIn", "Maximum"): [1000.0],
+            ("i-b", "CPUUtilization", "Minimum"): [0.0],
+        })
+        r = awsmonitor.get_ec2_metrics(cloudwatch, ["i-a", "i-b"],
+                metrics=("CPUUtilization", "NetworkIn"), end_time=END)
+        self.assertEqual(len(cloudwatch.calls), 1)
+        queries = cloudwatch.calls[0]["MetricDataQueries"]
+        self.assertEqual(len(queries), 12)
+        self.assertEqual([q["MetricStat"].get("Unit") for q in queries[:6]],
+                ["Percent"]*3+[None]*3)
+        self.assertEqual(r["i-a"], {"CPUUtilization": {"avg": 50.0}})
+        self.assertEqual(r["i-b"], {"CPUUtilization": {"min": 0.0}, "NetworkIn": {"max": 1000.0}})
+
+
+class StreamStatsTest(unittest.TestCase):
+
+    def test_average_over_samples(self):
+        stats = awsmonitor.StreamStats()
+        stats.add({"avg": 10.0, "min": 5.0, "max": 20.0})
+        stats.add({"avg": 0.0, "min": 0.0, "max": 0.0})
+        stats.add({"avg": -4.0, "min": -6.0, "max": -1.0})
+        data = {}
+        stats.finalize("cpu", data)
+        self.assertEqual(data, {"cpu_avg": 2.0, "cpu_min": -6.0, "cpu_max": 20.0})
+
+    def test_missing_values(self):
+        stats = awsmonitor.StreamStats()
+        stats.add({})
+        stats.add({"max": 3.0})
+        stats.add({"avg": 1.0, "min": 2.0})
+        data = {}
+        stats.finalize("cpu", data)
+        # only the instance with an average counts towards it
+        self.assertEqual(data, {"cpu_avg": 1.0, "cpu_min": 2.0, "cpu_max": 3.0})
+
+    def test_empty(self):
+        data = {}
+        awsmonitor.StreamStats().finalize("cpu", data)
+        self.assertEqual(data, {})
+
+
+class GroupStatsTest(unittest.TestCase):
+
+    def test_group(self):
+        group = awsmonitor.GroupStats()
+        group.add({"CPUUtilization": {"avg": 30.0, "min": 20.0, "max": 40.0},
+            "NetworkIn": {"avg": 100.0}})
+        group.add({"CPUUtilization": {"avg": 60.0, "min": 50.0, "max": 70.0}})
+        # running, but no datapoints yet
+        group.add({})
+        data = {}
+        group.finalize("r.az.none.t.k.running", data)
+        self.assertEqual(data, {
+            "r.az.none.t.k.running.count": 3,
+            "r.az.none.t.k.running.cpu_avg": 45.0,
+            "r.az.none.t.k.running.cpu_min": 20.0,
+            "r.az.none.t.k.running.cpu_max": 70.0,
+            "r.az.none.t.k.running.network_in_avg": 100.0,
+        })
+
+    def test_stopped(self):
+        group = awsmonitor.GroupStats()
+        group.add({})
+        group.add({})
+        data = {}
+        group.finalize("r.az.none.t.k.stopped", data)
+        self.assertEqual(data, {"r.az.none.t.k.stopped.count": 2})
+        self.assertFalse("r.az.none.t.k.stopped.cpu_min" in data)
+
+def instance(instance_id, az="us-east-1a", type="m5.large", group="", key="key-1"):
+    r = {"InstanceId": instance_id, "InstanceType": type,
+            "Placement": {"AvailabilityZone": az, "GroupName": group}}
+    if key is not None:
+        r["KeyName"] = key
+    return r
+
+
+class FakePaginator(object):
+
+    def __init__(self, ec2, operation):
+        self.ec2 = ec2
+        self.operation = operation
+
+    def paginate(self, **kwargs):
+        self.ec2.calls.append((self.operation, kwargs))
+        if self.operation == "describe_instance_status":
+            yield {"InstanceStatuses": [{"InstanceId": i, "InstanceState": {"Name": state}}
+                for i, state in self.ec2.states]}
+            return
+        wanted = None
+        if "Filters" in kwargs:
+            wanted = set(kwargs["Filters"][0]["Values"])
+        found = [i for i in self.ec2.instances if wanted is None or i["InstanceId"] in wanted]
+        # a page per two instances
+        for n in xrange(0, max(len(found), 1), 2):
+            yield {"Reservations": [{"Instances": found[n:n+2]}]}
+
+
+class FakeEc2(object):
+
+    def __init__(self, instances, states=()):
+        self.instances = instances
+        self.states = list(states)
+        self.calls = []
+
+    def get_paginator(self, operation):
+        return FakePaginator(self, operation)
+
+
+class InstanceCacheTest(unittest.TestCase):
+
+    def test_group_key(self):
+        cache = awsmonitor.InstanceCache("us-east-1")
+        self.assertEqual(cache.group_key(instance("i-a", group="my.group")),
+                "us-east-1.us-east-1a.my_group.m5_large.key-1")
+        self.assertEqual(cache.group_key(instance("i-a", key=None)),
+                "us-east-1.us-east-1a.none.m5_large.None")
+
+    def test_describes_only_missing(self):
+        ec2 = FakeEc2([instance("i-a"), instance("i-b", type="t3.micro"), instance("i-c")])
+        cache = awsmonitor.InstanceCache("us-east-1")
+        cache.update(ec2, ["i-a", "i-b"])
+        self.assertEqual(ec2.calls, [("describe_instances",
+            {"Filters": [{"Name": "instance-id", "Values": ["i-a", "i-b"]}]})])
+        self.assertEqual(cache.stats, {"hits": 0, "misses": 2, "evicted": 0,
+            "describe_calls": 1, "size": 2})
+        self.assertEqual(cache.get("i-b"), "us-east-1.us-east-1a.none.t3_micro.key-1")
+        cache.update(ec2, ["i-a", "i-b", "i-c"])
+        self.assertEqual(ec2.calls[1][1]["Filters"][0]["Values"], ["i-c"])
+        self.assertEqual(cache.stats["hits"], 2)
+        self.assertEqual(cache.stats["misses"], 1)
+        self.assertEqual(cache.get("i-z"), None)
+
+    def test_filter_chunks_and_unfiltered(self):
+        ids = ["i-%04d" % n for n in xrange(450)]
+        ec2 = FakeEc2([instance(i) for i in ids])
+        cache = awsmonitor.InstanceCache("us-east-1", max_filter=1000)
+        cache.update(ec2, ids)
+        self.assertEqual([len(kwargs["Filters"][0]["Values"]) for op, kwargs in ec2.calls],
+                [200, 200, 50])
+        self.assertEqual(cache.stats["describe_calls"], 225)
+        self.assertEqual(cache.stats["size"], 450)
+        ec2 = FakeEc2([instance(i) for i in ids])
+        cache = awsmonitor.InstanceCache("us-east-1", max_filter=100)
+        cache.update(ec2, ids)
+        self.assertEqual(ec2.calls, [("describe_instances", {})])
+        self.assertEqual(cache.stats["size"], 450)
+
+    def test_expires(self):
+        ec2 = FakeEc2([instance("i-a"), instance("i-b")])
+        cache = awsmonitor.InstanceCache("us-east-1", ttl=-1)
+        cache.update(ec2, ["i-a", "i-b"])
+        cache.update(ec2, ["i-a"])
+        self.assertEqual(cache.stats, {"hits": 0, "misses": 1, "evicted": 2,
+            "describe_calls": 1, "size": 1})
+
+
+class GetEc2InstancesTest(unittest.TestCase):
+
+    def test_groups_by_key_and_state(self):
+        ec2 = FakeEc2([instance("i-a"), instance("i-b"), instance("i-c")],
+                [("i-a", "running"), ("i-b", "running"), ("i-c", "stopped"), ("i-gone", "running")])
+        cloudwatch = FakeCloudWatch({
+            ("i-a", "CPUUtilization", "Average"): [20.0],
+            ("i-a", "CPUUtilization", "Minimum"): [10.0],
+            ("i-b", "CPUUtilization", "Average"): [40.0],
+            ("i-b", "CPUUtilization", "Maximum"): [90.0],
+        })
+        cache = awsmonitor.InstanceCache("us-east-1")
+        data = awsmonitor.get_ec2_instances(ec2, cloudwatch, cache)
+        base = "us-east-1.us-east-1a.none.m5_large.key-1."
+        self.assertEqual(data, {
+            base+"running.count": 2,
+            base+"running.cpu_avg": 30.0,
+            base+"running.cpu_min": 10.0,
+            base+"running.cpu_max": 90.0,
+            base+"stopped.count": 1,
+        })
+        # only running instances are asked for metrics
+        queried = set(q["MetricStat"]["Metric"]["Dimensions"][0]["Value"]
+                for c in cloudwatch.calls for q in c["MetricDataQueries"])
+        self.assertEqual(queried, set(["i-a", "i-b"]))
+
+    def test_counts_without_metrics(self):
+        ec2 = FakeEc2([instance("i-a")], [("i-a", "running")])
+        class BrokenCloudWatch(object):
+            def get_metric_data(self, **kwargs):
+                raise RuntimeError("throttled")
+        data = awsmonitor.get_ec2_instances(ec2, BrokenCloudWatch(), awsmonitor.InstanceCache("r"))
+        self.assertEqual(data, {"r.us-east-1a.none.m5_large.key-1.running.count": 1})
+
+class FakeSession(object):
+    sessions = []
+
+    def __init__(self, profile_name=None):
+        self.profile_name = profile_name
+        self.clients = []
+        FakeSession.sessions.append(self)
+
+    def client(self, name, region_name=None):
+        self.clients.append((name, region_name, threading.current_thread().name))
+        return (self.profile_name, name, region_name)
+
+
+class FakeBoto3(object):
+    class session(object):
+        Session = FakeSession
+
+
+class AwsProbeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.boto3 = awsmonitor.boto3
+        awsmonitor.boto3 = FakeBoto3
+        FakeSession.sessions = []
+        self.probe = awsmonitor.AwsProbe(profiles=["a", "b"], regions=["us-west-2", "us-east-1"],
+                use_graphite=False, use_influxdb=False, test=True, max_workers=4)
+
+    def tearDown(self):
+        awsmonitor.boto3 = self.boto3
+
+    def test_reuses_sessions_and_clients(self):
+        ec2, cloudwatch = self.probe.get_clients("a", "us-east-1")
+        self.assertEqual(ec2, ("a", "ec2", "us-east-1"))
+        self.assertEqual(cloudwatch, ("a", "cloudwatch", "us-east-1"))
+        self.assertTrue(self.probe.get_clients("a", "us-east-1")[1] is cloudwatch)
+        self.probe.get_clients("a", "us-west-2")
+        self.assertEqual([s.profile_name for s in FakeSession.sessions], ["a"])
+
+    def test_posts_every_region_of_every_profile(self):
+        posted = []
+        self.probe.post_region = lambda profile, region: posted.append(
+                (profile, region, threading.current_thread().name))
+        self.probe.post()
+        self.probe.post()
+        self.assertEqual(sorted((p, r) for p, r, t in posted),
+                sorted([(p, r) for p in ["a", "b"] for r in ["us-west-2", "us-east-1"]]*2))
+        self.assertTrue(all(t != threading.current_thread().name for p, r, t in posted))
+        # one session per profile, made on the probe's thread
+        self.assertEqual(sorted(s.profile_name for s in FakeSession.sessions), ["a", "b"])
+        for s in FakeSession.sessions:
+            self.assertEqual(len(s.clients), 4)
+            self.assertTrue(all(t == threading.current_thread().name for n, r, t in s.clients))
+
+
+@unittest.skipIf(boto3 is None, "boto3 is not installed")
+class StubbedCloudWatchTest(unittest.TestCase):
+    """the same requests against botocore's own model of the API"""
+
+    def setUp(self):
+        self.cloudwatch = boto3.client("cloudwatch", region_name="us-east-1",
+                aws_access_key_id="test", aws_secret_access_key="test")
+        self.stubber = Stubber(self.cloudwatch)
+
+    def tearDown(self):
+        self.stubber.assert_no_pending_responses()
+
+    def params(self, **kwargs):
+        params = {
+            "MetricDataQueries": ANY,
+            "StartTime": START,
+            "EndTime": END,
+            "ScanBy": "TimestampDescending",
+        }
+        params.update(kwargs)
+        return params
+
+    def test_batches_and_pages(self):
+        instances = ["i-%03d" % n for n in xrange(200)]
+        self.stubber.add_response("get_metric_data", {"NextToken": "page2", "MetricDataResults": [
+            {"Id": "i0_0_avg", "Values": [3.0], "StatusCode": "PartialData"}]}, self.params())
+        self.stubber.add_response("get_metric_data", {"MetricDataResults": [
+            {"Id": "i0_0_avg", "Values": [2.0], "StatusCode": "Complete"}]},
+            self.params(NextToken="page2"))
+        self.stubber.add_response("get_metric_data", {"MetricDataResults": [
+            {"Id": "i199_0_max", "Values": [7.0], "StatusCode": "Complete"}]}, self.params())
+        with self.stubber:
+            r = awsmonitor.get_ec2_metrics(self.cloudwatch, instances, end_time=END)
+        self.assertEqual(r["i-000"]["CPUUtilization"], {"avg": 3.0})
+        self.assertEqual(r["i-199"]["CPUUtilization"], {"max": 7.0})
+
+    def test_several_metrics(self):
+        self.stubber.add_response("get_metric_data", {"MetricDataResults": [
+            {"Id": "i0_1_min", "Values": [12.0], "StatusCode": "Complete"},
+            {"Id": "i1_0_avg", "Values": [40.0, 30.0], "StatusCode": "Complete"}]}, self.params())
+        with self.stubber:
+            r = awsmonitor.get_ec2_metrics(self.cloudwatch, ["i-a", "i-b"],
+                    metrics=("CPUUtilization", "NetworkIn"), end_time=END)
+        self.assertEqual(r["i-a"], {"NetworkIn": {"min": 12.0}})
+        self.assertEqual(r["i-b"], {"CPUUtilization": {"avg": 40.0}})
+
+
+@unittest.skipIf(boto3 is None, "boto3 is not installed")
+class StubbedEc2Test(unittest.TestCase):
+    """InstanceCache and get_instance_states against botocore's paginators"""
+
+    def setUp(self):
+        self.ec2 = boto3.client("ec2", region_name="us-east-1",
+                aws_access_key_id="test", aws_secret_access_key="test")
+        self.stubber = Stubber(self.ec2)
+
+    def tearDown(self):
+        self.stubber.assert_no_pending_responses()
+
+    def test_instance_cache(self):
+        self.stubber.add_response("describe_instances",
+                {"Reservations": [{"Instances": [instance("i-a")]}], "NextToken": "more"},
+                {"Filters": [{"Name": "instance-id", "Values": ["i-a", "i-b"]}]})
+        self.stubber.add_response("describe_instances",
+                {"Reservations": [{"Instances": [instance("i-b", key=None)]}]},
+                {"Filters": [{"Name": "instance-id", "Values": ["i-a", "i-b"]}], "NextToken": "more"})
+        cache = awsmonitor.InstanceCache("us-east-1")
+        with self.stubber:
+            cache.update(self.ec2, ["i-a", "i-b"])
+            # cached, no more calls
+            cache.update(self.ec2, ["i-a", "i-b"])
+        self.assertEqual(cache.get("i-a"), "us-east-1.us-east-1a.none.m5_large.key-1")
+        self.assertEqual(cache.get("i-b"), "us-east-1.us-east-1a.none.m5_large.None")
+        self.assertEqual(cache.stats["hits"], 2)
+
+    def test_instance_states(self):
+        self.stubber.add_response("describe_instance_status",
+                {"InstanceStatuses": [{"InstanceId": "i-a", "InstanceState": {"Name": "running"}}],
+                    "NextToken": "more"},
+                {"IncludeAllInstances": True})
+        self.stubber.add_response("describe_instance_status",
+                {"InstanceStatuses": [{"InstanceId": "i-b", "InstanceState": {"Name": "stopped"}}]},
+                {"IncludeAllInstances": True, "NextToken": "more"})
+        with self.stubber:
+            states = awsmonitor.get_instance_states(self.ec2)
+        self.assertEqual(states, [("i-a", "running"), ("i-b", "stopped")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+#!/usr/bin/python
+import json
+import os
+import sys
+import threading
+import unittest
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+
+from fifemon.esbulk import BulkIndexer
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """answers _bulk requests with the item statuses from the server's
+    respond(ids) function, which returns an HTTP status for the whole
+    request or {id: item status} (200 if missing). server.results(items)
+    can change the result items, None leaves them out of the response"""
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        lines = body.splitlines()
+        ids = [json.loads(line)["update"]["_id"] for line in lines[0::2]]
+        self.server.requests.append((ids, len(body)))
+        result = self.server.respond(ids)
+        if not isinstance(result, dict):
+            self.send_response(result)
+            self.end_headers()
+            return
+        items = []
+        for doc_id in ids:
+            status = result.get(doc_id, 200)
+            item = {"_id": doc_id, "status": status}
+            if status >= 300:
+                item["error"] = {"type": "stub_error", "reason": "status {0}".format(status)}
+            items.append({"update": item})
+        response = {"errors": len(result) > 0}
+        items = self.server.results(items)
+        if items is not None:
+            response["items"] = items
+        response = json.dumps(response)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+class BulkIndexerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), StubHandler)
+        self.server.requests = []
+        self.server.respond = lambda ids: {}
+        self.server.results = lambda items: items
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def indexer(self, **kwargs):
+        kwargs.setdefault("workers", 1)
+        kwargs.setdefault("retry_delay", 0)
+        host = "127.0.0.1:{0}".format(self.server.server_address[1])
+        return BulkIndexer([host], "test-index", "jobid", **kwargs)
+
+    def write(self, indexer, ids):
+        for doc_id in ids:
+            indexer.write({"jobid": doc_id, "JobStatus": 2})
+        indexer.flush()
+
+    def test_retries_only_failed_items(self):
+        responses = [{"b": 429}, {}]
+        self.server.respond = lambda ids: responses.pop(0)
+        indexer = self.indexer()
+        self.write(indexer, ["a", "b", "c"])
+        self.assertEqual([ids for ids, size in self.server.requests], [["a", "b", "c"], ["b"]])
+        self.assertEqual(indexer.indexed, 3)
+        self.assertEqual(indexer.retried, 1)
+        self.assertEqual(indexer.failed, 0)
+
+    def test_gives_up_after_max_retries(self):
+        self.server.respond = lambda ids: {"b": 429}
+        indexer = self.indexer(max_retries=2)
+        self.write(indexer, ["a", "b"])
+        self.assertEqual([ids for ids, size in self.server.requests], [["a", "b"], ["b"], ["b"]])
+        self.assertEqual(indexer.indexed, 1)
+        self.assertEqual(indexer.failed, 1)
+
+    def test_rejected_items_are_not_retried(self):
+        self.server.respond = lambda ids: {"b": 400}
+        indexer = self.indexer()
+        self.write(indexer, ["a", "b", "c"])
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(indexer.indexed, 2)
+        self.assertEqual(indexer.failed, 1)
+        self.assertEqual(indexer.retried, 0)
+
+    def test_batches_by_bytes(self):
+        indexer = self.indexer(batch_size=1000, max_bytes=400)
+        ids = ["job{0:03d}".format(i) for i in xrange(20)]
+        self.write(indexer, ids)
+        self.assertTrue(len(self.server.requests) > 1)
+        for request_ids, size in self.server.requests:
+            self.assertTrue(size <= 400, size)
+        self.assertEqual(sum((request_ids for request_ids, size in self.server.requests), []), ids)
+        self.assertEqual(indexer.indexed, 20)
+
+    def test_batches_by_count(self):
+        indexer = self.indexer(batch_size=3)
+        self.write(indexer, ["a", "b", "c", "d"])
+        self.assertEqual([ids for ids, size in self.server.requests], [["a", "b", "c"], ["d"]])
+
+    def test_retries_whole_request_on_server_error(self):
+        responses = [503, {}]
+        self.server.respond = lambda ids: responses.pop(0)
+        indexer = self.indexer()
+        self.write(indexer, ["a", "b"])
+        self.assertEqual([ids for ids, size in self.server.requests], [["a", "b"], ["a", "b"]])
+        self.assertEqual(indexer.indexed, 2)
+        self.assertEqual(indexer.retried, 2)
+        self.assertEqual(indexer.failed, 0)
+
+    def test_drops_request_on_client_error(self):
+        self.server.respond = lambda ids: 400
+        indexer = self.indexer()
+        self.write(indexer, ["a", "b"])
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(indexer.indexed, 0)
+        self.assertEqual(indexer.failed, 2)
+
+    def test_missing_results_count_as_failed(self):
+        self.server.results = lambda items: items[:2]
+        indexer = self.indexer()
+        self.write(indexer, ["a", "b", "c"])
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(indexer.indexed, 2)
+        self.assertEqual(indexer.failed, 1)
+
+    def test_no_results_count_as_failed(self):
+        self.server.results = lambda items: None
+        indexer = self.indexer()
+        self.write(indexer, ["a", "b"])
+        self.assertEqual(indexer.indexed, 0)
+        self.assertEqual(indexer.failed, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
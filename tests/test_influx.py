@@ -0,0 +1,85 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import sys
+import threading
+import unittest
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+
+try:
+    from fifemon.influx import Influxdb, escape_key, format_value
+except ImportError:
+    Influxdb = None
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """accepts /write requests, keeping their bodies in server.bodies"""
+
+    def do_POST(self):
+        self.server.bodies.append(self.rfile.read(int(self.headers["Content-Length"])))
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@unittest.skipIf(Influxdb is None, "influxdb is not installed")
+class FormatTest(unittest.TestCase):
+
+    def test_values(self):
+        self.assertEqual(format_value(True), "true")
+        self.assertEqual(format_value(3), "3i")
+        self.assertEqual(format_value(0.5), "0.5")
+        self.assertEqual(format_value('a "b"'), '"a \\"b\\""')
+        self.assertEqual(format_value(float("nan")), None)
+        self.assertEqual(format_value(float("inf")), None)
+        self.assertEqual(format_value(float("-inf")), None)
+
+    def test_unicode(self):
+        self.assertEqual(escape_key(u"caf\xe9 au lait"), "caf\xc3\xa9\\ au\\ lait")
+        self.assertEqual(format_value(u"☃"), '"\xe2\x98\x83"')
+
+
+@unittest.skipIf(Influxdb is None, "influxdb is not installed")
+class SendDictTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), StubHandler)
+        self.server.bodies = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.influxdb = Influxdb(host="127.0.0.1", port=self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_skips_non_finite(self):
+        data = {"pool.jobs": 2.0, "pool.ratio": float("nan"), "pool.rate": float("inf")}
+        self.influxdb.send_dict(data, timestamp=100, schema="pool.measurement")
+        self.assertEqual(self.server.bodies, ["jobs,pool=pool value=2.0 100\n"])
+        self.influxdb.send_dict(data, timestamp=100)
+        self.assertEqual(self.server.bodies[1], "pool.jobs value=2.0 100\n")
+        self.assertEqual(self.influxdb.get_stats()["points"], 2)
+
+    def test_unicode_tags_and_fields(self):
+        data = {u"m\xfcller.jobs": 1, "other.jobs": 2}
+        self.influxdb.send_dict(data, timestamp=100, schema="user.measurement",
+                tags={"pool": u"☃"})
+        self.assertEqual(len(self.server.bodies), 1)
+        lines = sorted(self.server.bodies[0].splitlines())
+        self.assertEqual(lines, [
+            "jobs,pool=\xe2\x98\x83,user=m\xc3\xbcller value=1i 100",
+            "jobs,pool=\xe2\x98\x83,user=other value=2i 100",
+        ])
+        self.influxdb.send_dict({"pool.user": u"\xe9"}, timestamp=100,
+                schema="pool.measurement", field="name")
+        self.assertEqual(self.server.bodies[1], 'user,pool=pool name="\xc3\xa9" 100\n')
+
+
+if __name__ == "__main__":
+    unittest.main()
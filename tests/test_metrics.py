@@ -0,0 +1,81 @@
+#!/usr/bin/python
+import os
+import sys
+import unittest
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, "..", "bin"))
+try:
+    import htcondor
+except ImportError:
+    # the condor package needs the bindings; the benchmarks' synthetic
+    # pool stands in for them
+    sys.path.insert(1, os.path.join(here, "..", "bench", "fake"))
+
+from condor.metrics import DerivedMetrics, MetricKeys, MetricValues
+
+
+class MetricValuesTest(unittest.TestCase):
+
+    def test_reads_like_a_dict(self):
+        values = MetricValues(MetricKeys())
+        values.add_key(("a", "b"), ".count", 1)
+        values.add_key(("a", "b"), ".count", 2)
+        values.set_key(("a", "c"), ".walltime", 10)
+        self.assertEqual(dict(values), {"a.b.count": 3, "a.c.walltime": 10})
+        self.assertEqual(values["a.b.count"], 3)
+        self.assertTrue("a.c.walltime" in values)
+        self.assertFalse("a.c.count" in values)
+        self.assertFalse("x.y.count" in values)
+        self.assertEqual(len(values), 2)
+        self.assertRaises(KeyError, lambda: values["a.b.walltime"])
+
+    def test_dict_after_trim(self):
+        keys = MetricKeys()
+        values = MetricValues(keys)
+        values.add_key(("a", "b"), ".count", 1)
+        for n in xrange(2000):
+            keys.id(("old", str(n)))
+        self.assertTrue(keys.trim(1))
+        # the new registry hands out the same id to another path
+        other = MetricValues(keys)
+        other.add_key(("x", "y"), ".count", 5)
+        self.assertEqual(keys.id(("x", "y")), 0)
+        self.assertEqual(values.items(), [("a.b.count", 1)])
+        self.assertEqual(dict(values), {"a.b.count": 1})
+        self.assertEqual(values["a.b.count"], 1)
+        self.assertFalse("x.y.count" in values)
+        self.assertEqual(dict(other), {"x.y.count": 5})
+
+    def test_iterparts(self):
+        values = MetricValues(MetricKeys())
+        values.add_key(("a", "b"), ".count", 1)
+        self.assertEqual(list(values.iterparts()), [(("a", "b", "count"), 1)])
+
+    def test_pickles_to_dict(self):
+        import cPickle
+        values = MetricValues(MetricKeys())
+        values.add_key(("a", "b"), ".count", 1)
+        self.assertEqual(cPickle.loads(cPickle.dumps(values, 2)), {"a.b.count": 1})
+
+
+class DerivedMetricsTest(unittest.TestCase):
+
+    def test_finalize(self):
+        derived = DerivedMetrics()
+        derived.register(".avg", lambda total, count: total/count if count > 0 else None,
+                [".total", ".count"])
+        values = MetricValues(MetricKeys())
+        values.add_key(("a",), ".total", 10.0)
+        values.add_key(("a",), ".count", 4)
+        values.add_key(("b",), ".total", 1.0)
+        values.add_key(("b",), ".count", 0)
+        values.add_key(("c",), ".total", 1.0)
+        derived.finalize(values)
+        self.assertEqual(values["a.avg"], 2.5)
+        self.assertFalse("b.avg" in values)
+        self.assertFalse("c.avg" in values)
+
+
+if __name__ == "__main__":
+    unittest.main()
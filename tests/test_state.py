@@ -0,0 +1,42 @@
+#!/usr/bin/python
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+
+from fifemon.state import load_state, save_state
+
+
+class StateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "state")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        save_state(self.path, ({"a": 1}, 42))
+        self.assertEqual(load_state(self.path, None), ({"a": 1}, 42))
+        self.assertFalse(os.path.exists(self.path+".tmp"))
+
+    def test_missing_or_unset(self):
+        self.assertEqual(load_state(self.path, ({}, 0)), ({}, 0))
+        self.assertEqual(load_state(None, ({}, 0)), ({}, 0))
+        save_state(None, ({}, 0))
+
+    def test_unreadable(self):
+        with open(self.path, "wb") as f:
+            f.write("not a pickle")
+        self.assertEqual(load_state(self.path, ({}, 0)), ({}, 0))
+
+    def test_unwritable(self):
+        save_state(os.path.join(self.dir, "missing", "state"), ({}, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()